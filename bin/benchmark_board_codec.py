@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+from time import perf_counter
+from typing import Any, Callable
+
+import numpy as np
+
+from rl_infra.impl.tetris.online.tetris_board_codec import packFrames, unpackFrames
+from rl_infra.impl.tetris.online.tetris_transition import BOARD_SHAPE, TetrisPiece
+from rl_infra.utils import compressNpArray, uncompressNpArray
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Compare decoding a batch of tetris boards stored one base64 string per board against unpacking
+        the same batch from the 2-bit packed representation."""
+    )
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of boards per batch (default 256).")
+    parser.add_argument("--repeats", type=int, default=20, help="Number of timings to take the best of (default 20).")
+
+    return parser
+
+
+def makeBoards(batchSize: int, rng: np.random.Generator) -> np.ndarray:
+    boards = np.zeros((batchSize,) + BOARD_SHAPE, dtype=np.uint8)
+    boards[:, :, :, :-1] = rng.integers(0, 3, size=boards[:, :, :, :-1].shape, dtype=np.uint8)
+    boards[:, :, 0, -1] = rng.integers(0, len(TetrisPiece), size=(batchSize, BOARD_SHAPE[0]), dtype=np.uint8)
+    boards[:, :, 1, -1] = rng.integers(0, 2, size=(batchSize, BOARD_SHAPE[0]), dtype=np.uint8)
+    return boards
+
+
+def timeBest(fn: Callable[[], Any], repeats: int) -> tuple[float, Any]:
+    """Returns the best time of repeats calls, and the result of the last one."""
+    best = float("inf")
+    res = None
+    for _ in range(repeats):
+        start = perf_counter()
+        res = fn()
+        best = min(best, perf_counter() - start)
+    return best, res
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    boards = makeBoards(args.batch_size, np.random.default_rng(0))
+    encoded = [compressNpArray(board) for board in boards]
+    packTime, packed = timeBest(lambda: packFrames(boards), args.repeats)
+    base64Time, base64Boards = timeBest(
+        lambda: np.stack([uncompressNpArray(**board) for board in encoded]), args.repeats
+    )
+    unpackTime, unpacked = timeBest(lambda: unpackFrames(packed), args.repeats)
+    if not np.array_equal(base64Boards, boards) or not np.array_equal(unpacked, boards):
+        raise RuntimeError("Decoded boards do not round trip")
+
+    print(f"{'encoding':>10} {'bytes/board':>12} {'decode (us)':>12} {'vs base64':>10}")
+    print(f"{'raw':>10} {boards[0].nbytes:>12} {'':>12} {'':>10}")
+    print(f"{'base64':>10} {len(encoded[0]['data']):>12} {base64Time * 1e6:>12.1f} {1:>9.1f}x")
+    print(f"{'packed':>10} {packed[0].nbytes:>12} {unpackTime * 1e6:>12.1f} {base64Time / unpackTime:>9.1f}x")
+    print(f"Packing {args.batch_size} boards takes {packTime * 1e6:.1f} us")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+from contextlib import ExitStack
+from time import perf_counter
+
+import torch
+
+from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService
+from rl_infra.impl.tetris.offline.tetris_training_service import TetrisTrainingService
+from rl_infra.impl.tetris.online.tetris_environment import TetrisEnvironment
+from rl_infra.impl.tetris.online.tetris_transition import TetrisAction
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Measure training throughput (samples/sec) of data parallel training on CPU against the number of
+        worker processes."""
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        nargs="+",
+        help="Worker counts to benchmark.  Defaults to powers of 2 up to the number of cores.",
+    )
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of transitions per batch (default 256).")
+    parser.add_argument("--num-batches", type=int, default=50, help="Number of batches to time (default 50).")
+    parser.add_argument(
+        "--num-rows", type=int, default=20_000, help="Number of transitions to play into data.db (default 20000)."
+    )
+    parser.add_argument(
+        "--prefetch-batches", type=int, default=2, help="Batches each process prefetches (default 2)."
+    )
+
+    return parser
+
+
+def fillDataService(dataService: TetrisDataService, numRows: int) -> None:
+    env = TetrisEnvironment()
+    actions = list(TetrisAction)
+    numPushed = 0
+    while numPushed < numRows:
+        while not env.step(random.choice(actions)).newState.isTerminal:
+            pass
+        dataService.pushEpisode(env.currentEpisodeRecord)
+        numPushed += len(env.currentEpisodeRecord.moves)
+        env.startNewEpisode()
+
+
+def timeTraining(trainingService: TetrisTrainingService, numWorkers: int, args: argparse.Namespace) -> float:
+    trainingService.policyModel = trainingService.modelFactory()
+    trainingService.targetModel = trainingService.modelFactory()
+    trainingService.optimizer = trainingService.optimizerFactory()
+    with ExitStack() as stack:
+        if numWorkers > 1:
+            stack.enter_context(trainingService.dataParallel(numWorkers))
+        # Warm up, so that process startup and the first sqlite connections are not timed
+        trainingService._trainBatches(args.batch_size, 2)
+        start = perf_counter()
+        trainingService._trainBatches(args.batch_size, args.num_batches)
+        return perf_counter() - start
+
+
+def runBenchmark(rootPath: str, args: argparse.Namespace) -> None:
+    # The training services (including those in worker processes) create their model database under the working
+    # directory, so keep it out of the caller's
+    os.chdir(rootPath)
+    dataService = TetrisDataService(rootPath=rootPath)
+    fillDataService(dataService, args.num_rows)
+    trainingService = TetrisTrainingService(
+        torch.device("cpu"), dataService=dataService, prefetchDepth=args.prefetch_batches
+    )
+    numCores = os.cpu_count() or 1
+    workerCounts = args.num_workers or [2**i for i in range(numCores.bit_length()) if 2**i <= numCores]
+
+    print(f"{numCores} cores, batches of {args.batch_size}")
+    print(f"{'workers':>8} {'samples/s':>12} {'speedup':>8}")
+    baseline = None
+    for numWorkers in workerCounts:
+        seconds = timeTraining(trainingService, numWorkers, args)
+        rate = args.batch_size * args.num_batches / seconds
+        baseline = rate if baseline is None else baseline
+        print(f"{numWorkers:>8} {rate:>12,.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        runBenchmark(tmpDir, args)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+from time import perf_counter
+from typing import Callable
+
+import torch
+from tetris.config import BOARD_SIZE
+
+from rl_infra.impl.tetris.offline.dqn import EXECUTION_MODES, DeepQNetwork
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Report DeepQNetwork forward (inference) and forward + backward (training) latency on CPU in each
+        execution mode."""
+    )
+    parser.add_argument(
+        "--modes", choices=EXECUTION_MODES, nargs="+", default=list(EXECUTION_MODES), help="Modes to benchmark."
+    )
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 32, 256], help="Batch sizes to benchmark (default 1 32 256)."
+    )
+    parser.add_argument("--iterations", type=int, default=200, help="Number of timed calls (default 200).")
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="Untimed calls first, e.g. for compilation (default 10)."
+    )
+
+    return parser
+
+
+def timePerCall(fn: Callable[[], None], iterations: int, warmup: int) -> float:
+    for _ in range(warmup):
+        fn()
+    start = perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    device = torch.device("cpu")
+    print(f"{'mode':>8} {'batch':>6} {'forward (us)':>13} {'fwd + bwd (us)':>15}")
+    for mode in args.modes:
+        model = DeepQNetwork(
+            arrayHeight=BOARD_SIZE[0],
+            arrayWidth=BOARD_SIZE[1] + 1,
+            numOutputs=5,
+            device=device,
+            executionMode=mode,
+        )
+        for batchSize in args.batch_sizes:
+            boards = torch.randint(0, 3, (batchSize, 2, BOARD_SIZE[0], BOARD_SIZE[1] + 1), dtype=torch.uint8)
+
+            def forward() -> None:
+                with torch.no_grad():
+                    model(boards)
+
+            def forwardBackward() -> None:
+                model.zero_grad()
+                model(boards).max(1)[0].mean().backward()
+
+            forwardTime = timePerCall(forward, args.iterations, args.warmup)
+            trainTime = timePerCall(forwardBackward, args.iterations, args.warmup)
+            print(f"{mode:>8} {batchSize:>6} {forwardTime * 1e6:>13.1f} {trainTime * 1e6:>15.1f}")
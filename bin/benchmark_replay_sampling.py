@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from rl_infra.impl.tetris.offline.tetris_data_schema import DATA_COLUMNS
+from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService
+from rl_infra.impl.tetris.online.tetris_board_codec import packFrames
+from rl_infra.impl.tetris.online.tetris_transition import BOARD_SHAPE, TetrisAction, TetrisPiece
+from rl_infra.types.offline import SqliteConnection, closeSqliteConnections
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Compare ORDER BY random() sampling against slot-index sampling on tables of increasing size."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="Table sizes (in rows) to benchmark (default 10k, 100k, 1M).",
+    )
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of rows per sample (default 32).")
+    parser.add_argument("--num-samples", type=int, default=20, help="Number of samples to time per size (default 20).")
+    parser.add_argument(
+        "--root-path",
+        type=str,
+        help="Directory to build the benchmark databases in.  Defaults to a temporary directory.",
+    )
+
+    return parser
+
+
+def fillDataService(dataService: TetrisDataService, numRows: int, rng: np.random.Generator) -> None:
+    # A handful of distinct frames is enough; the cost being measured is in locating rows, not in their contents.
+    rawFrames = rng.integers(0, 3, size=(16,) + BOARD_SHAPE[1:], dtype=np.uint8)
+    rawFrames[:, :, -1] = 0  # The metadata column
+    frames = [frame.tobytes() for frame in packFrames(rawFrames)]
+    pieces = [piece.value for piece in TetrisPiece]
+    actions = [action.value for action in TetrisAction]
+    chunkSize = 10_000
+    with SqliteConnection(dataService.dbPath) as cur:
+        cur.executemany(
+            "INSERT INTO frames (frame_id, frame) VALUES (?, ?);",
+            ((i, frames[i % len(frames)]) for i in range(numRows + 2)),
+        )
+        for start in range(0, numRows, chunkSize):
+            rows = [
+                (i, 0, pieces[i % 5], pieces[(i + 1) % 5], False, actions[i % 5])
+                + (0, pieces[(i + 1) % 5], pieces[(i + 2) % 5], False, float(rng.integers(-1, 2)))
+                for i in range(start, min(start + chunkSize, numRows))
+            ]
+            cur.executemany(
+                f"INSERT INTO data ({', '.join(DATA_COLUMNS)}) VALUES ({', '.join('?' * len(DATA_COLUMNS))});", rows
+            )
+
+
+def timeLegacySample(dataService: TetrisDataService, batchSize: int, numSamples: int) -> float:
+    with SqliteConnection(dataService.dbPath) as cur:
+        start = perf_counter()
+        for _ in range(numSamples):
+            rows = cur.execute(
+                f"SELECT {', '.join(DATA_COLUMNS)} FROM data ORDER BY random() LIMIT {batchSize};"
+            ).fetchall()
+            dataService._attachFrames(cur, rows)
+        return (perf_counter() - start) / numSamples
+
+
+def timeSlotSample(dataService: TetrisDataService, batchSize: int, numSamples: int) -> float:
+    with SqliteConnection(dataService.dbPath) as cur:
+        start = perf_counter()
+        for _ in range(numSamples):
+            dataService._attachFrames(cur, dataService._sampleRows(cur, batchSize))
+        return (perf_counter() - start) / numSamples
+
+
+def runBenchmark(rootPath: str, args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>10} {'order by random() (ms)':>24} {'slot index (ms)':>16} {'speedup':>8}")
+    for numRows in args.sizes:
+        dataService = TetrisDataService(rootPath=f"{rootPath}/{numRows}", capacity=numRows)
+        fillDataService(dataService, numRows, rng)
+        legacy = timeLegacySample(dataService, args.batch_size, args.num_samples)
+        slot = timeSlotSample(dataService, args.batch_size, args.num_samples)
+        print(f"{numRows:>10} {legacy * 1000:>24.3f} {slot * 1000:>16.3f} {legacy / slot:>7.1f}x")
+        closeSqliteConnections(dataService.dbPath)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(dataService.dbPath + suffix):
+                os.remove(dataService.dbPath + suffix)
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    if args.root_path is not None:
+        runBenchmark(args.root_path, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            runBenchmark(tmpDir, args)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+from time import perf_counter
+from typing import Callable, Sequence
+
+import numpy as np
+
+from rl_infra.impl.tetris.online.tetris_transition import (
+    BOARD_SHAPE,
+    TetrisAction,
+    TetrisDataDbRow,
+    TetrisPiece,
+    TetrisState,
+    TetrisTransition,
+)
+from rl_infra.types.online.transition import DataDbRow
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Compare the rate at which stored transition rows are decoded: the version 1 JSON rows through
+        TetrisTransition.from_orm, the current rows with pydantic validation, and the current rows with trusted
+        decoding."""
+    )
+    parser.add_argument("--num-rows", type=int, default=10_000, help="Number of rows to decode (default 10000).")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timings to take the best of (default 3).")
+
+    return parser
+
+
+def makeTransitions(numRows: int, rng: np.random.Generator) -> list[TetrisTransition]:
+    pieces, actions = list(TetrisPiece), list(TetrisAction)
+    transitions = []
+    for _ in range(numRows):
+        state, newState = (
+            TetrisState(
+                board=rng.integers(0, 3, size=BOARD_SHAPE, dtype=np.uint8),  # pyright: ignore
+                score=int(rng.integers(0, 100)),
+                activePiece=pieces[rng.integers(len(pieces))],
+                nextPiece=pieces[rng.integers(len(pieces))],
+                isTerminal=False,
+            )
+            for _ in range(2)
+        )
+        transitions.append(
+            TetrisTransition(
+                state=state, action=actions[rng.integers(len(actions))], newState=newState, reward=float(rng.random())
+            )
+        )
+    return transitions
+
+
+def timeDecode(decode: Callable[[], Sequence[TetrisTransition]], repeats: int) -> tuple[float, list[TetrisTransition]]:
+    """Returns the best time of repeats decodes, and the result of the last one."""
+    best = float("inf")
+    res: list[TetrisTransition] = []
+    for _ in range(repeats):
+        start = perf_counter()
+        res = list(decode())
+        best = min(best, perf_counter() - start)
+    return best, res
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    transitions = makeTransitions(args.num_rows, np.random.default_rng(0))
+    jsonRows = [DataDbRow(*transition.toDbRow()) for transition in transitions]
+    dbRows = [transition.toTetrisDbRow() for transition in transitions]
+    decoders: list[tuple[str, Callable[[], Sequence[TetrisTransition]]]] = [
+        ("v1 json", lambda: [TetrisTransition.from_orm(row) for row in jsonRows]),
+        ("validated", lambda: [TetrisTransition.fromTetrisDbRow(TetrisDataDbRow(*row)) for row in dbRows]),
+        ("trusted", lambda: [TetrisTransition.fromTetrisDbRow(TetrisDataDbRow(*row), trusted=True) for row in dbRows]),
+    ]
+
+    print(f"{'decoder':>10} {'rows/s':>12} {'vs v1 json':>11}")
+    baseline = None
+    for name, decode in decoders:
+        seconds, decoded = timeDecode(decode, args.repeats)
+        # Boards are arrays, so compare the transitions by their rows
+        if [transition.toTetrisDbRow() for transition in decoded] != dbRows:
+            raise RuntimeError(f"{name} decoding does not round trip")
+        rate = args.num_rows / seconds
+        baseline = rate if baseline is None else baseline
+        print(f"{name:>10} {rate:>12,.0f} {rate / baseline:>10.1f}x")
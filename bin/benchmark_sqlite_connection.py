@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sqlite3
+import tempfile
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+from typing import Callable, ContextManager, Iterator
+
+from rl_infra.types.offline import SqliteConnection, closeSqliteConnections
+
+CursorFactory = Callable[[str], ContextManager[sqlite3.Cursor]]
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.WARNING)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Compare the per-call overhead of opening, committing and closing a connection for every query
+        against the pooled SqliteConnection."""
+    )
+    parser.add_argument("--num-calls", type=int, default=1000, help="Number of calls to time per operation.")
+    parser.add_argument(
+        "--root-path",
+        type=str,
+        help="Directory to build the benchmark databases in.  Defaults to a temporary directory.",
+    )
+
+    return parser
+
+
+@contextmanager
+def perCallConnection(dbPath: str) -> Iterator[sqlite3.Cursor]:
+    """The connection handling SqliteConnection had before pooling."""
+    connection = sqlite3.connect(dbPath)
+    try:
+        yield connection.cursor()
+    finally:
+        connection.commit()
+        connection.close()
+
+
+def createTable(dbPath: str, connect: CursorFactory) -> None:
+    with connect(dbPath) as cur:
+        cur.execute(
+            """CREATE TABLE metrics (
+                tag TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                episode_number INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY(tag, version, episode_number)
+            );"""
+        )
+        cur.executemany("INSERT INTO metrics VALUES ('model', 0, ?, ?);", ((i, i) for i in range(1000)))
+
+
+def select(dbPath: str, connect: CursorFactory, i: int) -> None:
+    with connect(dbPath) as cur:
+        cur.execute("SELECT * FROM metrics WHERE tag = 'model' AND version = 0 AND episode_number = ?;", (i % 1000,))
+
+
+def insert(dbPath: str, connect: CursorFactory, i: int) -> None:
+    with connect(dbPath) as cur:
+        cur.execute("INSERT INTO metrics VALUES ('model', 1, ?, ?);", (i, i))
+
+
+def publishMetrics(dbPath: str, connect: CursorFactory, i: int) -> None:
+    """A read followed by two writes, each in its own scope, like TetrisModelService.publishOnlineMetrics.  The pooled
+    version wraps them in one transaction, as publishOnlineMetrics now does."""
+    with connect(dbPath) if connect is SqliteConnection else nullcontext():
+        select(dbPath, connect, i)
+        insert(dbPath, connect, 2 * i)
+        insert(dbPath, connect, 2 * i + 1)
+
+
+def timeOperation(
+    dbPath: str, connect: CursorFactory, operation: Callable[[str, CursorFactory, int], None], numCalls: int
+) -> float:
+    start = perf_counter()
+    for i in range(numCalls):
+        operation(dbPath, connect, i)
+    return (perf_counter() - start) / numCalls
+
+
+def runBenchmark(rootPath: str, args: argparse.Namespace) -> None:
+    print(f"{'operation':>16} {'per-call (us)':>14} {'pooled (us)':>12} {'speedup':>8}")
+    for name, operation in [("select", select), ("insert", insert), ("publish metrics", publishMetrics)]:
+        timings = []
+        for connect in (perCallConnection, SqliteConnection):
+            dbPath = f"{rootPath}/{name.replace(' ', '_')}_{connect.__name__}.db"
+            createTable(dbPath, connect)
+            timings.append(timeOperation(dbPath, connect, operation, args.num_calls))
+            closeSqliteConnections(dbPath)
+        perCall, pooled = timings
+        print(f"{name:>16} {perCall * 1e6:>14.1f} {pooled * 1e6:>12.1f} {perCall / pooled:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    setupLogger()
+
+    if args.root_path is not None:
+        runBenchmark(args.root_path, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            runBenchmark(tmpDir, args)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from typing import Any, Sequence
+
+from rl_infra.impl.tetris.offline.tetris_data_schema import (
+    DATA_DB_HOT_QUERIES,
+    DATA_DB_VERSION,
+    createDataTables,
+    getDataDbVersion,
+)
+from rl_infra.impl.tetris.offline.tetris_model_service import MODEL_DB_HOT_QUERIES, createModelTables
+from rl_infra.types.offline import SqliteConnection, closeSqliteConnections, findFullScans
+
+Query = tuple[str, str, Sequence[Any]]
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.INFO)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="""Print the query plans of the hot data.db and model.db queries, and exit with status 1 if any of
+        them scans a whole table instead of using an index."""
+    )
+    parser.add_argument(
+        "--root-path",
+        type=str,
+        help="""Directory containing data.db and model.db to check.  Defaults to freshly created databases in a
+        temporary directory, which checks the schema itself.""",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Print the full plan of every query.")
+
+    return parser
+
+
+def checkDb(dbPath: str, queries: list[Query], verbose: bool) -> list[str]:
+    with SqliteConnection(dbPath) as cur:
+        if verbose:
+            for name, sql, params in queries:
+                print(f"{os.path.basename(dbPath)} {name}:")
+                for _, _, _, detail in cur.execute(f"EXPLAIN QUERY PLAN {sql}", tuple(params)).fetchall():
+                    print(f"    {detail}")
+        problems = findFullScans(cur, queries)
+    closeSqliteConnections(dbPath)
+    return [f"{os.path.basename(dbPath)} {problem}" for problem in problems]
+
+
+def createTables(rootPath: str) -> None:
+    with SqliteConnection(f"{rootPath}/data.db") as cur:
+        createDataTables(cur)
+    with SqliteConnection(f"{rootPath}/model.db") as cur:
+        createModelTables(cur)
+    closeSqliteConnections()
+
+
+def checkQueryPlans(rootPath: str, verbose: bool) -> list[str]:
+    dataDbPath, modelDbPath = f"{rootPath}/data.db", f"{rootPath}/model.db"
+    for dbPath in (dataDbPath, modelDbPath):
+        if not os.path.exists(dbPath):
+            raise FileNotFoundError(f"{dbPath} does not exist")
+    with SqliteConnection(dataDbPath) as cur:
+        version = getDataDbVersion(cur)
+    if version != DATA_DB_VERSION:
+        raise RuntimeError(
+            f"{dataDbPath} is at schema version {version}, expected {DATA_DB_VERSION}.  "
+            "Run bin/migrate_tetris_data.py first."
+        )
+    return checkDb(dataDbPath, DATA_DB_HOT_QUERIES, verbose) + checkDb(modelDbPath, MODEL_DB_HOT_QUERIES, verbose)
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    logger = setupLogger()
+
+    if args.root_path is not None:
+        problems = checkQueryPlans(args.root_path, args.verbose)
+    else:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            createTables(tmpDir)
+            problems = checkQueryPlans(tmpDir, args.verbose)
+
+    for problem in problems:
+        logger.error(f"Full scan in {problem}")
+    if problems:
+        sys.exit(1)
+    logger.info(f"No full scans in {len(DATA_DB_HOT_QUERIES) + len(MODEL_DB_HOT_QUERIES)} hot queries")
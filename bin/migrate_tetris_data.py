@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+
+from rl_infra.impl.tetris.offline.config import DB_ROOT_PATH
+from rl_infra.impl.tetris.offline.tetris_data_schema import DATA_DB_VERSION, migrateDataDb
+
+
+def setupLogger() -> logging.Logger:
+    logger = logging.getLogger("rl_infra")
+    logger.setLevel(logging.INFO)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logger.level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def getParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=f"Migrate a tetris data.db to schema version {DATA_DB_VERSION}.")
+    parser.add_argument(
+        "--root-path",
+        type=str,
+        default=DB_ROOT_PATH,
+        help=f"Directory containing data.db (default {DB_ROOT_PATH}).",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="Number of rows to convert per insert (default 1000)."
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    parser = getParser()
+    args = parser.parse_args()
+    logger = setupLogger()
+
+    logger.info(f"args = {args}")
+
+    dbPath = f"{args.root_path}/data.db"
+    if not os.path.exists(dbPath):
+        raise FileNotFoundError(f"{dbPath} does not exist")
+    sizeBefore = os.path.getsize(dbPath)
+    migrateDataDb(dbPath, chunkSize=args.chunk_size)
+    sizeAfter = os.path.getsize(dbPath)
+    logger.info(f"Migrated {dbPath}: {sizeBefore / 2**20:.1f}MiB -> {sizeAfter / 2**20:.1f}MiB")
@@ -2,12 +2,21 @@
 
 import argparse
 import logging
+from contextlib import ExitStack
 
 import torch
 
-from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService
+from rl_infra.impl.tetris.offline.dqn import EXECUTION_MODES
+from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService, TetrisEpisodeSink
 from rl_infra.impl.tetris.offline.tetris_model_service import TetrisModelService
-from rl_infra.impl.tetris.offline.tetris_training_service import TetrisTrainingService
+from rl_infra.impl.tetris.offline.tetris_ring_data_service import TetrisRingDataService
+from rl_infra.impl.tetris.offline.tetris_shard_data_service import TetrisShardDataService
+from rl_infra.impl.tetris.offline.tetris_training_service import (
+    BETA_ANNEALING_EPOCHS,
+    TARGET_UPDATE_INTERVAL,
+    TAU,
+    TetrisTrainingService,
+)
 from rl_infra.impl.tetris.online.tetris_agent import TetrisAgent
 from rl_infra.impl.tetris.online.tetris_environment import TetrisEnvironment
 from rl_infra.types.offline.model_service import ModelDbKey
@@ -50,9 +59,106 @@ def getParser() -> argparse.ArgumentParser:
         type=int,
         default=32,
         help="""Number of transitions per batch (default 32).  Transitions will be selected at random from recent
-        gameplay and distributed such that examples with positive, zero, and negative reward are roughly equal.""",
+        gameplay.  See --sampling for how they are distributed.""",
     )
     parser.add_argument("--num-batches", type=int, default=1, help="Number of batches per training epoch. (default 1)")
+    parser.add_argument(
+        "--tau",
+        type=float,
+        default=TAU,
+        help=f"""How far to move the target network towards the policy network on each update (default {TAU}).  1 copies
+        the policy network (a hard update).""",
+    )
+    parser.add_argument(
+        "--target-update-interval",
+        type=int,
+        default=TARGET_UPDATE_INTERVAL,
+        help=f"Number of batches between target network updates (default {TARGET_UPDATE_INTERVAL}).",
+    )
+    parser.add_argument(
+        "--num-validation-episodes",
+        type=int,
+        default=1,
+        help="Number of the newest validation episodes to validate each epoch on (default 1).",
+    )
+    parser.add_argument(
+        "--execution-mode",
+        choices=EXECUTION_MODES,
+        default="eager",
+        help="""How the agent and training run the model (default eager).  script runs it with TorchScript, compile with
+        torch.compile, and bf16 under CPU bfloat16 autocast.""",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=0,
+        help="""Keep the model and optimizer in memory across epochs, and save them every this many epochs and on exit
+        (default 0, i.e., load and save them on every epoch).""",
+    )
+    parser.add_argument(
+        "--stream-interval",
+        type=int,
+        default=0,
+        help="""Write gameplay to the data service every this many moves while the episode is played, instead of all at
+        once when it ends (default 0, i.e., at the end).  Streaming also stops keeping played episodes in memory.""",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="""Number of processes to train each batch with (default 1).  With more than 1, each samples and computes
+        gradients on a shard of the batch, and the gradients are all-reduced before every optimizer step.  CPU only, and
+        requires --data-backend sqlite.""",
+    )
+    parser.add_argument(
+        "--prefetch-batches",
+        type=int,
+        default=2,
+        help="""Number of batches to sample and collate on a background thread while training on the current one
+        (default 2).  0 disables prefetching.""",
+    )
+    parser.add_argument(
+        "--data-backend",
+        choices=["sqlite", "ring", "shards"],
+        default="sqlite",
+        help="""Replay buffer implementation (default sqlite).  sqlite samples directly from data.db.  ring keeps the
+        newest transitions in memory and periodically writes them through to data.db.  shards stores transitions in
+        memory-mapped .npy files next to data.db, for buffers larger than RAM.""",
+    )
+    parser.add_argument(
+        "--sampling",
+        choices=["stratified", "uniform"],
+        default="stratified",
+        help="""How batches are drawn (default stratified).  stratified distributes each batch such that examples with
+        positive, zero, and negative reward are roughly equal.  uniform draws every transition with equal probability.
+        """,
+    )
+    parser.add_argument(
+        "--prioritized",
+        action="store_true",
+        help="""Sample transitions in proportion to their last TD error (prioritized replay).  Requires --data-backend
+        ring.""",
+    )
+    parser.add_argument(
+        "--beta-annealing-epochs",
+        type=int,
+        default=BETA_ANNEALING_EPOCHS,
+        help=f"""With --prioritized, the number of epochs over which the correction of the importance sampling weights
+        for the bias of prioritized sampling is annealed to full (default {BETA_ANNEALING_EPOCHS}).""",
+    )
+    parser.add_argument(
+        "--incremental-vacuum",
+        action="store_true",
+        help="""Return the pages freed by evicting old examples from data.db to the file system right away, so that
+        the file shrinks instead of keeping them for reuse.""",
+    )
+    parser.add_argument(
+        "--record-timings",
+        action="store_true",
+        help="""Time each phase of every training epoch (sampling, decoding, collation, forward, backward, optimizer
+        step, target update, validation and checkpointing), log them, and record them in the training_timings table
+        of model.db.""",
+    )
     parser.add_argument(
         "--print",
         action="store_true",
@@ -65,22 +171,50 @@ def getParser() -> argparse.ArgumentParser:
 
 def deployAndLoadModel(modelDbKey: ModelDbKey) -> TetrisAgent:
     modelService.deployModel(modelDbKey)
-    return TetrisAgent(device=device)
+    return TetrisAgent(device=device, executionMode=args.execution_mode)
 
 
-def playEpisode(agent: TetrisAgent, env: TetrisEnvironment, logger: logging.Logger) -> TetrisEnvironment:
+def playEpisode(
+    agent: TetrisAgent, env: TetrisEnvironment, logger: logging.Logger, sink: TetrisEpisodeSink | None = None
+) -> TetrisEnvironment:
     gameIsOver = False
     while not gameIsOver:
         logger.debug(f"State: {env.currentState}")
         action = agent.chooseAction(env.currentState)
         logger.debug(f"Action: {action}")
         transition = env.step(action)
+        if sink is not None:
+            sink.append(transition)
         gameIsOver = transition.newState.isTerminal
         logger.debug(f"Terminal: {gameIsOver}")
 
     return env
 
 
+def getDataService(args: argparse.Namespace) -> TetrisDataService:
+    # Prioritized replay replaces the sampling distribution entirely
+    stratified = args.sampling == "stratified" and not args.prioritized
+    # Bound the zero and negative reward examples as they are pushed.  Positive rewards are rare, so all are kept.
+    autoEvictSigns = (0, -1)
+    if args.data_backend == "ring":
+        return TetrisRingDataService(
+            stratified=stratified,
+            prioritized=args.prioritized,
+            autoEvictSigns=autoEvictSigns,
+            incrementalVacuum=args.incremental_vacuum,
+        )
+    if args.prioritized:
+        raise ValueError("--prioritized requires --data-backend ring")
+    if args.data_backend == "shards":
+        # Shards are evicted by deleting files, and data.db only holds validation episodes, which are never evicted
+        if args.incremental_vacuum:
+            raise ValueError("--incremental-vacuum requires --data-backend sqlite or ring")
+        return TetrisShardDataService(stratified=stratified, autoEvictSigns=autoEvictSigns)
+    return TetrisDataService(
+        stratified=stratified, autoEvictSigns=autoEvictSigns, incrementalVacuum=args.incremental_vacuum
+    )
+
+
 def retrainModel(agent: TetrisAgent, args: argparse.Namespace, trainingService: TetrisTrainingService) -> TetrisAgent:
     trainingService.retrainAndPublish(
         modelDbKey=agent.dbKey,
@@ -88,8 +222,17 @@ def retrainModel(agent: TetrisAgent, args: argparse.Namespace, trainingService:
         batchSize=args.batch_size,
         numBatches=args.num_batches,
     )
-    agent = deployAndLoadModel(agent.dbKey)
-
+    if trainingService.lastPhaseStats:
+        # Sampling, decoding and collation run on the prefetching thread, overlapping the other phases
+        logger.info("Training phase timings:\n" + "\n".join(str(stats) for stats in trainingService.lastPhaseStats))
+    if trainingService.sessionKey is None:
+        return deployAndLoadModel(agent.dbKey)
+
+    # The trained weights are still in memory, and may not have been saved yet
+    modelEntry = modelService.getModelEntry(agent.dbKey)
+    if modelEntry is None or trainingService.policyModel is None:
+        raise RuntimeError("No model entry or policy model found after retraining.")
+    agent.updatePolicy(trainingService.policyModel, modelEntry.numEpochsTrained)
     return agent
 
 
@@ -102,9 +245,20 @@ if __name__ == "__main__":
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     logger.info(f"device = {device}")
-    dataService = TetrisDataService()
+    dataService = getDataService(args)
     modelService = TetrisModelService()
-    trainingService = TetrisTrainingService(device=device)
+    trainingService = TetrisTrainingService(
+        device=device,
+        dataService=dataService,
+        prefetchDepth=args.prefetch_batches,
+        tau=args.tau,
+        targetUpdateInterval=args.target_update_interval,
+        executionMode=args.execution_mode,
+        numValidationEpisodes=args.num_validation_episodes,
+        recordTimings=args.record_timings,
+        prioritized=args.prioritized,
+        betaAnnealingEpochs=args.beta_annealing_epochs,
+    )
 
     modelDbKey = (
         modelService.getLatestVersionKey(args.model_tag)
@@ -116,44 +270,60 @@ if __name__ == "__main__":
 
     logger.info(f"Deploying model {modelDbKey}.")
     agent = deployAndLoadModel(modelDbKey)
-    env = TetrisEnvironment(episodeNumber=agent.numEpisodesPlayed)
+    env = TetrisEnvironment(episodeNumber=agent.numEpisodesPlayed, recordMoves=args.stream_interval == 0)
     modelEntry = modelService.getModelEntry(modelDbKey)
     logger.info(f"Model entry retrieved: {modelEntry}.")
 
-    for _ in range(args.num_episodes):
-        if modelEntry is None:
-            raise RuntimeError("No model entry found.")
-        logger.info(
-            f"Epsilon: {agent.epsilon:.4f}\n"
-            f"Num epochs trained: {modelEntry.numEpochsTrained:.4f}\n"
-            f"Average episodes length: {modelEntry.avgEpisodeLength or 0:.4f}\n"
-            f"Recency weighted average loss: {modelEntry.recencyWeightedAvgLoss or 0:.4f}\n"
-            f"Recency weighted validation average max Q: {modelEntry.recencyWeightedAvgValidationQ or 0:.4f}\n"
-        )
-
-        env = playEpisode(agent, env, logger)
-        lastEpisode = env.currentEpisodeRecord
-        onlineMetrics = lastEpisode.computeOnlineMetrics()
-        env.startNewEpisode()
-        agent.startNewEpisode()
-
-        logger.info(
-            f"Episodes played: {agent.numEpisodesPlayed}\n"
-            f"Epochs trained: {agent.numEpochsTrained}\n"
-            f"Moves: {onlineMetrics.numMoves}\n"
-            f"Score: {onlineMetrics.score}\n"
-        )
-
-        logger.info("Saving episode")
-        dataService.pushEpisode(env.currentEpisodeRecord)
-
-        logger.info("Updating online metrics for model")
-        modelService.publishOnlineMetrics(modelDbKey, onlineMetrics)
-        modelEntry = modelService.getModelEntry(modelDbKey)
-
-        if args.retrain_interval != 0 and agent.numEpisodesPlayed % args.retrain_interval == 0:
-            logger.info("Retraining model")
-            agent = retrainModel(agent, args, logger, trainingService)
+    useSession = args.checkpoint_interval > 0 and args.retrain_interval != 0
+    with ExitStack() as stack:
+        if args.num_workers > 1 and args.retrain_interval != 0:
+            stack.enter_context(trainingService.dataParallel(args.num_workers))
+        if useSession:
+            stack.enter_context(trainingService.session(modelDbKey, args.checkpoint_interval))
+
+        for _ in range(args.num_episodes):
+            if modelEntry is None:
+                raise RuntimeError("No model entry found.")
+            logger.info(
+                f"Epsilon: {agent.epsilon:.4f}\n"
+                f"Num epochs trained: {modelEntry.numEpochsTrained:.4f}\n"
+                f"Average episodes length: {modelEntry.avgEpisodeLength or 0:.4f}\n"
+                f"Recency weighted average loss: {modelEntry.recencyWeightedAvgLoss or 0:.4f}\n"
+                f"Recency weighted validation average max Q: {modelEntry.recencyWeightedAvgValidationQ or 0:.4f}\n"
+            )
+
+            if args.stream_interval > 0:
+                episodeNumber = env.currentEpisodeRecord.episodeNumber
+                with dataService.openEpisodeSink(args.stream_interval) as sink:
+                    env = playEpisode(agent, env, logger, sink)
+                onlineMetrics = sink.computeOnlineMetrics(episodeNumber)
+            else:
+                env = playEpisode(agent, env, logger)
+                lastEpisode = env.currentEpisodeRecord
+                onlineMetrics = lastEpisode.computeOnlineMetrics()
+                logger.info("Saving episode")
+                dataService.pushEpisode(lastEpisode)
+            env.startNewEpisode()
+            agent.startNewEpisode()
+
+            logger.info(
+                f"Episodes played: {agent.numEpisodesPlayed}\n"
+                f"Epochs trained: {agent.numEpochsTrained}\n"
+                f"Moves: {onlineMetrics.numMoves}\n"
+                f"Score: {onlineMetrics.score}\n"
+            )
+
+            logger.info("Updating online metrics for model")
+            modelService.publishOnlineMetrics(modelDbKey, onlineMetrics)
+            modelEntry = modelService.getModelEntry(modelDbKey)
+
+            if args.retrain_interval != 0 and agent.numEpisodesPlayed % args.retrain_interval == 0:
+                logger.info("Retraining model")
+                agent = retrainModel(agent, args, trainingService)
+
+    if useSession:
+        logger.info(f"Deploying model {modelDbKey} with the weights saved at the end of the training session.")
+        modelService.deployModel(modelDbKey)
 
     logger.info("Deleting old training examples")
     dataService.keepNewRowsDeleteOld(sgn=0)
@@ -1,5 +1,6 @@
 DIST_PATH = "/distance"
 EXPLORE_PATH = "/explore"
+FRAME_MIMETYPE = "application/x-numpy-frame"  # See rl_infra.utils.encodeNpArrayFrame
 IMG_PATH = "/camera"
 LIGHT_COLOR_PATH = "/light_color"
 LOCAL_IP = "0.0.0.0"
@@ -6,7 +6,7 @@ from flask import Flask, jsonify, request
 from flask.wrappers import Response
 
 from rl_infra.impl.robot.edge import config
-from rl_infra.utils import compressNpArray
+from rl_infra.utils import compressNpArray, encodeNpArrayFrame
 
 
 class RobotService:
@@ -65,9 +65,8 @@ class RobotService:
         with picamera.array.PiRGBArray(self.camera) as output:
             self.camera.capture(output, "rgb")
             rgbArray = output.array
-        resp = compressNpArray(rgbArray)
-
-        return jsonify(resp)
+        # Raw bytes rather than base64 in JSON, since images are by far the largest responses
+        return Response(response=encodeNpArrayFrame(rgbArray), status=200, mimetype=config.FRAME_MIMETYPE)
 
     def sendDistanceReading(self):
         resp = str(self.distanceSensor.read_mm())
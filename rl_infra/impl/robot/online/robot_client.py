@@ -8,7 +8,7 @@ from PIL import Image
 
 from rl_infra.impl.robot.edge import config
 from rl_infra.types.base_types import NumpyArray, SerializableDataClass, SerializedNumpyArray
-from rl_infra.utils import uncompressNpArray
+from rl_infra.utils import decodeNpArrayFrame, uncompressNpArray
 
 
 class RobotSensorReading(SerializableDataClass):
@@ -53,8 +53,10 @@ class RobotClient:
         )
         if imgResponse.status_code != 200:
             raise requests.HTTPError("Failed to get image")
+        if imgResponse.headers.get("Content-Type") == config.FRAME_MIMETYPE:
+            return decodeNpArrayFrame(imgResponse.content)
 
-        # Construct and deconstruct to validate contents of imgResponse
+        # Older robot services send the image as JSON.  Construct and deconstruct to validate contents of imgResponse
         return uncompressNpArray(**asdict(SerializedNumpyArray(**imgResponse.json())))
 
     @staticmethod
@@ -1,4 +1,12 @@
+from .batch_collator import *
+from .batch_prefetcher import *
+from .data_parallel import *
 from .dqn import *
+from .phase_timer import *
+from .target_updater import *
+from .tensor_checkpoint import *
 from .tetris_data_service import *
 from .tetris_model_service import *
+from .tetris_ring_data_service import *
+from .tetris_shard_data_service import *
 from .tetris_training_service import *
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import logging
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from torch import Tensor
+
+from rl_infra.types.offline.data_service import TransitionBatch
+
+logger = logging.getLogger(__name__)
+
+
+class TetrisTrainingBatch(NamedTuple):
+    """A sampled batch of transitions, collated into tensors."""
+
+    states: Tensor
+    actions: Tensor
+    rewards: Tensor
+    nonFinalMask: Tensor
+    nonFinalNextStates: Tensor
+    # Only set for prioritized sampling
+    slots: NDArray[np.int64] | None = None
+    weights: Tensor | None = None
+
+    def to(self, device: torch.device) -> TetrisTrainingBatch:
+        # non_blocking only overlaps the copy with compute when the source is pinned, which collation does on CUDA.
+        return self._replace(
+            **{
+                name: value.to(device, non_blocking=True)
+                for name, value in self._asdict().items()
+                if isinstance(value, Tensor)
+            }
+        )
+
+
+class _CollateBuffers(NamedTuple):
+    """Numpy views of preallocated tensors, so that batches can be written into them with numpy's vectorized copies."""
+
+    states: NDArray[np.uint8]
+    actions: NDArray[np.int64]
+    rewards: NDArray[np.float32]
+    nonFinalMask: NDArray[np.bool_]
+    nextStates: NDArray[np.uint8]
+    weights: NDArray[np.float32]
+
+
+class BatchCollator:
+    """Turns TransitionBatches into TetrisTrainingBatches.
+
+    Without pinMemory, the tensors share memory with the batch's arrays, apart from the non-final next states, which
+    are gathered in one vectorized copy.  With pinMemory, every column is copied once into a set of pinned buffers
+    allocated on first use, so that the copies to the GPU can be asynchronous without pinning fresh memory per batch.
+    The buffers are reused round robin, so a collated batch is only valid until numBuffers more batches have been
+    collated.  When collating ahead of training with a BatchPrefetcher, numBuffers must be at least its depth + 2:
+    one batch being collated, depth batches queued and one being trained on."""
+
+    pinMemory: bool
+    numBuffers: int
+
+    def __init__(self, pinMemory: bool = False, numBuffers: int = 2) -> None:
+        if numBuffers <= 0:
+            raise ValueError("numBuffers must be positive")
+        self.pinMemory = pinMemory
+        self.numBuffers = numBuffers
+        self._buffers: list[_CollateBuffers] = []
+        self._nextBuffer = 0
+
+    def __call__(
+        self, batch: TransitionBatch, slots: NDArray[np.int64] | None = None, weights: NDArray[np.float32] | None = None
+    ) -> TetrisTrainingBatch:
+        if not self.pinMemory:
+            return TetrisTrainingBatch(
+                states=torch.from_numpy(batch.states),
+                actions=torch.from_numpy(batch.actions),
+                rewards=torch.from_numpy(batch.rewards),
+                nonFinalMask=torch.from_numpy(batch.nonFinalMask),
+                nonFinalNextStates=torch.from_numpy(np.compress(batch.nonFinalMask, batch.nextStates, axis=0)),
+                slots=slots,
+                weights=None if weights is None else torch.from_numpy(weights),
+            )
+
+        buffers = self._getBuffers(batch)
+        batchSize = len(batch.actions)
+        numNonFinal = int(np.count_nonzero(batch.nonFinalMask))
+        np.copyto(buffers.states[:batchSize], batch.states)
+        np.copyto(buffers.actions[:batchSize], batch.actions)
+        np.copyto(buffers.rewards[:batchSize], batch.rewards)
+        np.copyto(buffers.nonFinalMask[:batchSize], batch.nonFinalMask)
+        np.compress(batch.nonFinalMask, batch.nextStates, axis=0, out=buffers.nextStates[:numNonFinal])
+        if weights is not None:
+            np.copyto(buffers.weights[:batchSize], weights)
+        # from_numpy on a view of a pinned tensor shares its memory, so the results stay pinned
+        return TetrisTrainingBatch(
+            states=torch.from_numpy(buffers.states[:batchSize]),
+            actions=torch.from_numpy(buffers.actions[:batchSize]),
+            rewards=torch.from_numpy(buffers.rewards[:batchSize]),
+            nonFinalMask=torch.from_numpy(buffers.nonFinalMask[:batchSize]),
+            nonFinalNextStates=torch.from_numpy(buffers.nextStates[:numNonFinal]),
+            slots=slots,
+            weights=None if weights is None else torch.from_numpy(buffers.weights[:batchSize]),
+        )
+
+    def _getBuffers(self, batch: TransitionBatch) -> _CollateBuffers:
+        """Returns the next buffers in the rotation, reallocating them all if batch does not fit."""
+        batchSize = len(batch.actions)
+        if not self._buffers or len(self._buffers[0].actions) < batchSize:
+            logger.debug(f"Allocating {self.numBuffers} pinned collate buffers for batches of {batchSize}")
+            self._buffers = [self._allocate(batch) for _ in range(self.numBuffers)]
+            self._nextBuffer = 0
+        elif self._buffers[0].states.shape[1:] != batch.states.shape[1:]:
+            raise ValueError(f"Expected states of shape (...,) + {self._buffers[0].states.shape[1:]}")
+        buffers = self._buffers[self._nextBuffer]
+        self._nextBuffer = (self._nextBuffer + 1) % self.numBuffers
+        return buffers
+
+    @staticmethod
+    def _allocate(batch: TransitionBatch) -> _CollateBuffers:
+        def empty(like: NDArray[np.generic]) -> NDArray[np.generic]:
+            dtype = torch.from_numpy(np.empty(0, dtype=like.dtype)).dtype
+            return torch.empty((len(batch.actions),) + like.shape[1:], dtype=dtype, pin_memory=True).numpy()
+
+        return _CollateBuffers(
+            states=empty(batch.states),
+            actions=empty(batch.actions),
+            rewards=empty(batch.rewards),
+            nonFinalMask=empty(batch.nonFinalMask),
+            nextStates=empty(batch.nextStates),
+            weights=empty(np.empty(0, dtype=np.float32)),
+        )
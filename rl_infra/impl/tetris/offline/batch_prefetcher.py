@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from contextlib import AbstractContextManager
+from time import perf_counter
+from types import TracebackType
+from typing import Callable, Generic, Iterator, NamedTuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PrefetchStats(NamedTuple):
+    numBatches: int
+    numStarved: int  # Batches that were not ready when the consumer asked for them
+    waitSeconds: float  # Total time the consumer spent waiting for batches
+
+    def __str__(self) -> str:
+        return (
+            f"{self.numStarved}/{self.numBatches} batches starved, {self.waitSeconds * 1000:.1f}ms waiting "
+            f"({self.waitSeconds * 1000 / max(self.numBatches, 1):.2f}ms per batch)"
+        )
+
+
+class _ProducerError(NamedTuple):
+    error: BaseException
+
+
+class BatchPrefetcher(AbstractContextManager["BatchPrefetcher[T]"], Generic[T]):
+    """Calls `produce` numBatches times on a background thread, keeping up to `depth` results in a bounded queue, so
+    that producing the next batches overlaps with consuming the current one.  Iterating yields the results in order,
+    and re-raises any exception raised by `produce`.  With depth=0, batches are produced inline on iteration instead.
+
+    Use as a context manager, so that the thread is stopped even if the consumer stops early."""
+
+    produce: Callable[[], T]
+    numBatches: int
+    depth: int
+    numConsumed: int
+    numStarved: int
+    waitSeconds: float
+
+    def __init__(self, produce: Callable[[], T], numBatches: int, depth: int = 2) -> None:
+        if depth < 0:
+            raise ValueError("depth must be non-negative")
+        self.produce = produce
+        self.numBatches = numBatches
+        self.depth = depth
+        self.numConsumed = 0
+        self.numStarved = 0
+        self.waitSeconds = 0.0
+        self._queue: queue.Queue[T | _ProducerError] = queue.Queue(maxsize=max(depth, 1))
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._run, name="BatchPrefetcher", daemon=True)
+            self._thread.start()
+
+    @property
+    def stats(self) -> PrefetchStats:
+        return PrefetchStats(numBatches=self.numConsumed, numStarved=self.numStarved, waitSeconds=self.waitSeconds)
+
+    def __iter__(self) -> Iterator[T]:
+        while self.numConsumed < self.numBatches:
+            start = perf_counter()
+            if self._thread is None:
+                item: T | _ProducerError = self.produce()
+                self.numStarved += 1
+            else:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    self.numStarved += 1
+                    item = self._queue.get()
+            self.waitSeconds += perf_counter() - start
+            if isinstance(item, _ProducerError):
+                raise item.error
+            self.numConsumed += 1
+            yield item
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __exit__(
+        self,
+        __exc_type: type[BaseException] | None,
+        __exc_value: BaseException | None,
+        __traceback: TracebackType | None,
+    ) -> bool | None:
+        self.close()
+        return super().__exit__(__exc_type, __exc_value, __traceback)
+
+    def _run(self) -> None:
+        try:
+            for _ in range(self.numBatches):
+                if not self._put(self.produce()):
+                    return
+        except BaseException as e:
+            logger.debug(f"Batch producer failed: {e!r}")
+            self._put(_ProducerError(e))
+
+    def _put(self, item: T | _ProducerError) -> bool:
+        """Blocks until there is room in the queue, or until close() is called.  Returns whether item was queued."""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+from contextlib import AbstractContextManager
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from types import TracebackType
+from typing import Any, Callable, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import Tensor
+
+logger = logging.getLogger(__name__)
+
+# Called in each worker process with its rank, the world size, the queue of commands sent by rank 0 and the extra
+# arguments given to DataParallelGroup.  Must be a module level function, so that it can be pickled.
+WorkerFn = Callable[..., None]
+
+
+class DataParallelGroup(AbstractContextManager["DataParallelGroup"]):
+    """Starts numWorkers - 1 local worker processes which, together with this process as rank 0, form a
+    torch.distributed process group with the gloo backend.  Workers run runWorker, which is expected to loop over the
+    commands sent with send until it receives None.  Collectives such as allReduceSum are run by every rank, so rank 0
+    and the workers must agree on the work each command implies.
+
+    The CPU's threads are split evenly between the processes, so that they do not compete for cores.  Use as a
+    context manager, so that the workers are stopped even if training fails."""
+
+    numWorkers: int
+    processes: list[BaseProcess]
+    commandQueues: list[Queue[Any]]
+
+    def __init__(self, numWorkers: int, runWorker: WorkerFn, *workerArgs: Any) -> None:
+        if numWorkers < 2:
+            raise ValueError("numWorkers must be at least 2")
+        if dist.is_initialized():
+            raise RuntimeError("A torch.distributed process group is already initialized in this process")
+        self.numWorkers = numWorkers
+        self._initialNumThreads = torch.get_num_threads()
+        numThreads = max(1, self._initialNumThreads // numWorkers)
+        # The file store rendezvous needs no free port, only a file that does not exist yet
+        fd, self._storePath = tempfile.mkstemp(prefix="rl_infra_gloo_")
+        os.close(fd)
+        os.remove(self._storePath)
+        initMethod = f"file://{self._storePath}"
+
+        # Workers must not inherit rank 0's state (e.g. open sqlite connections), so they are spawned, not forked
+        context = mp.get_context("spawn")
+        self.commandQueues = [context.Queue() for _ in range(1, numWorkers)]
+        self.processes = [
+            context.Process(
+                target=_workerMain,
+                args=(rank, numWorkers, initMethod, numThreads, self.commandQueues[rank - 1], runWorker, workerArgs),
+                name=f"DataParallelWorker-{rank}",
+                daemon=True,
+            )
+            for rank in range(1, numWorkers)
+        ]
+        for process in self.processes:
+            process.start()
+        torch.set_num_threads(numThreads)
+        dist.init_process_group("gloo", init_method=initMethod, rank=0, world_size=numWorkers)
+        logger.info(f"Started data parallel group of {numWorkers} processes with {numThreads} threads each")
+
+    def send(self, command: Any) -> None:
+        """Sends command to every worker."""
+        for process in self.processes:
+            if not process.is_alive():
+                raise RuntimeError(f"{process.name} exited with code {process.exitcode}")
+        for commandQueue in self.commandQueues:
+            commandQueue.put(command)
+
+    def close(self) -> None:
+        if not self.processes:
+            return
+        for commandQueue in self.commandQueues:
+            commandQueue.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        dist.destroy_process_group()
+        torch.set_num_threads(self._initialNumThreads)
+        if os.path.exists(self._storePath):
+            os.remove(self._storePath)
+        logger.info("Stopped data parallel group")
+
+    def __exit__(
+        self,
+        __exc_type: type[BaseException] | None,
+        __exc_value: BaseException | None,
+        __traceback: TracebackType | None,
+    ) -> bool | None:
+        self.close()
+        return super().__exit__(__exc_type, __exc_value, __traceback)
+
+
+def shardSizes(batchSize: int, worldSize: int) -> list[int]:
+    """Splits batchSize into worldSize shards that differ in size by at most one, largest first."""
+    if batchSize < worldSize:
+        raise ValueError(f"batchSize {batchSize} cannot be split between {worldSize} processes")
+    return [batchSize // worldSize + (rank < batchSize % worldSize) for rank in range(worldSize)]
+
+
+def allReduceSum(tensors: Sequence[Tensor]) -> None:
+    """Replaces each tensor with its sum across all ranks, in a single collective over a flattened copy."""
+    flat = torch.cat([tensor.reshape(-1) for tensor in tensors])
+    dist.all_reduce(flat)
+    offset = 0
+    for tensor in tensors:
+        tensor.copy_(flat[offset : offset + tensor.numel()].view_as(tensor))
+        offset += tensor.numel()
+
+
+def broadcastTensors(tensors: Sequence[Tensor], src: int = 0) -> None:
+    """Replaces each tensor with its value on rank src, in one collective per dtype over a flattened copy.  Tensors
+    are broadcast in place rather than pickled through a queue, so that rank src's storages stay where they are."""
+    byDtype: dict[torch.dtype, list[Tensor]] = {}
+    for tensor in tensors:
+        byDtype.setdefault(tensor.dtype, []).append(tensor)
+    for dtypeTensors in byDtype.values():
+        flat = torch.cat([tensor.detach().reshape(-1) for tensor in dtypeTensors])
+        dist.broadcast(flat, src)
+        if dist.get_rank() == src:
+            continue
+        offset = 0
+        with torch.no_grad():
+            for tensor in dtypeTensors:
+                tensor.copy_(flat[offset : offset + tensor.numel()].view_as(tensor))
+                offset += tensor.numel()
+
+
+def _workerMain(
+    rank: int,
+    worldSize: int,
+    initMethod: str,
+    numThreads: int,
+    commandQueue: Queue[Any],
+    runWorker: WorkerFn,
+    workerArgs: tuple[Any, ...],
+) -> None:
+    torch.set_num_threads(numThreads)
+    dist.init_process_group("gloo", init_method=initMethod, rank=rank, world_size=worldSize)
+    try:
+        runWorker(rank, worldSize, commandQueue, *workerArgs)
+    finally:
+        dist.destroy_process_group()
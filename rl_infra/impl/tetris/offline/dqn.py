@@ -1,12 +1,19 @@
+from typing import Callable
+
 import torch
 import torch.nn as nn
 from torch import relu, sigmoid
 
+# eager runs the layers as written.  script runs them as a TorchScript module, and compile through torch.compile, which
+# compiles on the first call (and again for new input shapes).  bf16 runs them eagerly under CPU bfloat16 autocast.
+EXECUTION_MODES = ("eager", "script", "compile", "bf16")
+
 
 class DeepQNetwork(nn.Module):
     kernelSize: int
     stride: int
     device: torch.device
+    executionMode: str
 
     def __init__(
         self,
@@ -16,11 +23,17 @@ class DeepQNetwork(nn.Module):
         device: torch.device,
         kernelSize: int = 4,
         stride: int = 1,
+        executionMode: str = "eager",
     ) -> None:
         super(DeepQNetwork, self).__init__()
+        if executionMode not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode {executionMode}.  Expected one of {EXECUTION_MODES}")
+        if executionMode == "bf16" and device.type != "cpu":
+            raise ValueError("bf16 execution is only supported on CPU")
         self.kernelSize = kernelSize
         self.stride = stride
         self.device = device
+        self.executionMode = executionMode
 
         self.conv1 = nn.Conv2d(2, 4, kernel_size=kernelSize, stride=stride)
         self.conv2 = nn.Conv2d(4, 8, kernel_size=kernelSize, stride=stride)
@@ -30,17 +43,45 @@ class DeepQNetwork(nn.Module):
         self.linear1 = nn.Linear(convw * convh * 8, 32)
         self.linear2 = nn.Linear(32, numOutputs)
 
+        # A bound method rather than a module, so that it is not registered as a submodule and the state dict is the
+        # same in every mode.  The scripted and compiled versions share this module's parameters.
+        layers = _QValues(self.conv1, self.conv2, self.linear1, self.linear2)
+        self._qValues: Callable[[torch.Tensor], torch.Tensor]
+        if executionMode == "script":
+            self._qValues = torch.jit.script(layers).forward
+        elif executionMode == "compile":
+            self._qValues = torch.compile(layers.forward)
+        else:
+            self._qValues = layers.forward
+
     # Called with either one element to determine next action, or a batch
     # during optimization. Returns tensor([[left0exp,right0exp]...]).
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.float()
-        x = x.to(self.device)
-        x = relu(self.conv1(x))
-        x = relu(self.conv2(x))
-
-        return sigmoid(self.linear2(relu(self.linear1(x.view(x.size(0), -1)))))
+        # Move before casting, so that boards cross to the device as bytes.  Both are no-ops when already done.
+        x = x.to(self.device).float()
+        if self.executionMode == "bf16":
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                return self._qValues(x).float()
+        return self._qValues(x)
 
     def _conv2dSizeOut(self, size: int):
         # Number of Linear input connections depends on output of conv2d layers
         # and therefore the input image size, so compute it.
         return (size - (self.kernelSize - 1)) // self.stride
+
+
+class _QValues(nn.Module):
+    """The layers of a DeepQNetwork without its input handling, so that they can be scripted or compiled."""
+
+    def __init__(self, conv1: nn.Conv2d, conv2: nn.Conv2d, linear1: nn.Linear, linear2: nn.Linear) -> None:
+        super().__init__()
+        self.conv1 = conv1
+        self.conv2 = conv2
+        self.linear1 = linear1
+        self.linear2 = linear2
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = relu(self.conv1(x))
+        x = relu(self.conv2(x))
+
+        return sigmoid(self.linear2(relu(self.linear1(x.view(x.size(0), -1)))))
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import logging
+import threading
+from contextlib import AbstractContextManager, nullcontext
+from time import perf_counter
+from types import TracebackType
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+_NULL_CONTEXT: AbstractContextManager[None] = nullcontext()
+
+
+class PhaseStats(NamedTuple):
+    phase: str
+    count: int  # Number of times the phase ran
+    seconds: float  # Total wall time
+    numSamples: int  # Total transitions processed, for phases that process them
+
+    @property
+    def samplesPerSecond(self) -> float | None:
+        if self.numSamples == 0 or self.seconds == 0:
+            return None
+        return self.numSamples / self.seconds
+
+    def __str__(self) -> str:
+        rate = "" if self.samplesPerSecond is None else f", {self.samplesPerSecond:,.0f} samples/s"
+        return (
+            f"{self.phase}: {self.seconds * 1000:.1f}ms over {self.count} "
+            f"({self.seconds * 1000 / max(self.count, 1):.3f}ms each{rate})"
+        )
+
+
+class PhaseTimer:
+    """Accumulates the wall time, count and number of samples of named phases, e.g. the phases of a training epoch.
+    Phases may be timed from several threads.  A disabled timer's time() returns a shared no-op context manager, so
+    leaving the timing calls in place costs next to nothing."""
+
+    enabled: bool
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._totals: dict[str, list[float]] = {}  # Phase -> [count, seconds, numSamples], in first-timed order
+        self._lock = threading.Lock()
+
+    def time(self, phase: str, numSamples: int = 0) -> AbstractContextManager[None]:
+        """Times the body of a with statement as one run of phase, processing numSamples transitions."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _PhaseContext(self, phase, numSamples)
+
+    def add(self, phase: str, seconds: float, count: int = 1, numSamples: int = 0) -> None:
+        """Records time measured elsewhere."""
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = self._totals.setdefault(phase, [0, 0.0, 0])
+            totals[0] += count
+            totals[1] += seconds
+            totals[2] += numSamples
+
+    def stats(self) -> list[PhaseStats]:
+        with self._lock:
+            return [
+                PhaseStats(phase=phase, count=int(count), seconds=seconds, numSamples=int(numSamples))
+                for phase, (count, seconds, numSamples) in self._totals.items()
+            ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._totals = {}
+
+
+class _PhaseContext(AbstractContextManager[None]):
+    def __init__(self, timer: PhaseTimer, phase: str, numSamples: int) -> None:
+        self.timer = timer
+        self.phase = phase
+        self.numSamples = numSamples
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = perf_counter()
+
+    def __exit__(
+        self,
+        __exc_type: type[BaseException] | None,
+        __exc_value: BaseException | None,
+        __traceback: TracebackType | None,
+    ) -> None:
+        self.timer.add(self.phase, perf_counter() - self.start, numSamples=self.numSamples)
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import numpy as np
+from numpy.typing import ArrayLike, NDArray
+
+
+class SumTree:
+    """Binary tree over `capacity` non-negative priorities where every node holds the sum of its children.  Updates and
+    proportional draws touch one node per level, so both are O(log capacity) per element, and both are vectorized over
+    a batch of elements."""
+
+    capacity: int
+    numLeaves: int
+    depth: int
+    tree: NDArray[np.float64]
+
+    def __init__(self, capacity: int) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.depth = (capacity - 1).bit_length()
+        self.numLeaves = 1 << self.depth
+        # Node 1 is the root, the children of node k are 2k and 2k + 1, and leaf i is node numLeaves + i.
+        self.tree = np.zeros(2 * self.numLeaves, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    def get(self, indices: ArrayLike) -> NDArray[np.float64]:
+        return self.tree[np.asarray(indices) + self.numLeaves]
+
+    def update(self, indices: ArrayLike, priorities: ArrayLike) -> None:
+        nodes = np.asarray(indices, dtype=np.int64) + self.numLeaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values: ArrayLike) -> NDArray[np.int64]:
+        """Returns, for each value in [0, total), the index i such that
+        sum(priorities[:i]) <= value < sum(priorities[:i + 1])."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            leftSums = self.tree[2 * nodes]
+            # Never descend into an empty subtree, which rounding could otherwise do for values close to a boundary.
+            goRight = (values >= leftSums) & (self.tree[2 * nodes + 1] > 0)
+            values = np.where(goRight, values - leftSums, values)
+            nodes = 2 * nodes + goRight
+        return nodes - self.numLeaves
+
+    def sample(self, batchSize: int, rng: np.random.Generator) -> NDArray[np.int64]:
+        """Draws batchSize indices with probability proportional to their priority, one from each of batchSize equal
+        segments of the total, which lowers the variance of the batch composition."""
+        if self.total <= 0:
+            raise ValueError("Cannot sample from a tree with zero total priority")
+        bounds = np.linspace(0, self.total, batchSize + 1)
+        return self.find(rng.uniform(bounds[:-1], bounds[1:]))
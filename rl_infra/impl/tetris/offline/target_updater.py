@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import logging
+
+import torch
+from torch import Tensor, nn
+
+logger = logging.getLogger(__name__)
+
+
+class TargetUpdater:
+    """Moves a target network's weights towards a policy network's, in place, every `interval` calls to step.
+
+    With tau = 1 this is a hard update, copying the policy weights into the target.  Otherwise it is a soft update,
+    θ′ ← τ θ + (1 − τ) θ′, which is usually done with interval 1.  Both update the target's existing tensors with
+    fused foreach ops, so no parameter set is allocated per update."""
+
+    tau: float
+    interval: int
+    numSteps: int
+
+    def __init__(self, tau: float = 1.0, interval: int = 1) -> None:
+        if not 0 < tau <= 1:
+            raise ValueError("tau must be in (0, 1]")
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.tau = tau
+        self.interval = interval
+        self.numSteps = 0
+
+    def step(self, policyModel: nn.Module, targetModel: nn.Module) -> bool:
+        """Counts a training step, and updates targetModel if it is due.  Returns whether it was updated."""
+        self.numSteps += 1
+        if self.numSteps % self.interval != 0:
+            return False
+        self.update(policyModel, targetModel)
+        return True
+
+    @torch.no_grad()
+    def update(self, policyModel: nn.Module, targetModel: nn.Module) -> None:
+        """Updates targetModel now, regardless of interval."""
+        targets, sources = _pairTensors(policyModel, targetModel)
+        if self.tau == 1:
+            torch._foreach_copy_(targets, sources)
+            return
+        # Integer buffers (e.g. batch norm's step count) cannot be interpolated, so they are copied
+        lerpTargets, lerpSources, copyTargets, copySources = [], [], [], []
+        for target, source in zip(targets, sources):
+            if target.is_floating_point():
+                lerpTargets.append(target)
+                lerpSources.append(source)
+            else:
+                copyTargets.append(target)
+                copySources.append(source)
+        if lerpTargets:
+            torch._foreach_lerp_(lerpTargets, lerpSources, self.tau)
+        if copyTargets:
+            torch._foreach_copy_(copyTargets, copySources)
+
+
+def _pairTensors(policyModel: nn.Module, targetModel: nn.Module) -> tuple[list[Tensor], list[Tensor]]:
+    """Returns the target's parameters and buffers, and the policy's matching ones, in the same order."""
+    targets = list(targetModel.parameters()) + list(targetModel.buffers())
+    sources = list(policyModel.parameters()) + list(policyModel.buffers())
+    if len(targets) != len(sources) or any(t.shape != s.shape for t, s in zip(targets, sources)):
+        raise ValueError("Policy and target models must have the same architecture")
+    return targets, sources
@@ -0,0 +1,153 @@
+"""Single-file checkpoints of named sections (e.g. the policy and target state dicts and the optimizer state), which
+load without unpickling and without reading the sections that are not asked for.
+
+A checkpoint file is CHECKPOINT_MAGIC, the length of a JSON header as an 8 byte little-endian integer, the header, and
+then the raw bytes of every tensor, each starting at a multiple of ALIGNMENT.  The header maps each tensor's name to
+its dtype, shape and offset from the start of the tensor data, and holds the structure of each section (nested dicts,
+lists and plain values) with references to its tensors by name.
+
+Loading maps the file copy-on-write, so that tensors are views of the page cache which are only read from disk when
+touched, and writing to them leaves the file unchanged.  Files are written to a temporary file and renamed into place,
+so that readers see either the old or the new checkpoint, and a file mapped by a reader is never modified."""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+from typing import Any, Callable, NamedTuple
+
+import torch
+from torch import Tensor
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_MAGIC = b"RLCKPT01"
+ALIGNMENT = 64  # Of each tensor's offset, so that views of the mapped file can be reinterpreted as any dtype
+
+_HEADER_LENGTH = struct.Struct("<Q")
+
+
+class CheckpointTensor(NamedTuple):
+    dtype: str  # e.g. "float32", the name of the torch dtype
+    shape: list[int]
+    offset: int  # From the start of the tensor data
+    numBytes: int
+
+
+class CheckpointHeader(NamedTuple):
+    tensors: dict[str, CheckpointTensor]
+    sections: dict[str, Any]  # Encoded structure of each section
+    dataOffset: int  # Of the tensor data from the start of the file
+
+
+def saveCheckpoint(path: str, sections: dict[str, Any]) -> None:
+    """Atomically writes sections, each a (nested) dict or list of tensors and plain values such as a state dict, to
+    path.  Tensors are written from CPU memory, so tensors on other devices are copied to the CPU first."""
+    tensors: dict[str, Tensor] = {}
+    encodedSections = {name: _encode(section, name, tensors) for name, section in sections.items()}
+    tensorEntries = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        numBytes = tensor.numel() * tensor.element_size()
+        tensorEntries[name] = CheckpointTensor(
+            dtype=str(tensor.dtype).removeprefix("torch."), shape=list(tensor.shape), offset=offset, numBytes=numBytes
+        )
+        offset = _align(offset + numBytes)
+    header = json.dumps(
+        {
+            "byteorder": sys.byteorder,
+            "tensors": {name: entry._asdict() for name, entry in tensorEntries.items()},
+            "sections": encodedSections,
+        }
+    ).encode()
+    dataOffset = _align(len(CHECKPOINT_MAGIC) + _HEADER_LENGTH.size + len(header))
+
+    fd, tmpPath = tempfile.mkstemp(prefix=".checkpoint_", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(CHECKPOINT_MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for name, tensor in tensors.items():
+                f.seek(dataOffset + tensorEntries[name].offset)
+                # Viewing the bytes in place, rather than through numpy, also covers dtypes numpy lacks (bfloat16)
+                f.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+            f.truncate(dataOffset + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+    logger.debug(f"Saved {len(tensors)} tensors ({dataOffset + offset} bytes) in sections {list(sections)} to {path}")
+
+
+def readCheckpointHeader(path: str) -> CheckpointHeader:
+    with open(path, "rb") as f:
+        if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+            raise ValueError(f"{path} is not a checkpoint file")
+        (headerLength,) = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))
+        header = json.loads(f.read(headerLength))
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError(f"{path} was written on a {header['byteorder']} endian machine")
+    return CheckpointHeader(
+        tensors={name: CheckpointTensor(**entry) for name, entry in header["tensors"].items()},
+        sections=header["sections"],
+        dataOffset=_align(len(CHECKPOINT_MAGIC) + _HEADER_LENGTH.size + headerLength),
+    )
+
+
+def loadCheckpoint(path: str, *sectionNames: str, copy: bool = False) -> dict[str, Any]:
+    """Returns the named sections of the checkpoint at path (by default all of them), with their tensors as
+    copy-on-write views of the mapped file.  Only the pages of the tensors that are used are read.  With copy, the
+    tensors are read into memory of their own instead, for callers that keep them rather than copying from them."""
+    header = readCheckpointHeader(path)
+    for name in sectionNames:
+        if name not in header.sections:
+            raise KeyError(f"Checkpoint {path} has no section {name}.  It has {list(header.sections)}")
+    fileData = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+
+    def getTensor(name: str) -> Tensor:
+        entry = header.tensors[name]
+        start = header.dataOffset + entry.offset
+        tensor = fileData[start : start + entry.numBytes].view(getattr(torch, entry.dtype)).reshape(entry.shape)
+        return tensor.clone() if copy else tensor
+
+    return {name: _decode(header.sections[name], getTensor) for name in sectionNames or header.sections}
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode(value: Any, path: str, tensors: dict[str, Tensor]) -> Any:
+    """Encodes value as JSON, moving its tensors into tensors under names given by their path.  Dicts are encoded as
+    lists of items, so that keys which are not strings (such as the parameter indices of optimizer state) survive."""
+    if isinstance(value, Tensor):
+        tensors[path] = value.detach().cpu().contiguous()
+        return {"tensor": path}
+    if isinstance(value, dict):
+        return {"dict": [[key, _encode(item, f"{path}/{key}", tensors)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        kind = "list" if isinstance(value, list) else "tuple"
+        return {kind: [_encode(item, f"{path}/{i}", tensors) for i, item in enumerate(value)]}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    raise TypeError(f"Cannot save {path} of type {type(value).__name__} in a checkpoint")
+
+
+def _decode(encoded: dict[str, Any], getTensor: Callable[[str], Tensor]) -> Any:
+    ((kind, value),) = encoded.items()
+    if kind == "tensor":
+        return getTensor(value)
+    if kind == "dict":
+        return {key: _decode(item, getTensor) for key, item in value}
+    if kind == "list":
+        return [_decode(item, getTensor) for item in value]
+    if kind == "tuple":
+        return tuple(_decode(item, getTensor) for item in value)
+    return value
@@ -0,0 +1,80 @@
+"""Regression tests for the query plans of the hot data.db and model.db queries: each must use an index rather than scan
+a whole table, both on freshly created databases and on a data.db migrated from version 1.  See findFullScans, and
+bin/check_query_plans.py to print the plans."""
+
+from __future__ import annotations
+
+import random
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from rl_infra.impl.tetris.offline.tetris_data_schema import (
+    DATA_DB_HOT_QUERIES,
+    DATA_DB_VERSION,
+    createDataTables,
+    getDataDbVersion,
+    migrateDataDb,
+)
+from rl_infra.impl.tetris.offline.tetris_model_service import MODEL_DB_HOT_QUERIES, createModelTables
+from rl_infra.impl.tetris.online.tetris_environment import TetrisEnvironment
+from rl_infra.impl.tetris.online.tetris_transition import TetrisAction
+from rl_infra.types.offline import SqliteConnection, closeSqliteConnections, findFullScans
+
+
+@pytest.fixture(autouse=True)
+def closeConnections() -> Iterator[None]:
+    yield
+    closeSqliteConnections()
+
+
+def createV1DataDb(dbPath: str) -> None:
+    """Creates data.db as it was before schema versioning, holding one random episode as training and validation
+    data."""
+    env = TetrisEnvironment()
+    while not env.step(random.choice(list(TetrisAction))).newState.isTerminal:
+        pass
+    rows = [move.toDbRow() for move in env.currentEpisodeRecord.moves]
+    with SqliteConnection(dbPath) as cur:
+        cur.execute(
+            """CREATE TABLE data (
+                state TEXT NOT NULL,
+                action TEXT NOT NULL,
+                new_state TEXT NOT NULL,
+                reward REAL NOT NULL
+            );"""
+        )
+        cur.execute(
+            """CREATE TABLE validation_data (
+                episode_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                action TEXT NOT NULL,
+                new_state TEXT NOT NULL,
+                reward REAL NOT NULL
+            );"""
+        )
+        cur.executemany("INSERT INTO data VALUES (?, ?, ?, ?);", rows)
+        cur.executemany("INSERT INTO validation_data VALUES (0, ?, ?, ?, ?);", rows)
+
+
+def test_fresh_data_db_has_no_full_scans(tmp_path: Path) -> None:
+    with SqliteConnection(str(tmp_path / "data.db")) as cur:
+        createDataTables(cur)
+        assert findFullScans(cur, DATA_DB_HOT_QUERIES) == []
+
+
+def test_migrated_data_db_has_no_full_scans(tmp_path: Path) -> None:
+    dbPath = str(tmp_path / "data.db")
+    createV1DataDb(dbPath)
+    closeSqliteConnections(dbPath)
+    migrateDataDb(dbPath)
+    with SqliteConnection(dbPath) as cur:
+        assert getDataDbVersion(cur) == DATA_DB_VERSION
+        assert findFullScans(cur, DATA_DB_HOT_QUERIES) == []
+
+
+def test_model_db_has_no_full_scans(tmp_path: Path) -> None:
+    with SqliteConnection(str(tmp_path / "model.db")) as cur:
+        createModelTables(cur)
+        assert findFullScans(cur, MODEL_DB_HOT_QUERIES) == []
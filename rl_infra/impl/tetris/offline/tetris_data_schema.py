@@ -0,0 +1,445 @@
+"""Schema and migrations for the tetris replay database (data.db).  The schema version is kept in PRAGMA user_version.
+
+Version 1 stored every state as TetrisState.json(), i.e., a pydantic JSON document with a base64 encoded board.
+Version 2 stores boards as raw uint8 BLOBs and the remaining state fields as typed columns.  Version 3 stores each board
+frame of the replay data once, in the frames table (validation_data keeps the version 2 layout).  Version 4 partitions
+the slot index by reward sign.  Version 5 indexes data by reward sign, so that eviction can find the oldest rows of a
+sign without scanning the table.  Version 6 indexes validation_data by episode id.  Version 7 stores frames 2-bit packed
+(see tetris_board_codec), about a quarter of their raw size.
+
+Boards are stacks of the two most recent frames, and consecutive transitions of an episode share frames, so a run of
+transitions is stored as consecutive frame ids f, f+1, f+2, ...  A transition with frame_id = i has state.board = [frame
+i+1, frame i] and newState.board = [frame i+2, frame i+1]."""
+
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import sqlite3
+from typing import Any, Callable, Iterable
+
+import numpy as np
+from numpy.typing import NDArray
+
+from rl_infra.impl.tetris.online.tetris_board_codec import FRAME_SHAPE, PACKED_FRAME_SIZE, packFrames, unpackFrames
+from rl_infra.impl.tetris.online.tetris_transition import (
+    TetrisAction,
+    TetrisDataDbRow,
+    TetrisPiece,
+    TetrisTransition,
+)
+from rl_infra.types.offline import SqliteConnection
+from rl_infra.types.online.transition import DataDbRow
+
+logger = logging.getLogger(__name__)
+
+DATA_DB_VERSION = 7
+
+ACTIONS = list(sorted(TetrisAction))  # Same order as TetrisAgent.possibleActions
+ACTION_INDICES = {action.value: i for i, action in enumerate(ACTIONS)}
+PIECES = list(TetrisPiece)
+
+STATE_COLUMNS = ["board", "score", "active_piece", "next_piece", "is_terminal"]
+TRANSITION_COLUMNS = (
+    [f"state_{col}" for col in STATE_COLUMNS] + ["action"] + [f"new_state_{col}" for col in STATE_COLUMNS] + ["reward"]
+)
+DATA_COLUMNS = (
+    ["frame_id"]
+    + [f"state_{col}" for col in STATE_COLUMNS[1:]]
+    + ["action"]
+    + [f"new_state_{col}" for col in STATE_COLUMNS[1:]]
+    + ["reward"]
+)
+DATA_COLUMNS_DDL = """
+    frame_id INTEGER NOT NULL,
+    state_score INTEGER NOT NULL,
+    state_active_piece TEXT NOT NULL,
+    state_next_piece TEXT NOT NULL,
+    state_is_terminal INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    new_state_score INTEGER NOT NULL,
+    new_state_active_piece TEXT NOT NULL,
+    new_state_next_piece TEXT NOT NULL,
+    new_state_is_terminal INTEGER NOT NULL,
+    reward REAL NOT NULL"""
+TRANSITION_COLUMNS_DDL = """
+    state_board BLOB NOT NULL,
+    state_score INTEGER NOT NULL,
+    state_active_piece TEXT NOT NULL,
+    state_next_piece TEXT NOT NULL,
+    state_is_terminal INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    new_state_board BLOB NOT NULL,
+    new_state_score INTEGER NOT NULL,
+    new_state_active_piece TEXT NOT NULL,
+    new_state_next_piece TEXT NOT NULL,
+    new_state_is_terminal INTEGER NOT NULL,
+    reward REAL NOT NULL"""
+
+SLOT_COUNT_QUERY = "SELECT COALESCE(MAX(slot) + 1, 0) FROM data_slots WHERE sgn = ?;"
+EVICTION_QUERY = (
+    "DELETE FROM data WHERE rowid IN (SELECT rowid FROM data WHERE sign(reward) = ? ORDER BY rowid LIMIT ?);"
+)
+VALIDATION_MAX_EPISODE_ID_QUERY = "SELECT MAX(episode_id) FROM validation_data;"
+VALIDATION_PREVIOUS_EPISODE_ID_QUERY = "SELECT MAX(episode_id) FROM validation_data WHERE episode_id < ?;"
+VALIDATION_EPISODE_LENGTH_QUERY = "SELECT COUNT(*) FROM validation_data WHERE episode_id = ?;"
+VALIDATION_EPISODE_QUERY = f"SELECT {', '.join(TRANSITION_COLUMNS)} FROM validation_data WHERE episode_id = ?;"
+
+
+def rowsBySlotQuery(numSlots: int) -> str:
+    return f"""
+        SELECT s.slot, {", ".join(f"d.{col}" for col in DATA_COLUMNS)}
+        FROM data_slots AS s JOIN data AS d ON d.rowid = s.data_rowid
+        WHERE s.sgn = ? AND s.slot IN ({", ".join("?" * numSlots)});"""
+
+
+def framesByIdQuery(numFrames: int) -> str:
+    return f"SELECT frame_id, frame FROM frames WHERE frame_id IN ({', '.join('?' * numFrames)});"
+
+
+# The queries run per sample, push or eviction, with example parameters.  Trigger bodies cannot be explained, so their
+# lookups are listed as standalone statements.  See findFullScans and bin/check_query_plans.py.
+DATA_DB_HOT_QUERIES: list[tuple[str, str, tuple[Any, ...]]] = [
+    ("slot count", SLOT_COUNT_QUERY, (0,)),
+    ("rows by slot", rowsBySlotQuery(2), (0, 0, 1)),
+    ("frames by id", framesByIdQuery(2), (0, 1)),
+    ("next frame id", "SELECT COALESCE(MAX(frame_id) + 1, 0) FROM frames;", ()),
+    ("eviction", EVICTION_QUERY, (0, 1)),
+    ("validation max episode id", VALIDATION_MAX_EPISODE_ID_QUERY, ()),
+    ("validation previous episode id", VALIDATION_PREVIOUS_EPISODE_ID_QUERY, (1,)),
+    ("validation episode length", VALIDATION_EPISODE_LENGTH_QUERY, (0,)),
+    ("validation episode", VALIDATION_EPISODE_QUERY, (0,)),
+    ("slot insert trigger", "SELECT COALESCE(MAX(slot) + 1, 0) FROM data_slots WHERE sgn = sign(?);", (0.0,)),
+    (
+        "slot delete trigger (last slot)",
+        "SELECT data_rowid FROM data_slots WHERE sgn = sign(?) ORDER BY slot DESC LIMIT 1;",
+        (0.0,),
+    ),
+    (
+        "slot delete trigger (swap)",
+        "UPDATE data_slots SET data_rowid = ? WHERE sgn = sign(?) AND data_rowid = ?;",
+        (0, 0.0, 0),
+    ),
+    ("frames delete trigger", "SELECT 1 FROM data WHERE data.frame_id BETWEEN ? - 2 AND ?;", (0, 0)),
+]
+
+
+def getValidationCachePath(dbPath: str) -> str:
+    """Returns the directory of the .npy files caching the boards of the validation episodes of the database at
+    dbPath (see TetrisDataService.getValidationTensor)."""
+    return f"{os.path.dirname(dbPath)}/validation_cache"
+
+
+def clearValidationCache(dbPath: str) -> None:
+    """Deletes the cached validation boards of the database at dbPath, which must be done whenever episode ids may
+    come to refer to other episodes, e.g. when the database is created anew."""
+    cachePath = getValidationCachePath(dbPath)
+    if os.path.exists(cachePath):
+        logger.info(f"Clearing validation cache {cachePath}")
+        shutil.rmtree(cachePath)
+
+
+def getDataDbVersion(cur: sqlite3.Cursor) -> int:
+    """Returns the schema version of the database, 0 for an empty database."""
+    version = cur.execute("PRAGMA user_version;").fetchone()[0]
+    if version == 0 and _tableExists(cur, "data"):
+        # Version 1 predates schema versioning
+        return 1
+    return version
+
+
+def createDataTables(cur: sqlite3.Cursor) -> None:
+    """Creates the current version of the schema in an empty database."""
+    cur.execute(f"CREATE TABLE IF NOT EXISTS data ({DATA_COLUMNS_DDL});")
+    createSignIndex(cur)
+    createSlotIndex(cur)
+    createFrameTable(cur)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS validation_data (episode_id INTEGER NOT NULL, {TRANSITION_COLUMNS_DDL});")
+    createValidationIndex(cur)
+    cur.execute(f"PRAGMA user_version = {DATA_DB_VERSION};")
+
+
+def createSlotIndex(cur: sqlite3.Cursor) -> None:
+    """Maintains data_slots, which numbers the rows of data with each reward sign densely as 0..n_sgn-1, so that
+    sampling (uniform or stratified by sign) can draw slot numbers instead of sorting the table.  Deletes fill the hole
+    with the last slot of the same sign (swap-remove), so the slots stay dense no matter which rows are evicted."""
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS data_slots (
+            sgn INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            data_rowid INTEGER NOT NULL,
+            PRIMARY KEY(sgn, slot)
+        ) WITHOUT ROWID;"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS data_slots_data_rowid ON data_slots (data_rowid);")
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS data_slots_insert AFTER INSERT ON data
+        BEGIN
+            INSERT INTO data_slots (sgn, slot, data_rowid)
+            VALUES (
+                sign(new.reward),
+                (SELECT COALESCE(MAX(slot) + 1, 0) FROM data_slots WHERE sgn = sign(new.reward)),
+                new.rowid
+            );
+        END;"""
+    )
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS data_slots_delete AFTER DELETE ON data
+        BEGIN
+            UPDATE data_slots
+            SET data_rowid = (
+                SELECT data_rowid FROM data_slots WHERE sgn = sign(old.reward) ORDER BY slot DESC LIMIT 1
+            )
+            WHERE sgn = sign(old.reward) AND data_rowid = old.rowid;
+            DELETE FROM data_slots
+            WHERE sgn = sign(old.reward) AND slot = (SELECT MAX(slot) FROM data_slots WHERE sgn = sign(old.reward));
+        END;"""
+    )
+    # Backfill for tables created before the slot index existed.
+    if cur.execute("SELECT 1 FROM data_slots LIMIT 1;").fetchone() is None:
+        cur.execute(
+            """INSERT INTO data_slots (sgn, slot, data_rowid)
+            SELECT sign(reward), ROW_NUMBER() OVER (PARTITION BY sign(reward) ORDER BY rowid) - 1, rowid FROM data;"""
+        )
+
+
+def createSignIndex(cur: sqlite3.Cursor) -> None:
+    # Index entries end with the rowid, so this also serves "WHERE sign(reward) = ? ORDER BY rowid LIMIT ?".
+    cur.execute("CREATE INDEX IF NOT EXISTS data_sign ON data (sign(reward));")
+
+
+def createValidationIndex(cur: sqlite3.Cursor) -> None:
+    # Also covers MAX(episode_id)
+    cur.execute("CREATE INDEX IF NOT EXISTS validation_data_episode_id ON validation_data (episode_id);")
+
+
+def setIncrementalAutoVacuum(dbPath: str) -> None:
+    """Switches the database to incremental auto-vacuum, so that PRAGMA incremental_vacuum can return the pages freed
+    by deletes to the file system.  This rebuilds the file, which is only cheap while the database is small."""
+    with SqliteConnection(dbPath, transaction=False) as cur:
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        cur.execute("VACUUM;")
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+
+def createFrameTable(cur: sqlite3.Cursor) -> None:
+    """Creates the frames table, along with a trigger dropping frames once no transition of data references them."""
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS frames (
+            frame_id INTEGER PRIMARY KEY,
+            frame BLOB NOT NULL
+        );"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS data_frame_id ON data (frame_id);")
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS data_frames_delete AFTER DELETE ON data
+        BEGIN
+            DELETE FROM frames
+            WHERE frame_id BETWEEN old.frame_id AND old.frame_id + 2
+            AND NOT EXISTS (
+                SELECT 1 FROM data WHERE data.frame_id BETWEEN frames.frame_id - 2 AND frames.frame_id
+            );
+        END;"""
+    )
+
+
+class FrameRunWriter:
+    """Splits consecutive transitions into runs of shared frames.  Each run starts with the two frames of its first
+    state and adds one frame per transition, so an episode of n moves takes n + 2 frames instead of 4n."""
+
+    nextFrameId: int
+    previousBoard: bytes | None
+
+    def __init__(self, firstFrameId: int) -> None:
+        self.nextFrameId = firstFrameId
+        self.previousBoard = None
+
+    def split(self, rows: Iterable[TetrisDataDbRow]) -> tuple[list[tuple[int, bytes]], list[tuple[Any, ...]]]:
+        """Returns the (frame_id, frame) rows and the data rows (in DATA_COLUMNS order) for the given transitions."""
+        frames: list[bytes] = []
+        dataRows: list[tuple[Any, ...]] = []
+        for row in rows:
+            frameSize = len(row.stateBoard) // 2
+            newest, oldest = row.stateBoard[:frameSize], row.stateBoard[frameSize:]
+            if row.newStateBoard[frameSize:] != newest:
+                raise ValueError("newState.board does not continue the frame stack of state.board")
+            if row.stateBoard != self.previousBoard:
+                frames += [oldest, newest]
+            frames.append(row.newStateBoard[:frameSize])
+            self.previousBoard = row.newStateBoard
+            dataRows.append((self.nextFrameId + len(frames) - 3,) + row[1:6] + row[7:12])
+        frameRows = list(enumerate(frames, start=self.nextFrameId))
+        self.nextFrameId += len(frames)
+        return frameRows, dataRows
+
+
+def packFrameRows(frameRows: list[tuple[int, bytes]]) -> list[tuple[int, bytes]]:
+    """Packs (frame_id, frame) rows of raw frames into the format of the frames table."""
+    if len(frameRows) == 0:
+        return []
+    frames = np.frombuffer(b"".join(frame for _, frame in frameRows), dtype=np.uint8).reshape((-1,) + FRAME_SHAPE)
+    return [(frameId, frame.tobytes()) for (frameId, _), frame in zip(frameRows, packFrames(frames))]
+
+
+def unpackFrameArray(frames: Iterable[bytes]) -> NDArray[np.uint8]:
+    """Unpacks frames as stored in the frames table into an array of shape (n,) + FRAME_SHAPE."""
+    return unpackFrames(np.frombuffer(b"".join(frames), dtype=np.uint8).reshape(-1, PACKED_FRAME_SIZE))
+
+
+def joinFrames(row: tuple[Any, ...], frames: dict[int, bytes]) -> TetrisDataDbRow:
+    """Inverse of FrameRunWriter.split for a single data row (in DATA_COLUMNS order), given raw (unpacked) frames."""
+    frameId = row[0]
+    return TetrisDataDbRow(
+        frames[frameId + 1] + frames[frameId],
+        *row[1:6],
+        frames[frameId + 2] + frames[frameId + 1],
+        *row[6:11],
+    )
+
+
+def stackFrames(rows: list[tuple[Any, ...]], frames: dict[int, bytes]) -> tuple[NDArray[np.uint8], NDArray[np.uint8]]:
+    """Columnar counterpart of joinFrames, given frames as stored in the frames table.  Returns the state and new state
+    boards of the data rows (in DATA_COLUMNS order) as two arrays of shape (len(rows),) + BOARD_SHAPE."""
+    frameIds = sorted(frames)
+    frameArray = unpackFrameArray(frames[i] for i in frameIds)
+    # frames holds all three frames of every row, so frames frame_id + 1 and frame_id + 2 directly follow frame_id
+    idx = np.searchsorted(frameIds, [row[0] for row in rows])
+    states = np.stack([frameArray[idx + 1], frameArray[idx]], axis=1)
+    newStates = np.stack([frameArray[idx + 2], frameArray[idx + 1]], axis=1)
+    return states, newStates
+
+
+def insertFrameRuns(
+    cur: sqlite3.Cursor, rows: Iterable[TetrisDataDbRow], writer: FrameRunWriter | None = None
+) -> FrameRunWriter:
+    """Appends the given consecutive transitions to data as frame runs, and returns the writer used.  Passing it back
+    for the next transitions of the same episode continues its run, so that an episode pushed in several calls shares
+    frames across them.  The run is only continued while its last frame is still the newest in frames, which means
+    the transition referencing it (and so the frames the next transition shares) was not evicted since."""
+    nextFrameId = cur.execute("SELECT COALESCE(MAX(frame_id) + 1, 0) FROM frames;").fetchone()[0]
+    if writer is None or writer.nextFrameId != nextFrameId:
+        writer = FrameRunWriter(nextFrameId)
+    frameRows, dataRows = writer.split(rows)
+    cur.executemany("INSERT INTO frames (frame_id, frame) VALUES (?, ?);", packFrameRows(frameRows))
+    cur.executemany(
+        f"INSERT INTO data ({', '.join(DATA_COLUMNS)}) VALUES ({', '.join('?' * len(DATA_COLUMNS))});", dataRows
+    )
+    return writer
+
+
+def migrateDataDb(dbPath: str, chunkSize: int = 1000) -> None:
+    """Migrates the database at dbPath to DATA_DB_VERSION one version at a time, then reclaims freed pages and switches
+    to incremental auto-vacuum."""
+    with SqliteConnection(dbPath) as cur:
+        version = getDataDbVersion(cur)
+    if version == 0:
+        raise KeyError(f"No tetris data found in {dbPath}")
+    if version > DATA_DB_VERSION:
+        raise RuntimeError(f"{dbPath} has schema version {version}, newer than supported version {DATA_DB_VERSION}")
+    if version < DATA_DB_VERSION:
+        clearValidationCache(dbPath)
+    while version < DATA_DB_VERSION:
+        logger.info(f"Migrating {dbPath} from schema version {version} to {version + 1}")
+        with SqliteConnection(dbPath) as cur:
+            MIGRATIONS[version](cur, chunkSize)
+            cur.execute(f"PRAGMA user_version = {version + 1};")
+        version += 1
+    setIncrementalAutoVacuum(dbPath)
+
+
+def _migrateV1ToV2(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    # Leftovers of an interrupted migration.  The old tables are only dropped at the very end.
+    cur.execute("DROP TABLE IF EXISTS data_v2;")
+    cur.execute("DROP TABLE IF EXISTS validation_data_v2;")
+    cur.execute(f"CREATE TABLE data_v2 ({TRANSITION_COLUMNS_DDL});")
+    cur.execute(f"CREATE TABLE validation_data_v2 (episode_id INTEGER NOT NULL, {TRANSITION_COLUMNS_DDL});")
+    placeholders = ", ".join("?" * len(TRANSITION_COLUMNS))
+    insertData = f"INSERT INTO data_v2 ({', '.join(TRANSITION_COLUMNS)}) VALUES ({placeholders});"
+    insertValidation = (
+        f"INSERT INTO validation_data_v2 (episode_id, {', '.join(TRANSITION_COLUMNS)}) VALUES (?, {placeholders});"
+    )
+
+    # Use a second cursor for reading so that inserts do not reset the one being iterated over.
+    reader = cur.connection.cursor()
+    reader.execute("SELECT state, action, new_state, reward FROM data ORDER BY rowid;")
+    while rows := reader.fetchmany(chunkSize):
+        cur.executemany(insertData, [TetrisTransition.from_orm(DataDbRow(*row)).toTetrisDbRow() for row in rows])
+    reader.execute("SELECT episode_id, state, action, new_state, reward FROM validation_data ORDER BY rowid;")
+    while rows := reader.fetchmany(chunkSize):
+        cur.executemany(
+            insertValidation,
+            [(row[0],) + TetrisTransition.from_orm(DataDbRow(*row[1:])).toTetrisDbRow() for row in rows],
+        )
+
+    # Dropping data also drops the triggers maintaining data_slots, which are rebuilt on the new table.
+    cur.execute("DROP TABLE data;")
+    cur.execute("DROP TABLE IF EXISTS data_slots;")
+    cur.execute("DROP TABLE validation_data;")
+    cur.execute("ALTER TABLE data_v2 RENAME TO data;")
+    cur.execute("ALTER TABLE validation_data_v2 RENAME TO validation_data;")
+    createSlotIndex(cur)
+
+
+def _migrateV2ToV3(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    cur.execute("DROP TABLE IF EXISTS data_v3;")
+    cur.execute("DROP TABLE IF EXISTS frames;")
+    cur.execute(f"CREATE TABLE data_v3 ({DATA_COLUMNS_DDL});")
+    cur.execute("CREATE TABLE frames (frame_id INTEGER PRIMARY KEY, frame BLOB NOT NULL);")
+    insertData = f"INSERT INTO data_v3 ({', '.join(DATA_COLUMNS)}) VALUES ({', '.join('?' * len(DATA_COLUMNS))});"
+
+    # Rows were pushed an episode at a time, so consecutive rowids continue each other's frame runs.
+    writer = FrameRunWriter(0)
+    reader = cur.connection.cursor()
+    reader.execute(f"SELECT {', '.join(TRANSITION_COLUMNS)} FROM data ORDER BY rowid;")
+    while rows := reader.fetchmany(chunkSize):
+        frameRows, dataRows = writer.split(TetrisDataDbRow(*row) for row in rows)
+        cur.executemany("INSERT INTO frames (frame_id, frame) VALUES (?, ?);", frameRows)
+        cur.executemany(insertData, dataRows)
+
+    cur.execute("DROP TABLE data;")
+    cur.execute("DROP TABLE IF EXISTS data_slots;")
+    cur.execute("ALTER TABLE data_v3 RENAME TO data;")
+    createSlotIndex(cur)
+    createFrameTable(cur)
+
+
+def _migrateV3ToV4(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    cur.execute("DROP TRIGGER IF EXISTS data_slots_insert;")
+    cur.execute("DROP TRIGGER IF EXISTS data_slots_delete;")
+    cur.execute("DROP TABLE IF EXISTS data_slots;")
+    createSlotIndex(cur)
+
+
+def _migrateV4ToV5(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    createSignIndex(cur)
+
+
+def _migrateV5ToV6(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    createValidationIndex(cur)
+
+
+def _migrateV6ToV7(cur: sqlite3.Cursor, chunkSize: int) -> None:
+    lastFrameId = -1
+    while rows := cur.execute(
+        "SELECT frame_id, frame FROM frames WHERE frame_id > ? ORDER BY frame_id LIMIT ?;", (lastFrameId, chunkSize)
+    ).fetchall():
+        cur.executemany(
+            "UPDATE frames SET frame = ? WHERE frame_id = ?;",
+            [(frame, frameId) for frameId, frame in packFrameRows(rows)],
+        )
+        lastFrameId = rows[-1][0]
+
+
+def _tableExists(cur: sqlite3.Cursor, name: str) -> bool:
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)).fetchone() is not None
+
+
+MIGRATIONS: dict[int, Callable[[sqlite3.Cursor, int], None]] = {
+    1: _migrateV1ToV2,
+    2: _migrateV2ToV3,
+    3: _migrateV3ToV4,
+    4: _migrateV4ToV5,
+    5: _migrateV5ToV6,
+    6: _migrateV6ToV7,
+}
@@ -1,49 +1,108 @@
 from __future__ import annotations
 
 import logging
+import os
 import random
-from math import ceil
-from typing import Sequence
+import sqlite3
+from contextlib import AbstractContextManager
+from types import TracebackType
+from typing import Any, Sequence
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from torch import Tensor
 
 from rl_infra.impl.tetris.offline.config import DB_ROOT_PATH
+from rl_infra.impl.tetris.offline.phase_timer import PhaseTimer
+from rl_infra.impl.tetris.offline.tetris_data_schema import (
+    ACTION_INDICES,
+    DATA_COLUMNS,
+    DATA_DB_VERSION,
+    EVICTION_QUERY,
+    SLOT_COUNT_QUERY,
+    TRANSITION_COLUMNS,
+    VALIDATION_EPISODE_LENGTH_QUERY,
+    VALIDATION_EPISODE_QUERY,
+    VALIDATION_MAX_EPISODE_ID_QUERY,
+    VALIDATION_PREVIOUS_EPISODE_ID_QUERY,
+    FrameRunWriter,
+    clearValidationCache,
+    createDataTables,
+    framesByIdQuery,
+    getDataDbVersion,
+    getValidationCachePath,
+    insertFrameRuns,
+    joinFrames,
+    rowsBySlotQuery,
+    setIncrementalAutoVacuum,
+    stackFrames,
+    unpackFrameArray,
+)
 from rl_infra.impl.tetris.online.tetris_environment import (
     TetrisEpisodeRecord,
     TetrisGameplayRecord,
     TetrisOnlineMetrics,
 )
-from rl_infra.impl.tetris.online.tetris_transition import TetrisAction, TetrisState, TetrisTransition
-from rl_infra.types.offline import DataService, SqliteConnection
+from rl_infra.impl.tetris.online.tetris_transition import (
+    TetrisAction,
+    TetrisDataDbRow,
+    TetrisState,
+    TetrisTransition,
+)
+from rl_infra.types.offline import DataService, SqliteConnection, TransitionBatch
 from rl_infra.types.online.environment import EpisodeRecord
-from rl_infra.types.online.transition import DataDbRow, Transition
+from rl_infra.types.online.transition import Transition
 
 logger = logging.getLogger(__name__)
 
 
 class TetrisDataService(DataService[TetrisState, TetrisAction, TetrisOnlineMetrics]):
     dbPath: str
+    stratified: bool
+    autoEvictSigns: tuple[int, ...]
+    incrementalVacuum: bool
+    validationCache: dict[int, Tensor]
+    timer: PhaseTimer  # Times the sample and decode phases of batch sampling.  Disabled unless a caller enables it.
+    frameRunWriter: FrameRunWriter | None  # Of the episode being pushed, so that its pushTransitions share frames
 
-    def __init__(self, rootPath: str | None = None, capacity: int = 10000) -> None:
+    def __init__(
+        self,
+        rootPath: str | None = None,
+        capacity: int = 10000,
+        stratified: bool = False,
+        autoEvictSigns: Sequence[int] = (),
+        incrementalVacuum: bool = False,
+    ) -> None:
+        """For each reward sign in autoEvictSigns, every push evicts the oldest rows of that sign beyond capacity, as
+        keepNewRowsDeleteOld does.  With incrementalVacuum, pages freed by eviction are returned to the file system
+        right away instead of being left for reuse."""
         if rootPath is None:
             rootPath = DB_ROOT_PATH
         self.dbPath = f"{rootPath}/data.db"
         self.capacity = capacity
+        self.stratified = stratified
+        if any(sgn not in [-1, 0, 1] for sgn in autoEvictSigns):
+            raise KeyError("autoEvictSigns must be a subset of {-1, 0, 1}")
+        self.autoEvictSigns = tuple(autoEvictSigns)
+        self.incrementalVacuum = incrementalVacuum
+        self.validationCache = {}
+        self.timer = PhaseTimer()
+        self.frameRunWriter = None
         with SqliteConnection(self.dbPath) as cur:
-            cur.execute(
-                """CREATE TABLE IF NOT EXISTS data (
-                    state TEXT NOT NULL,
-                    action TEXT NOT NULL,
-                    new_state TEXT NOT NULL,
-                    reward REAL NOT NULL
-                );"""
-            )
-            cur.execute(
-                """CREATE TABLE IF NOT EXISTS validation_data (
-                    episode_id INTEGER NOT NULL,
-                    state TEXT NOT NULL,
-                    action TEXT NOT NULL,
-                    new_state TEXT NOT NULL,
-                    reward REAL NOT NULL
-                );"""
+            version = getDataDbVersion(cur)
+        if version == 0:
+            # Boards cached for the validation episodes of a previous database would be served for the new episodes
+            # that reuse their ids
+            clearValidationCache(self.dbPath)
+            # Only free while the database is empty
+            setIncrementalAutoVacuum(self.dbPath)
+            with SqliteConnection(self.dbPath) as cur:
+                createDataTables(cur)
+        elif version != DATA_DB_VERSION:
+            raise RuntimeError(
+                f"{self.dbPath} has schema version {version}, expected {DATA_DB_VERSION}.  "
+                "Run bin/migrate_tetris_data.py to upgrade it."
             )
 
     def pushGameplay(self, gameplay: TetrisGameplayRecord) -> None:
@@ -54,37 +113,41 @@ class TetrisDataService(DataService[TetrisState, TetrisAction, TetrisOnlineMetri
     def pushEpisode(self, episode: EpisodeRecord[TetrisState, TetrisAction, TetrisOnlineMetrics]) -> None:
         logger.info("Pushing episode record.")
         logger.debug(f"Episode: {episode}")
-        query = """
-            INSERT INTO data (
-                state,
-                action,
-                new_state,
-                reward
-            ) VALUES (?, ?, ?, ?);"""
-        values = [entry.toDbRow() for entry in episode.moves]
+        self.pushTransitions(episode.moves)
+        self.finishEpisode()
+
+    def pushTransitions(self, transitions: Sequence[Transition[TetrisState, TetrisAction]]) -> None:
+        """Pushes consecutive transitions of an episode, in one transaction.  An episode may be pushed in several
+        calls, as long as finishEpisode is called after the last one."""
+        if len(transitions) == 0:
+            return
+        values = [TetrisTransition.toTetrisDbRow(entry) for entry in transitions]
         with SqliteConnection(self.dbPath) as cur:
-            cur.executemany(query, values)
+            self.frameRunWriter = insertFrameRuns(cur, values, self.frameRunWriter)
+            self._enforceCapacity(cur)
+
+    def finishEpisode(self) -> None:
+        """Marks the end of the episode pushed by the preceding pushTransitions calls, so that the next push starts a
+        new frame run."""
+        self.frameRunWriter = None
+
+    def openEpisodeSink(self, flushInterval: int = 100) -> TetrisEpisodeSink:
+        return TetrisEpisodeSink(self, flushInterval)
 
     def pushValidationEpisode(self, episode: EpisodeRecord[TetrisState, TetrisAction, TetrisOnlineMetrics]) -> None:
+        query = f"""
+            INSERT INTO validation_data (episode_id, {", ".join(TRANSITION_COLUMNS)})
+            VALUES (?, {", ".join("?" * len(TRANSITION_COLUMNS))});"""
         with SqliteConnection(self.dbPath) as cur:
-            maxId = cur.execute("SELECT MAX(episode_id) FROM validation_data;").fetchone()[0]
-        if maxId is None:
-            id = 0
-        else:
-            id = maxId + 1
-        logger.info("Pushing validation episode.")
-        logger.info(f"Validation episode ID: {id}")
-        logger.debug(f"Episode: {episode}")
-        query = """
-            INSERT INTO validation_data (
-                episode_id,
-                state,
-                action,
-                new_state,
-                reward
-            ) VALUES (?, ?, ?, ?, ?);"""
-        values = [(id,) + entry.toDbRow() for entry in episode.moves]
-        with SqliteConnection(self.dbPath) as cur:
+            maxId = cur.execute(VALIDATION_MAX_EPISODE_ID_QUERY).fetchone()[0]
+            if maxId is None:
+                id = 0
+            else:
+                id = maxId + 1
+            logger.info("Pushing validation episode.")
+            logger.info(f"Validation episode ID: {id}")
+            logger.debug(f"Episode: {episode}")
+            values = [(id,) + TetrisTransition.toTetrisDbRow(entry) for entry in episode.moves]
             cur.executemany(query, values)
 
     def getValidationEpisode(
@@ -92,43 +155,251 @@ class TetrisDataService(DataService[TetrisState, TetrisAction, TetrisOnlineMetri
     ) -> EpisodeRecord[TetrisState, TetrisAction, TetrisOnlineMetrics]:
         if episodeId is None:
             with SqliteConnection(self.dbPath) as cur:
-                maxId = cur.execute("SELECT MAX(episode_id) FROM validation_data;").fetchone()[0]
+                maxId = cur.execute(VALIDATION_MAX_EPISODE_ID_QUERY).fetchone()[0]
             if maxId is None:
                 raise KeyError("No validation episodes")
             else:
                 episodeId = maxId
         logger.info(f"Retrieving validation episode with id = {episodeId}")
         with SqliteConnection(self.dbPath) as cur:
-            rows = cur.execute(
-                f"SELECT state, action, new_state, reward FROM validation_data WHERE episode_id = {episodeId}"
-            ).fetchall()
-        return TetrisEpisodeRecord(episodeNumber=0, moves=[TetrisTransition.from_orm(DataDbRow(*row)) for row in rows])
+            rows = cur.execute(VALIDATION_EPISODE_QUERY, (episodeId,)).fetchall()
+        return TetrisEpisodeRecord(
+            episodeNumber=0,
+            moves=[TetrisTransition.fromTetrisDbRow(TetrisDataDbRow(*row), trusted=True) for row in rows],
+        )
+
+    def getValidationEpisodeIds(self, numEpisodes: int) -> list[int]:
+        """Returns the ids of the newest numEpisodes validation episodes (or all of them, if there are fewer), newest
+        first.  Each id is one seek back through the episode id index, so this does not depend on the number of
+        validation rows."""
+        if numEpisodes <= 0:
+            raise ValueError("numEpisodes must be positive")
+        ids: list[int] = []
+        with SqliteConnection(self.dbPath) as cur:
+            episodeId = cur.execute(VALIDATION_MAX_EPISODE_ID_QUERY).fetchone()[0]
+            while episodeId is not None and len(ids) < numEpisodes:
+                ids.append(episodeId)
+                episodeId = cur.execute(VALIDATION_PREVIOUS_EPISODE_ID_QUERY, (episodeId,)).fetchone()[0]
+        if not ids:
+            raise KeyError("No validation episodes")
+        return ids
+
+    def getValidationTensor(self, episodeId: int | None = None) -> tuple[Tensor, int]:
+        """Returns the DQN inputs of the states of a validation episode (by default the newest) stacked into one
+        tensor, along with the episode id.  Validation episodes never change once pushed, so the stacked boards are
+        cached in memory and in a .npy file next to data.db, keyed by episode id.  The cache is cleared when data.db is
+        created or migrated, and cached boards are only used if they match the number of states of the episode in
+        data.db, which is counted through the episode id index."""
+        with SqliteConnection(self.dbPath) as cur:
+            if episodeId is None:
+                episodeId = cur.execute(VALIDATION_MAX_EPISODE_ID_QUERY).fetchone()[0]
+                if episodeId is None:
+                    raise KeyError("No validation episodes")
+            numStates = cur.execute(VALIDATION_EPISODE_LENGTH_QUERY, (episodeId,)).fetchone()[0]
+        if numStates == 0:
+            raise KeyError(f"Validation episode {episodeId} not found")
+        tensor = self.validationCache.get(episodeId)
+        if tensor is not None and len(tensor) == numStates:
+            return tensor, episodeId
+
+        cachePath = f"{getValidationCachePath(self.dbPath)}/{episodeId}.npy"
+        boards = np.load(cachePath) if os.path.exists(cachePath) else None
+        if boards is not None and len(boards) == numStates:
+            logger.info(f"Loading validation episode {episodeId} from {cachePath}")
+        else:
+            if boards is not None:
+                logger.warning(f"Rebuilding {cachePath}, which does not match validation episode {episodeId}")
+            moves = self.getValidationEpisode(episodeId).moves
+            boards = np.stack([move.state.board for move in moves])
+            os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+            # Write and rename, so that a crash never leaves a partial file behind
+            with open(f"{cachePath}.tmp", "wb") as f:
+                np.save(f, boards)
+            os.replace(f"{cachePath}.tmp", cachePath)
+        tensor = self.validationCache[episodeId] = torch.from_numpy(boards)
+        return tensor, episodeId
 
     def sample(self, batchSize: int) -> Sequence[Transition[TetrisState, TetrisAction]]:
-        logger.info(f"Sampling batch of {batchSize} transitions")
+        logger.info(f"Sampling {'stratified' if self.stratified else 'uniform'} batch of {batchSize} transitions")
         with SqliteConnection(self.dbPath) as cur:
-            rows = cur.execute(f"select * from data order by random() limit {batchSize}").fetchall()
-        if len(rows) < batchSize:
-            logger.info(f"Not enough rows found (found {len(rows)}).  Oversampling.")
-            rows *= ceil(batchSize / len(rows))
+            rows = self._attachFrames(cur, self._sampleRows(cur, batchSize))
+        random.shuffle(rows)
+        return [TetrisTransition.fromTetrisDbRow(row, trusted=True) for row in rows]
+
+    def sampleBatch(self, batchSize: int) -> TransitionBatch:
+        logger.info(f"Sampling {'stratified' if self.stratified else 'uniform'} batch of {batchSize} transitions")
+        # Reading rows and frames from data.db counts as sampling, turning them into arrays as decoding
+        with self.timer.time("sample", batchSize), SqliteConnection(self.dbPath) as cur:
+            rows = self._sampleRows(cur, batchSize)
+            frames = self._getFrames(cur, rows)
+        with self.timer.time("decode", batchSize):
             random.shuffle(rows)
-            rows = rows[:batchSize]
-            logger.debug(f"Oversampled rows: {rows}")
-        return [TetrisTransition.from_orm(DataDbRow(*row)) for row in random.sample(rows, batchSize)]
+            actionIdx, rewardIdx, isTerminalIdx = (
+                DATA_COLUMNS.index(c) for c in ("action", "reward", "state_is_terminal")
+            )
+            states, nextStates = stackFrames(rows, frames)
+            return TransitionBatch(
+                states=states,
+                actions=np.array([ACTION_INDICES[row[actionIdx]] for row in rows], dtype=np.int64),
+                rewards=np.array([row[rewardIdx] for row in rows], dtype=np.float32),
+                nextStates=nextStates,
+                nonFinalMask=np.array([not row[isTerminalIdx] for row in rows], dtype=np.bool_),
+            )
+
+    def _sampleRows(self, cur: sqlite3.Cursor, batchSize: int) -> list[tuple[Any, ...]]:
+        """Draws batchSize data rows (in DATA_COLUMNS order), without replacement unless there are too few rows.  Cost
+        depends on batchSize and not on the number of rows, because slots are drawn in Python and looked up through
+        the data_slots index."""
+        counts = {sgn: cur.execute(SLOT_COUNT_QUERY, (sgn,)).fetchone()[0] for sgn in (-1, 0, 1)}
+        if sum(counts.values()) == 0:
+            raise KeyError("No transitions to sample")
+        if self.stratified:
+            slots = self._drawStratifiedSlots(counts, batchSize)
+        else:
+            slots = self._drawUniformSlots(counts, batchSize)
+        return self._getRowsBySlot(cur, slots)
+
+    @staticmethod
+    def _drawUniformSlots(counts: dict[int, int], batchSize: int) -> dict[int, list[int]]:
+        """Draws slots uniformly from the union of all signs, by numbering the rows of sign -1, then 0, then 1."""
+        slots: dict[int, list[int]] = {sgn: [] for sgn in counts}
+        for idx in _drawIndices(sum(counts.values()), batchSize):
+            for sgn, count in counts.items():
+                if idx < count:
+                    slots[sgn].append(idx)
+                    break
+                idx -= count
+        return slots
+
+    @staticmethod
+    def _drawStratifiedSlots(counts: dict[int, int], batchSize: int) -> dict[int, list[int]]:
+        """Splits the batch evenly between the reward signs that have rows, then draws uniformly within each sign."""
+        signs = [sgn for sgn, count in counts.items() if count > 0]
+        quotas = {sgn: batchSize // len(signs) for sgn in signs}
+        for sgn in random.sample(signs, batchSize % len(signs)):
+            quotas[sgn] += 1
+        return {sgn: _drawIndices(counts[sgn], quota) for sgn, quota in quotas.items()}
+
+    def _getRowsBySlot(self, cur: sqlite3.Cursor, slots: dict[int, list[int]]) -> list[tuple[Any, ...]]:
+        rows: list[tuple[Any, ...]] = []
+        for sgn, signSlots in slots.items():
+            if len(signSlots) == 0:
+                continue
+            uniqueSlots = sorted(set(signSlots))
+            rowsBySlot = {
+                row[0]: row[1:]
+                for row in cur.execute(rowsBySlotQuery(len(uniqueSlots)), [sgn] + uniqueSlots)
+            }
+            rows += [rowsBySlot[slot] for slot in signSlots]
+        return rows
+
+    @classmethod
+    def _attachFrames(cls, cur: sqlite3.Cursor, rows: list[tuple[Any, ...]]) -> list[TetrisDataDbRow]:
+        """Rebuilds the board stacks of data rows from the frames table."""
+        packedFrames = cls._getFrames(cur, rows)
+        frames = dict(zip(packedFrames, (frame.tobytes() for frame in unpackFrameArray(packedFrames.values()))))
+        return [joinFrames(row, frames) for row in rows]
+
+    @staticmethod
+    def _getFrames(cur: sqlite3.Cursor, rows: list[tuple[Any, ...]]) -> dict[int, bytes]:
+        """Returns the frames referenced by the data rows, by frame id, as stored in the frames table."""
+        frameIds = sorted({row[0] + offset for row in rows for offset in range(3)})
+        return dict(cur.execute(framesByIdQuery(len(frameIds)), frameIds).fetchall())
 
     def keepNewRowsDeleteOld(self, sgn: int = 0) -> None:
         logger.info(f"Removing all but {self.capacity} rows with reward sign {sgn}")
         if sgn not in [-1, 0, 1]:
             raise KeyError("sgn must be one of {-1, 0, 1}")
         with SqliteConnection(self.dbPath) as cur:
-            cur.execute(
-                f"""
-                with rows_to_keep as (
-                    select rowid from data
-                    where sign(reward) = {sgn}
-                    order by rowid desc
-                    limit {self.capacity}
-                )
-                delete from data where sign(reward) = {sgn} and rowid not in rows_to_keep;
-                """
-            )
+            if self._evictOldRows(cur, sgn) > 0 and self.incrementalVacuum:
+                cur.execute("PRAGMA incremental_vacuum;").fetchall()
+
+    def _enforceCapacity(self, cur: sqlite3.Cursor) -> None:
+        numEvicted = sum(self._evictOldRows(cur, sgn) for sgn in self.autoEvictSigns)
+        if numEvicted > 0 and self.incrementalVacuum:
+            # Each step of the pragma frees a page, so it has to be run to completion
+            cur.execute("PRAGMA incremental_vacuum;").fetchall()
+
+    def _evictOldRows(self, cur: sqlite3.Cursor, sgn: int) -> int:
+        """Deletes the oldest rows with reward sign sgn beyond capacity.  The count comes from the slot index and the
+        rows from the sign index, so the cost is proportional to the number of rows evicted.  Returns that number."""
+        numRows = cur.execute(SLOT_COUNT_QUERY, (sgn,)).fetchone()[0]
+        numEvicted = numRows - self.capacity
+        if numEvicted <= 0:
+            return 0
+        logger.debug(f"Evicting {numEvicted} rows with reward sign {sgn}")
+        cur.execute(EVICTION_QUERY, (sgn, numEvicted))
+        return numEvicted
+
+
+class TetrisEpisodeSink(AbstractContextManager["TetrisEpisodeSink"]):
+    """Streams an episode into a data service while it is played.  append buffers transitions and pushes them every
+    flushInterval transitions, so that memory stays bounded and writes are spread over the episode.  close pushes the
+    rest and finishes the episode.  Also tracks the online metrics of the episode, since its moves are not kept."""
+
+    dataService: TetrisDataService
+    flushInterval: int
+    buffer: list[Transition[TetrisState, TetrisAction]]
+    numMoves: int
+    score: int
+    closed: bool
+
+    def __init__(self, dataService: TetrisDataService, flushInterval: int = 100) -> None:
+        if flushInterval <= 0:
+            raise ValueError("flushInterval must be positive")
+        self.dataService = dataService
+        self.flushInterval = flushInterval
+        self.buffer = []
+        self.numMoves = 0
+        self.score = 0
+        self.closed = False
+
+    def append(self, transition: Transition[TetrisState, TetrisAction]) -> None:
+        if self.closed:
+            raise RuntimeError("Cannot append to a closed episode sink")
+        self.buffer.append(transition)
+        self.numMoves += 1
+        self.score = max(self.score, transition.newState.score)
+        if len(self.buffer) >= self.flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        logger.debug(f"Flushing {len(self.buffer)} transitions")
+        self.dataService.pushTransitions(self.buffer)
+        self.buffer = []
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        logger.info(f"Closing episode sink after {self.numMoves} transitions")
+        self.flush()
+        self.dataService.finishEpisode()
+        self.closed = True
+
+    def computeOnlineMetrics(self, episodeNumber: int) -> TetrisOnlineMetrics:
+        return TetrisOnlineMetrics(episodeNumber=episodeNumber, numMoves=self.numMoves, score=self.score)
+
+    def __exit__(
+        self,
+        __exc_type: type[BaseException] | None,
+        __exc_value: BaseException | None,
+        __traceback: TracebackType | None,
+    ) -> bool | None:
+        self.close()
+        return super().__exit__(__exc_type, __exc_value, __traceback)
+
+
+def _drawIndices(numRows: int, numDraws: int) -> list[int]:
+    """Draws numDraws indices from range(numRows), without replacement as long as there are enough rows."""
+    if numDraws <= numRows:
+        return random.sample(range(numRows), numDraws)
+    logger.info(f"Not enough rows found (found {numRows}).  Oversampling.")
+    return list(range(numRows)) + random.choices(range(numRows), k=numDraws - numRows)
+
+
+def drawIndexArray(rng: np.random.Generator, numRows: int, numDraws: int) -> NDArray[np.int64]:
+    """Counterpart of _drawIndices for the in-memory and sharded backends, so that every backend draws the same way."""
+    if numDraws <= numRows:
+        return rng.choice(numRows, numDraws, replace=False)
+    logger.info(f"Not enough rows found (found {numRows}).  Oversampling.")
+    return np.concatenate([np.arange(numRows), rng.integers(0, numRows, numDraws - numRows)])
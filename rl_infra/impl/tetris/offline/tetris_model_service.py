@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import logging
 import os
+import sqlite3
+from typing import Any, Sequence
 
 import torch
 from torch.optim import Optimizer
 
 from rl_infra.impl.tetris.offline.config import DB_ROOT_PATH
 from rl_infra.impl.tetris.offline.dqn import DeepQNetwork
+from rl_infra.impl.tetris.offline.phase_timer import PhaseStats
+from rl_infra.impl.tetris.offline.tensor_checkpoint import loadCheckpoint, readCheckpointHeader, saveCheckpoint
 from rl_infra.impl.tetris.offline.tetris_schema import (
     TetrisModelDbEntry,
     TetrisModelDbRow,
@@ -16,11 +20,95 @@ from rl_infra.impl.tetris.offline.tetris_schema import (
     TetrisOnlineMetrics,
     TetrisOnlineMetricsDbEntry,
 )
-from rl_infra.impl.tetris.online.config import MODEL_ENTRY_PATH, MODEL_ROOT_PATH, MODEL_WEIGHTS_PATH
+from rl_infra.impl.tetris.online.config import (
+    MODEL_CHECKPOINT_PATH,
+    MODEL_ENTRY_PATH,
+    MODEL_ROOT_PATH,
+    MODEL_WEIGHTS_PATH,
+)
 from rl_infra.types.offline import ModelDbKey, ModelService, SqliteConnection
+from rl_infra.types.offline.schema import OPTIMIZER_SECTION, POLICY_MODEL_SECTION, TARGET_MODEL_SECTION
 
 logger = logging.getLogger(__name__)
 
+_WEIGHTS_SECTIONS = (POLICY_MODEL_SECTION, TARGET_MODEL_SECTION, OPTIMIZER_SECTION)
+
+LATEST_VERSION_QUERY = "SELECT tag, version, weights_location FROM models WHERE tag = ? ORDER BY version DESC;"
+MODEL_ENTRY_QUERY = "SELECT * FROM models WHERE tag = ? AND version = ?;"
+
+# Both lookups are served by the primary key index of models.  See findFullScans and bin/check_query_plans.py.
+MODEL_DB_HOT_QUERIES: list[tuple[str, str, tuple[Any, ...]]] = [
+    ("latest version", LATEST_VERSION_QUERY, ("tag",)),
+    ("model entry", MODEL_ENTRY_QUERY, ("tag", 0)),
+]
+
+
+def createModelTables(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS models (
+            tag TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            weights_location TEXT NOT NULL,
+            num_episodes_played INTEGER NOT NULL,
+            num_epochs_trained INTEGER NOT NULL,
+            avg_episode_length REAL,
+            avg_episode_score REAL,
+            recency_weighted_avg_loss REAL,
+            recency_weighted_avg_validation_q REAL,
+            PRIMARY KEY(tag, version)
+        );"""
+    )
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS offline_metrics (
+            tag TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            epoch_number INTEGER NOT NULL,
+            num_batches_trained INTEGER NOT NULL,
+            avg_batch_loss REAL NOT NULL,
+            val_episode_avg_max_q REAL NOT NULL,
+            validation_episode_id INTEGER NOT NULL,
+            PRIMARY KEY(tag, version, epoch_number),
+            FOREIGN KEY(tag, version) REFERENCES models(tag, version)
+        );"""
+    )
+    # One row per validation episode of each offline_metrics row
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS offline_validation_metrics (
+            tag TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            epoch_number INTEGER NOT NULL,
+            validation_episode_id INTEGER NOT NULL,
+            avg_max_q REAL NOT NULL,
+            PRIMARY KEY(tag, version, epoch_number, validation_episode_id),
+            FOREIGN KEY(tag, version, epoch_number) REFERENCES offline_metrics(tag, version, epoch_number)
+        );"""
+    )
+    # One row per timed phase of each offline_metrics row, when training records timings
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS training_timings (
+            tag TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            epoch_number INTEGER NOT NULL,
+            phase TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total_seconds REAL NOT NULL,
+            num_samples INTEGER NOT NULL,
+            PRIMARY KEY(tag, version, epoch_number, phase),
+            FOREIGN KEY(tag, version, epoch_number) REFERENCES offline_metrics(tag, version, epoch_number)
+        );"""
+    )
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS online_metrics (
+            tag TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            episode_number INTEGER NOT NULL,
+            num_moves INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            PRIMARY KEY(tag, version, episode_number),
+            FOREIGN KEY(tag, version) REFERENCES models(tag, version)
+        );"""
+    )
+
 
 class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisOfflineMetrics]):
     def __init__(self) -> None:
@@ -28,46 +116,10 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
         self.modelWeightsPathStub = f"{DB_ROOT_PATH}/models"
         self.deployModelRootPath = MODEL_ROOT_PATH
         self.deployModelWeightsPath = MODEL_WEIGHTS_PATH
+        self.deployModelCheckpointPath = MODEL_CHECKPOINT_PATH
         self.deployModelEntryPath = MODEL_ENTRY_PATH
         with SqliteConnection(self.dbPath) as cur:
-            cur.execute(
-                """CREATE TABLE IF NOT EXISTS models (
-                    tag TEXT NOT NULL,
-                    version INTEGER NOT NULL,
-                    weights_location TEXT NOT NULL,
-                    num_episodes_played INTEGER NOT NULL,
-                    num_epochs_trained INTEGER NOT NULL,
-                    avg_episode_length REAL,
-                    avg_episode_score REAL,
-                    recency_weighted_avg_loss REAL,
-                    recency_weighted_avg_validation_q REAL,
-                    PRIMARY KEY(tag, version)
-                );"""
-            )
-            cur.execute(
-                """CREATE TABLE IF NOT EXISTS offline_metrics (
-                    tag TEXT NOT NULL,
-                    version INTEGER NOT NULL,
-                    epoch_number INTEGER NOT NULL,
-                    num_batches_trained INTEGER NOT NULL,
-                    avg_batch_loss REAL NOT NULL,
-                    val_episode_avg_max_q REAL NOT NULL,
-                    validation_episode_id INTEGER NOT NULL,
-                    PRIMARY KEY(tag, version, epoch_number),
-                    FOREIGN KEY(tag, version) REFERENCES models(tag, version)
-                );"""
-            )
-            cur.execute(
-                """CREATE TABLE IF NOT EXISTS online_metrics (
-                    tag TEXT NOT NULL,
-                    version INTEGER NOT NULL,
-                    episode_number INTEGER NOT NULL,
-                    num_moves INTEGER NOT NULL,
-                    score INTEGER NOT NULL,
-                    PRIMARY KEY(tag, version, episode_number),
-                    FOREIGN KEY(tag, version) REFERENCES models(tag, version)
-                );"""
-            )
+            createModelTables(cur)
 
     def publishNewModel(
         self,
@@ -96,18 +148,14 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
 
     def getLatestVersionKey(self, modelTag: str) -> ModelDbKey | None:
         with SqliteConnection(self.dbPath) as cur:
-            res = cur.execute(
-                f"SELECT tag, version, weights_location FROM models WHERE tag = '{modelTag}' ORDER BY version DESC"
-            ).fetchone()
+            res = cur.execute(LATEST_VERSION_QUERY, (modelTag,)).fetchone()
         if res is None:
             return None
         return ModelDbKey(tag=res[0], version=res[1], weightsLocation=res[2])
 
     def getModelEntry(self, key: ModelDbKey) -> TetrisModelDbEntry | None:
         with SqliteConnection(self.dbPath) as cur:
-            res = cur.execute(
-                f"""SELECT * FROM models WHERE tag = '{key.tag}' AND version = {key.version};"""
-            ).fetchone()
+            res = cur.execute(MODEL_ENTRY_QUERY, (key.tag, key.version)).fetchone()
         if res is None:
             return None
         return TetrisModelDbEntry.from_orm(TetrisModelDbRow(*res))
@@ -118,8 +166,19 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
             raise KeyError(f"Model {key} not found")
         if not os.path.exists(self.deployModelRootPath):
             os.makedirs(self.deployModelRootPath)
-        logger.info(f"Deploying model {key} (executing cp {key.policyModelLocation} {self.deployModelWeightsPath})")
-        os.system(f"cp {key.policyModelLocation} {self.deployModelWeightsPath}")
+        if os.path.exists(key.checkpointLocation):
+            # Agents only need the policy, so only it is deployed.  Saving the checkpoint is atomic, so agents starting
+            # meanwhile load either the old or the new policy.
+            logger.info(f"Deploying model {key} (saving its policy to {self.deployModelCheckpointPath})")
+            saveCheckpoint(self.deployModelCheckpointPath, loadCheckpoint(key.checkpointLocation, POLICY_MODEL_SECTION))
+            staleWeightsPath = self.deployModelWeightsPath
+        else:
+            logger.info(f"Deploying model {key} (executing cp {key.policyModelLocation} {self.deployModelWeightsPath})")
+            os.system(f"cp {key.policyModelLocation} {self.deployModelWeightsPath}")
+            staleWeightsPath = self.deployModelCheckpointPath
+        # Agents load whichever format is deployed, so remove the previously deployed model if it had the other one
+        if os.path.exists(staleWeightsPath):
+            os.remove(staleWeightsPath)
         logger.info(f"Copying model entry {entry} to {self.deployModelEntryPath}")
         with open(self.deployModelEntryPath, "w") as f:
             f.write(entry.json())
@@ -131,63 +190,119 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
         targetModel: DeepQNetwork | None = None,
         optimizer: Optimizer | None = None,
     ) -> None:
+        """Saves the given models and optimizer in key's checkpoint.  The checkpoint is a single file, so the saved
+        weights of the others are carried over, and weights saved in the legacy .pt files are converted."""
         if not os.path.exists(key.weightsLocation):
             os.makedirs(key.weightsLocation)
-        if policyModel is not None:
-            torch.save(policyModel.state_dict(), key.policyModelLocation)
-        if targetModel is not None:
-            torch.save(targetModel.state_dict(), key.targetModelLocation)
+        sections = {
+            name: stateful.state_dict()
+            for name, stateful in self._weightsSections(policyModel, targetModel, optimizer).items()
+            if stateful is not None
+        }
+        if not sections:
+            return
+        savedSections = self._loadWeightsSections(key, [name for name in _WEIGHTS_SECTIONS if name not in sections])
+        saveCheckpoint(key.checkpointLocation, savedSections | sections)
+        for location in (key.policyModelLocation, key.targetModelLocation, key.optimizerLocation):
+            if os.path.exists(location):
+                os.remove(location)
+
+    def loadModelWeights(
+        self,
+        key: ModelDbKey,
+        policyModel: DeepQNetwork | None = None,
+        targetModel: DeepQNetwork | None = None,
+        optimizer: Optimizer | None = None,
+    ) -> None:
+        """Loads key's saved weights into each of the given models and optimizer, reading only their sections of the
+        checkpoint, or the legacy .pt files of weights saved before checkpoints were single files."""
+        statefuls = {
+            name: stateful
+            for name, stateful in self._weightsSections(policyModel, targetModel, optimizer).items()
+            if stateful is not None
+        }
+        sections = self._loadWeightsSections(key, [name for name in statefuls if name != OPTIMIZER_SECTION])
         if optimizer is not None:
-            torch.save(optimizer.state_dict(), key.optimizerLocation)
+            # The optimizer keeps the state tensors it loads instead of copying them, so it is given copies rather than
+            # views of the checkpoint file
+            sections |= self._loadWeightsSections(key, [OPTIMIZER_SECTION], copy=True)
+        for name, stateful in statefuls.items():
+            if name not in sections:
+                raise KeyError(f"No {name} weights saved for {key}")
+            stateful.load_state_dict(sections[name])
 
     def publishOnlineMetrics(self, key: ModelDbKey, onlineMetrics: TetrisOnlineMetrics) -> None:
         modelEntry = TetrisModelDbEntry.fromMetrics(key, onlineMetrics=onlineMetrics)
         logger.info(f"Publishing online metrics.  Created model entry {modelEntry} to upsert.")
-        maybeExistingEntry = self.getModelEntry(key)
-        if maybeExistingEntry is not None:
-            logger.debug(f"Found existing model entry {maybeExistingEntry}")
-            modelEntry = maybeExistingEntry.updateWithNewValues(modelEntry)
-            logger.debug(f"After updaing, model entry to upsert is {modelEntry}")
-        self._upsertModelEntry(modelEntry)
-        onlineMetricsEntry = TetrisOnlineMetricsDbEntry(modelDbKey=key, onlineMetrics=onlineMetrics)
-        logger.info(f"Online metrics enrty to insert: {onlineMetricsEntry}")
-        self._insertOnlineMetricsEntry(onlineMetricsEntry)
+        # One transaction for the read-modify-write of the model entry and the metrics insert
+        with SqliteConnection(self.dbPath):
+            maybeExistingEntry = self.getModelEntry(key)
+            if maybeExistingEntry is not None:
+                logger.debug(f"Found existing model entry {maybeExistingEntry}")
+                modelEntry = maybeExistingEntry.updateWithNewValues(modelEntry)
+                logger.debug(f"After updaing, model entry to upsert is {modelEntry}")
+            self._upsertModelEntry(modelEntry)
+            onlineMetricsEntry = TetrisOnlineMetricsDbEntry(modelDbKey=key, onlineMetrics=onlineMetrics)
+            logger.info(f"Online metrics enrty to insert: {onlineMetricsEntry}")
+            self._insertOnlineMetricsEntry(onlineMetricsEntry)
 
     def publishOfflineMetrics(self, key: ModelDbKey, offlineMetrics: TetrisOfflineMetrics) -> None:
         modelEntry = TetrisModelDbEntry.fromMetrics(key, offlineMetrics=offlineMetrics)
         logger.info(f"Publishing offline metrics.  Created model entry {modelEntry} to upsert.")
-        maybeExistingEntry = self.getModelEntry(key)
-        if maybeExistingEntry is not None:
-            logger.debug(f"Found existing model entry {maybeExistingEntry}")
-            modelEntry = maybeExistingEntry.updateWithNewValues(modelEntry)
-            logger.debug(f"After updaing, model entry to upsert is {modelEntry}")
-        self._upsertModelEntry(modelEntry)
-        offlineMetricsEntry = TetrisOfflineMetricsDbEntry(modelDbKey=key, offlineMetrics=offlineMetrics)
-        logger.info(f"Offline metrics enrty to insert: {offlineMetricsEntry}")
-        self._insertOfflineMetricsEntry(offlineMetricsEntry)
+        with SqliteConnection(self.dbPath):
+            maybeExistingEntry = self.getModelEntry(key)
+            if maybeExistingEntry is not None:
+                logger.debug(f"Found existing model entry {maybeExistingEntry}")
+                modelEntry = maybeExistingEntry.updateWithNewValues(modelEntry)
+                logger.debug(f"After updaing, model entry to upsert is {modelEntry}")
+            self._upsertModelEntry(modelEntry)
+            offlineMetricsEntry = TetrisOfflineMetricsDbEntry(modelDbKey=key, offlineMetrics=offlineMetrics)
+            logger.info(f"Offline metrics enrty to insert: {offlineMetricsEntry}")
+            self._insertOfflineMetricsEntry(offlineMetricsEntry)
+
+    def publishTrainingTimings(self, key: ModelDbKey, epochNumber: int, phaseStats: Sequence[PhaseStats]) -> None:
+        """Records the time spent in each phase of an epoch whose offline metrics are already published."""
+        logger.info(f"Publishing timings of {len(phaseStats)} training phases for epoch {epochNumber} of {key}")
+        with SqliteConnection(self.dbPath) as cur:
+            cur.executemany(
+                """INSERT INTO training_timings (
+                    tag,
+                    version,
+                    epoch_number,
+                    phase,
+                    count,
+                    total_seconds,
+                    num_samples
+                ) VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                (
+                    (key.tag, key.version, epochNumber, stats.phase, stats.count, stats.seconds, stats.numSamples)
+                    for stats in phaseStats
+                ),
+            )
 
     def _insertOnlineMetricsEntry(self, entry: TetrisOnlineMetricsDbEntry) -> None:
         with SqliteConnection(self.dbPath) as cur:
             cur.execute(
-                f"""INSERT INTO online_metrics (
+                """INSERT INTO online_metrics (
                     tag,
                     version,
                     episode_number,
                     num_moves,
                     score
-                ) VALUES (
-                    '{entry.modelDbKey.tag}',
-                    '{entry.modelDbKey.version}',
-                    {entry.onlineMetrics.episodeNumber},
-                    {entry.onlineMetrics.numMoves},
-                    {entry.onlineMetrics.score}
-                );"""
+                ) VALUES (?, ?, ?, ?, ?);""",
+                (
+                    entry.modelDbKey.tag,
+                    entry.modelDbKey.version,
+                    entry.onlineMetrics.episodeNumber,
+                    entry.onlineMetrics.numMoves,
+                    entry.onlineMetrics.score,
+                ),
             )
 
     def _insertOfflineMetricsEntry(self, entry: TetrisOfflineMetricsDbEntry) -> None:
         with SqliteConnection(self.dbPath) as cur:
             cur.execute(
-                f"""INSERT INTO offline_metrics (
+                """INSERT INTO offline_metrics (
                     tag,
                     version,
                     epoch_number,
@@ -195,25 +310,41 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
                     avg_batch_loss,
                     val_episode_avg_max_q,
                     validation_episode_id
-                ) VALUES (
-                    '{entry.modelDbKey.tag}',
-                    '{entry.modelDbKey.version}',
-                    {entry.offlineMetrics.epochNumber},
-                    {entry.offlineMetrics.numBatchesTrained},
-                    {entry.offlineMetrics.avgBatchLoss},
-                    {entry.offlineMetrics.valEpisodeAvgMaxQ},
-                    {entry.offlineMetrics.validationEpisodeId}
-                );"""
+                ) VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                (
+                    entry.modelDbKey.tag,
+                    entry.modelDbKey.version,
+                    entry.offlineMetrics.epochNumber,
+                    entry.offlineMetrics.numBatchesTrained,
+                    entry.offlineMetrics.avgBatchLoss,
+                    entry.offlineMetrics.valEpisodeAvgMaxQ,
+                    entry.offlineMetrics.validationEpisodeId,
+                ),
+            )
+            cur.executemany(
+                """INSERT INTO offline_validation_metrics (
+                    tag,
+                    version,
+                    epoch_number,
+                    validation_episode_id,
+                    avg_max_q
+                ) VALUES (?, ?, ?, ?, ?);""",
+                (
+                    (
+                        entry.modelDbKey.tag,
+                        entry.modelDbKey.version,
+                        entry.offlineMetrics.epochNumber,
+                        episodeId,
+                        avgMaxQ,
+                    )
+                    for episodeId, avgMaxQ in entry.offlineMetrics.valEpisodeAvgMaxQs.items()
+                ),
             )
 
     def _upsertModelEntry(self, entry: TetrisModelDbEntry) -> None:
-        episodeLength = entry.avgEpisodeLength if entry.avgEpisodeLength is not None else "NULL"
-        episodeScore = entry.avgEpisodeScore if entry.avgEpisodeScore is not None else "NULL"
-        trainingLoss = entry.recencyWeightedAvgLoss if entry.recencyWeightedAvgLoss is not None else "NULL"
-        avgQ = entry.recencyWeightedAvgValidationQ if entry.recencyWeightedAvgValidationQ is not None else "NULL"
         with SqliteConnection(self.dbPath) as cur:
             cur.execute(
-                f"""INSERT INTO models (
+                """INSERT INTO models (
                     tag,
                     version,
                     weights_location,
@@ -223,17 +354,7 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
                     avg_episode_score,
                     recency_weighted_avg_loss,
                     recency_weighted_avg_validation_q
-                ) VALUES (
-                    '{entry.modelDbKey.tag}',
-                    '{entry.modelDbKey.version}',
-                    '{entry.modelDbKey.weightsLocation}',
-                    {entry.numEpisodesPlayed},
-                    {entry.numEpochsTrained},
-                    {episodeLength},
-                    {episodeScore},
-                    {trainingLoss},
-                    {avgQ}
-                )
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ON CONFLICT (tag, version)
                 DO UPDATE SET
                     weights_location=excluded.weights_location,
@@ -242,8 +363,38 @@ class TetrisModelService(ModelService[DeepQNetwork, TetrisOnlineMetrics, TetrisO
                     avg_episode_length=excluded.avg_episode_length,
                     avg_episode_score=excluded.avg_episode_score,
                     recency_weighted_avg_loss=excluded.recency_weighted_avg_loss,
-                    recency_weighted_avg_validation_q=excluded.recency_weighted_avg_validation_q;"""
+                    recency_weighted_avg_validation_q=excluded.recency_weighted_avg_validation_q;""",
+                (
+                    entry.modelDbKey.tag,
+                    entry.modelDbKey.version,
+                    entry.modelDbKey.weightsLocation,
+                    entry.numEpisodesPlayed,
+                    entry.numEpochsTrained,
+                    entry.avgEpisodeLength,
+                    entry.avgEpisodeScore,
+                    entry.recencyWeightedAvgLoss,
+                    entry.recencyWeightedAvgValidationQ,
+                ),
             )
 
+    def _weightsSections(
+        self, policyModel: DeepQNetwork | None, targetModel: DeepQNetwork | None, optimizer: Optimizer | None
+    ) -> dict[str, DeepQNetwork | Optimizer | None]:
+        return {POLICY_MODEL_SECTION: policyModel, TARGET_MODEL_SECTION: targetModel, OPTIMIZER_SECTION: optimizer}
+
+    def _loadWeightsSections(self, key: ModelDbKey, names: list[str], copy: bool = False) -> dict[str, Any]:
+        """Returns the saved state dicts among names, from key's checkpoint or else its legacy .pt files."""
+        if not names:
+            return {}
+        if os.path.exists(key.checkpointLocation):
+            savedNames = readCheckpointHeader(key.checkpointLocation).sections
+            return loadCheckpoint(key.checkpointLocation, *[name for name in names if name in savedNames], copy=copy)
+        legacyLocations = {
+            POLICY_MODEL_SECTION: key.policyModelLocation,
+            TARGET_MODEL_SECTION: key.targetModelLocation,
+            OPTIMIZER_SECTION: key.optimizerLocation,
+        }
+        return {name: torch.load(legacyLocations[name]) for name in names if os.path.exists(legacyLocations[name])}
+
     def _generateWeightsLocation(self, tag: str, version: int) -> str:
         return f"{self.modelWeightsPathStub}/{tag}/{version}"
@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+from rl_infra.impl.tetris.offline.sum_tree import SumTree
+from rl_infra.impl.tetris.offline.tetris_data_schema import ACTIONS, DATA_COLUMNS, PIECES, insertFrameRuns
+from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService, drawIndexArray
+from rl_infra.impl.tetris.online.tetris_board_codec import PACKED_FRAME_SIZE, packFrames, unpackFrames
+from rl_infra.impl.tetris.online.tetris_transition import (
+    BOARD_SHAPE,
+    TetrisAction,
+    TetrisDataDbRow,
+    TetrisState,
+    TetrisTransition,
+)
+from rl_infra.types.offline import PrioritizedDataService, SqliteConnection, TransitionBatch
+from rl_infra.types.online.transition import Transition
+
+logger = logging.getLogger(__name__)
+
+
+class TetrisRingDataService(TetrisDataService, PrioritizedDataService[TetrisState, TetrisAction]):
+    """Replay buffer holding the newest `capacity` transitions in preallocated arrays, overwritten in ring order.
+    Pushed transitions are written through to data.db every `persistInterval` transitions (and on persist()), and the
+    buffer is reloaded from the newest rows of data.db on construction.  Validation episodes are served from data.db as
+    usual.
+
+    With prioritized=True, slots also carry priorities (|TD error| + priorityEpsilon) ** priorityExponent in a sum-tree,
+    which samplePrioritized draws from proportionally.  New transitions get the largest priority seen so far, so that
+    each is replayed at least once before its TD error is known."""
+
+    persistInterval: int
+    prioritized: bool
+    size: int
+    cursor: int
+    numUnpersisted: int
+    rng: np.random.Generator
+    boards: NDArray[np.uint8]
+    nextFrames: NDArray[np.uint8]
+    actions: NDArray[np.uint8]
+    rewards: NDArray[np.float32]
+    scores: NDArray[np.int32]
+    pieces: NDArray[np.uint8]
+    terminals: NDArray[np.bool_]
+    signSlots: NDArray[np.int64]
+    signCounts: list[int]
+    slotSigns: NDArray[np.int8]
+    slotPositions: NDArray[np.int64]
+    priorities: SumTree | None
+    priorityExponent: float
+    priorityEpsilon: float
+    maxPriority: float
+    prioritiesLock: threading.Lock
+
+    def __init__(
+        self,
+        rootPath: str | None = None,
+        capacity: int = 10000,
+        persistInterval: int = 1000,
+        seed: int | None = None,
+        stratified: bool = False,
+        prioritized: bool = False,
+        priorityExponent: float = 0.6,
+        priorityEpsilon: float = 1e-3,
+        autoEvictSigns: Sequence[int] = (),
+        incrementalVacuum: bool = False,
+    ) -> None:
+        super().__init__(
+            rootPath=rootPath,
+            capacity=capacity,
+            stratified=stratified,
+            autoEvictSigns=autoEvictSigns,
+            incrementalVacuum=incrementalVacuum,
+        )
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        if stratified and prioritized:
+            raise ValueError("stratified and prioritized sampling are mutually exclusive")
+        self.persistInterval = persistInterval
+        self.rng = np.random.default_rng(seed)
+        # Frames are kept 2-bit packed (see tetris_board_codec), at about a quarter of their raw size.
+        # newState.board is always [next frame, state.board[0]], so only the next frame is kept for new states.  The
+        # second axis of scores, pieces and terminals is (state, newState), and the last axis of pieces is (active,
+        # next).
+        self.boards = np.zeros((capacity, BOARD_SHAPE[0], PACKED_FRAME_SIZE), dtype=np.uint8)
+        self.nextFrames = np.zeros((capacity, PACKED_FRAME_SIZE), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.uint8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.scores = np.zeros((capacity, 2), dtype=np.int32)
+        self.pieces = np.zeros((capacity, 2, 2), dtype=np.uint8)
+        self.terminals = np.zeros((capacity, 2), dtype=np.bool_)
+        # Index of the filled slots by reward sign, so that stratified draws cost O(batch) rather than O(capacity).  The
+        # first signCounts[sign + 1] entries of row sign + 1 of signSlots are the slots with rewards of that sign, in no
+        # particular order.  slotSigns and slotPositions locate each filled slot in signSlots.
+        self.signSlots = np.zeros((3, capacity), dtype=np.int64)
+        self.signCounts = [0, 0, 0]
+        self.slotSigns = np.zeros(capacity, dtype=np.int8)
+        self.slotPositions = np.zeros(capacity, dtype=np.int64)
+        self.prioritized = prioritized
+        self.priorities = SumTree(capacity) if prioritized else None
+        self.priorityExponent = priorityExponent
+        self.priorityEpsilon = priorityEpsilon
+        self.maxPriority = 1.0
+        # Batches may be prefetched on another thread while the training thread updates priorities
+        self.prioritiesLock = threading.Lock()
+        self.size = 0
+        self.cursor = 0
+        self.numUnpersisted = 0
+        self._loadFromDb()
+
+    def pushTransitions(self, transitions: Sequence[Transition[TetrisState, TetrisAction]]) -> None:
+        moves = transitions[-self.capacity :]
+        if len(moves) == 0:
+            return
+        slots = self._write(
+            boards=np.stack([move.state.board for move in moves]),
+            nextFrames=np.stack([move.newState.board[0] for move in moves]),
+            actions=np.array([ACTIONS.index(move.action) for move in moves], dtype=np.uint8),
+            rewards=np.array([move.reward for move in moves], dtype=np.float32),
+            scores=np.array([(move.state.score, move.newState.score) for move in moves], dtype=np.int32),
+            pieces=np.array(
+                [
+                    [
+                        (PIECES.index(state.activePiece), PIECES.index(state.nextPiece))
+                        for state in (move.state, move.newState)
+                    ]
+                    for move in moves
+                ],
+                dtype=np.uint8,
+            ),
+            terminals=np.array([(move.state.isTerminal, move.newState.isTerminal) for move in moves], dtype=np.bool_),
+        )
+        self.numUnpersisted = min(self.numUnpersisted + len(slots), self.capacity)
+        if self.numUnpersisted >= self.persistInterval:
+            self.persist()
+
+    def sample(self, batchSize: int) -> Sequence[Transition[TetrisState, TetrisAction]]:
+        return [self._getTransition(slot) for slot in self._drawSlots(batchSize)]
+
+    def sampleBatch(self, batchSize: int) -> TransitionBatch:
+        with self.timer.time("sample", batchSize):
+            slots = self._drawSlots(batchSize)
+        with self.timer.time("decode", batchSize):
+            return self._getBatch(slots)
+
+    def samplePrioritized(
+        self, batchSize: int, beta: float
+    ) -> tuple[Sequence[Transition[TetrisState, TetrisAction]], NDArray[np.int64], NDArray[np.float32]]:
+        slots, weights = self._drawPrioritizedSlots(batchSize, beta)
+        return [self._getTransition(slot) for slot in slots], slots, weights
+
+    def samplePrioritizedBatch(
+        self, batchSize: int, beta: float
+    ) -> tuple[TransitionBatch, NDArray[np.int64], NDArray[np.float32]]:
+        with self.timer.time("sample", batchSize):
+            slots, weights = self._drawPrioritizedSlots(batchSize, beta)
+        with self.timer.time("decode", batchSize):
+            return self._getBatch(slots), slots, weights
+
+    def updatePriorities(self, slots: NDArray[np.int64], tdErrors: NDArray[np.float32]) -> None:
+        if self.priorities is None:
+            raise RuntimeError("Prioritized sampling requires prioritized=True")
+        priorities = (np.abs(tdErrors) + self.priorityEpsilon) ** self.priorityExponent
+        with self.prioritiesLock:
+            self.priorities.update(slots, priorities)
+            self.maxPriority = max(self.maxPriority, float(priorities.max()))
+
+    def keepNewRowsDeleteOld(self, sgn: int = 0) -> None:
+        # The ring is bounded by construction, so this only bounds the copy in data.db.
+        self.persist()
+        super().keepNewRowsDeleteOld(sgn)
+
+    def persist(self) -> None:
+        """Writes the transitions pushed since the last snapshot to data.db."""
+        if self.numUnpersisted == 0:
+            return
+        logger.info(f"Persisting {self.numUnpersisted} transitions to {self.dbPath}")
+        slots = (self.cursor - self.numUnpersisted + np.arange(self.numUnpersisted)) % self.capacity
+        with SqliteConnection(self.dbPath) as cur:
+            insertFrameRuns(cur, [self._getDbRow(slot) for slot in slots])
+            self._enforceCapacity(cur)
+        self.numUnpersisted = 0
+
+    def _drawSlots(self, batchSize: int) -> NDArray[np.int64]:
+        logger.info(f"Sampling {'stratified' if self.stratified else 'uniform'} batch of {batchSize} transitions")
+        if self.size == 0:
+            raise KeyError("No transitions to sample")
+        if self.stratified:
+            return self._drawStratifiedSlots(batchSize)
+        return self.rng.integers(0, self.size, batchSize)
+
+    def _drawPrioritizedSlots(self, batchSize: int, beta: float) -> tuple[NDArray[np.int64], NDArray[np.float32]]:
+        """Returns the drawn slots and their importance sampling weights."""
+        logger.info(f"Sampling prioritized batch of {batchSize} transitions")
+        if self.priorities is None:
+            raise RuntimeError("Prioritized sampling requires prioritized=True")
+        if self.size == 0:
+            raise KeyError("No transitions to sample")
+        with self.prioritiesLock:
+            slots = self.priorities.sample(batchSize, self.rng)
+            # Importance sampling weights (size * P(slot)) ** -beta, normalized by the batch maximum so they only
+            # scale the loss down.
+            probabilities = self.priorities.get(slots) / self.priorities.total
+        weights = (self.size * probabilities) ** -beta
+        weights /= weights.max()
+        return slots, weights.astype(np.float32)
+
+    def _drawStratifiedSlots(self, batchSize: int) -> NDArray[np.int64]:
+        """Splits the batch evenly between the reward signs present in the buffer, then draws uniformly within each,
+        without replacement unless a sign has too few slots, as TetrisDataService does."""
+        presentSigns = [sign for sign in range(3) if self.signCounts[sign] > 0]
+        quotas = np.full(len(presentSigns), batchSize // len(presentSigns))
+        quotas[self.rng.choice(len(presentSigns), batchSize % len(presentSigns), replace=False)] += 1
+        return self.rng.permutation(
+            np.concatenate(
+                [
+                    self.signSlots[sign, drawIndexArray(self.rng, self.signCounts[sign], quota)]
+                    for sign, quota in zip(presentSigns, quotas)
+                ]
+            )
+        )
+
+    def _indexSigns(self, slots: NDArray[np.int64], rewards: NDArray[np.float32]) -> None:
+        """Files each of slots under the sign of its new reward.  Must run before self.size counts the slots, so that
+        overwritten slots are told apart from new ones."""
+        for slot, sign in zip(slots.tolist(), (np.sign(rewards).astype(np.int64) + 1).tolist()):
+            if slot < self.size:
+                oldSign = int(self.slotSigns[slot])
+                if oldSign == sign:
+                    continue
+                # Remove the slot from its old sign by moving that sign's last slot into its position
+                self.signCounts[oldSign] -= 1
+                lastSlot = self.signSlots[oldSign, self.signCounts[oldSign]]
+                self.signSlots[oldSign, self.slotPositions[slot]] = lastSlot
+                self.slotPositions[lastSlot] = self.slotPositions[slot]
+            self.signSlots[sign, self.signCounts[sign]] = slot
+            self.slotPositions[slot] = self.signCounts[sign]
+            self.signCounts[sign] += 1
+            self.slotSigns[slot] = sign
+
+    def _write(
+        self,
+        boards: NDArray[np.uint8],
+        nextFrames: NDArray[np.uint8],
+        actions: NDArray[np.uint8],
+        rewards: NDArray[np.float32],
+        scores: NDArray[np.int32],
+        pieces: NDArray[np.uint8],
+        terminals: NDArray[np.bool_],
+    ) -> NDArray[np.int64]:
+        """Writes a block of transitions at the cursor, wrapping around and overwriting the oldest ones.  Takes raw
+        boards and frames."""
+        slots = (self.cursor + np.arange(len(boards))) % self.capacity
+        self.boards[slots] = packFrames(boards)
+        self.nextFrames[slots] = packFrames(nextFrames)
+        self.actions[slots] = actions
+        self.rewards[slots] = rewards
+        self.scores[slots] = scores
+        self.pieces[slots] = pieces
+        self.terminals[slots] = terminals
+        self._indexSigns(slots, rewards)
+        if self.priorities is not None:
+            # Prefetching threads traverse the sum tree while this one pushes
+            with self.prioritiesLock:
+                self.priorities.update(slots, np.full(len(slots), self.maxPriority))
+        self.cursor = (self.cursor + len(slots)) % self.capacity
+        self.size = min(self.size + len(slots), self.capacity)
+        return slots
+
+    def _loadFromDb(self) -> None:
+        with SqliteConnection(self.dbPath) as cur:
+            rows = cur.execute(
+                f"SELECT {', '.join(DATA_COLUMNS)} FROM data ORDER BY rowid DESC LIMIT ?;", (self.capacity,)
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            dbRows = self._attachFrames(cur, rows[::-1])
+        logger.info(f"Loading {len(dbRows)} transitions from {self.dbPath}")
+        boards = np.frombuffer(b"".join(row.stateBoard for row in dbRows), dtype=np.uint8).reshape((-1,) + BOARD_SHAPE)
+        newBoards = np.frombuffer(b"".join(row.newStateBoard for row in dbRows), dtype=np.uint8).reshape(boards.shape)
+        self._write(
+            boards=boards,
+            nextFrames=newBoards[:, 0],
+            actions=np.array([ACTIONS.index(row.action) for row in dbRows], dtype=np.uint8),
+            rewards=np.array([row.reward for row in dbRows], dtype=np.float32),
+            scores=np.array([(row.stateScore, row.newStateScore) for row in dbRows], dtype=np.int32),
+            pieces=np.array(
+                [
+                    [
+                        (PIECES.index(row.stateActivePiece), PIECES.index(row.stateNextPiece)),
+                        (PIECES.index(row.newStateActivePiece), PIECES.index(row.newStateNextPiece)),
+                    ]
+                    for row in dbRows
+                ],
+                dtype=np.uint8,
+            ),
+            terminals=np.array([(row.stateIsTerminal, row.newStateIsTerminal) for row in dbRows], dtype=np.bool_),
+        )
+
+    def _getState(self, slot: int, new: bool) -> TetrisState:
+        board = self._getBoard(slot, new)
+        # Built without validation, since the fields come from arrays this class wrote
+        return TetrisState.construct(
+            board=board,
+            score=int(self.scores[slot, int(new)]),
+            activePiece=PIECES[self.pieces[slot, int(new), 0]],
+            nextPiece=PIECES[self.pieces[slot, int(new), 1]],
+            isTerminal=bool(self.terminals[slot, int(new)]),
+        )
+
+    def _getBoard(self, slot: int, new: bool) -> NDArray[np.uint8]:
+        """Unpacks the board of the state or new state in slot.  Unpacking copies, so the board is unaffected when the
+        slot is overwritten."""
+        if new:
+            return unpackFrames(np.stack([self.nextFrames[slot], self.boards[slot, 0]]))
+        return unpackFrames(self.boards[slot])
+
+    def _getBatch(self, slots: NDArray[np.int64]) -> TransitionBatch:
+        states = unpackFrames(self.boards[slots])
+        return TransitionBatch(
+            states=states,
+            actions=self.actions[slots].astype(np.int64),
+            rewards=self.rewards[slots],
+            nextStates=np.stack([unpackFrames(self.nextFrames[slots]), states[:, 0]], axis=1),
+            nonFinalMask=~self.terminals[slots, 0],
+        )
+
+    def _getTransition(self, slot: int) -> TetrisTransition:
+        return TetrisTransition.construct(
+            state=self._getState(slot, new=False),
+            action=ACTIONS[self.actions[slot]].value,
+            newState=self._getState(slot, new=True),
+            reward=float(self.rewards[slot]),
+        )
+
+    def _getDbRow(self, slot: int) -> TetrisDataDbRow:
+        return TetrisDataDbRow(
+            self._getBoard(slot, new=False).tobytes(),
+            int(self.scores[slot, 0]),
+            PIECES[self.pieces[slot, 0, 0]].value,
+            PIECES[self.pieces[slot, 0, 1]].value,
+            bool(self.terminals[slot, 0]),
+            ACTIONS[self.actions[slot]].value,
+            self._getBoard(slot, new=True).tobytes(),
+            int(self.scores[slot, 1]),
+            PIECES[self.pieces[slot, 1, 0]].value,
+            PIECES[self.pieces[slot, 1, 1]].value,
+            bool(self.terminals[slot, 1]),
+            float(self.rewards[slot]),
+        )
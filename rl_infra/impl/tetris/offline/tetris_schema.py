@@ -22,8 +22,9 @@ class TetrisOnlineMetrics(OnlineMetrics):
 class TetrisOfflineMetrics(OfflineMetrics):
     numBatchesTrained: int
     avgBatchLoss: float
-    validationEpisodeId: int
-    valEpisodeAvgMaxQ: float  # TODO: This needs a better name
+    validationEpisodeId: int  # The newest of the validation episodes
+    valEpisodeAvgMaxQ: float  # TODO: This needs a better name.  The mean of valEpisodeAvgMaxQs
+    valEpisodeAvgMaxQs: dict[int, float] = {}  # Average max Q over the states of each validation episode, by id
 
 
 class TetrisModelDbRow(NamedTuple):
@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+from typing import Any, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+from rl_infra.impl.tetris.offline.tetris_data_schema import ACTIONS, PIECES
+from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService, drawIndexArray
+from rl_infra.impl.tetris.online.tetris_transition import BOARD_SHAPE, TetrisAction, TetrisState, TetrisTransition
+from rl_infra.types.offline import TransitionBatch
+from rl_infra.types.online.transition import Transition
+
+logger = logging.getLogger(__name__)
+
+# Everything about a transition except its boards.  The second axis of score, pieces and terminal is (state,
+# newState), and the last axis of pieces is (active, next), as in TetrisRingDataService.
+SHARD_META_DTYPE = np.dtype(
+    [
+        ("action", np.uint8),
+        ("reward", np.float32),
+        ("score", np.int32, (2,)),
+        ("pieces", np.uint8, (2, 2)),
+        ("terminal", np.bool_, (2,)),
+        ("episode", np.int64),
+    ]
+)
+SIGNS = (-1, 0, 1)
+
+
+class TetrisShardDataService(TetrisDataService):
+    """Replay buffer stored on disk as fixed-record .npy shards of shardSize transitions each, so that it can grow past
+    RAM.  Shard k holds transitions k * shardSize, ..., (k + 1) * shardSize - 1 (numbered in push order) in three
+    memory-mapped files: the state boards, the next frame of each new state (newState.board is always [next frame,
+    state.board[0]]), and the remaining fields as a SHARD_META_DTYPE record.  index.json records how many transitions
+    were pushed and which are still live.  Validation episodes are served from data.db as usual.
+
+    Sampling reads boards through the page cache.  sample builds each state's board as a view of its shard (and each
+    new state's board as a stacked copy), while sampleBatch copies the sampled rows of each shard into the batch
+    arrays with one fancy-indexing gather, and copies the state boards once more when stacking them into nextStates.
+    Shards are never rewritten, only appended to and deleted, so the views stay valid.
+
+    keepNewRowsDeleteOld marks the rows of a sign older than its newest `capacity` as evicted, and deletes the shards in
+    which every row is evicted, so disk space is reclaimed a shard at a time.  The number of live rows of each sign and
+    the offsets of each sign within the shard being filled are kept up to date as rows are pushed, so a push only
+    touches the rows it writes, and evicts only once a sign exceeds capacity."""
+
+    shardPath: str
+    shardSize: int
+    numPushed: int
+    firstShard: int
+    signStart: dict[int, int]
+    nextEpisodeId: int
+    rng: np.random.Generator
+    boards: dict[int, NDArray[np.uint8]]
+    nextFrames: dict[int, NDArray[np.uint8]]
+    meta: dict[int, NDArray[Any]]
+    signOffsets: dict[int, dict[int, NDArray[np.int64]]]
+    openShard: int | None  # The shard whose sign offsets are views of openSignOffsets
+    openSignOffsets: dict[int, NDArray[np.int64]]
+    liveCounts: dict[int, int]
+
+    def __init__(
+        self,
+        rootPath: str | None = None,
+        capacity: int = 10000,
+        shardSize: int = 2**16,
+        seed: int | None = None,
+        stratified: bool = False,
+        autoEvictSigns: Sequence[int] = (),
+    ) -> None:
+        super().__init__(rootPath=rootPath, capacity=capacity, stratified=stratified, autoEvictSigns=autoEvictSigns)
+        if shardSize <= 0:
+            raise ValueError("shardSize must be positive")
+        self.shardPath = f"{os.path.dirname(self.dbPath)}/shards"
+        os.makedirs(self.shardPath, exist_ok=True)
+        self.rng = np.random.default_rng(seed)
+        self.boards = {}
+        self.nextFrames = {}
+        self.meta = {}
+        # Per shard and sign, the offsets within the shard of the rows with that sign.  Built lazily, except for the
+        # shard being filled, whose offsets are appended to as rows are pushed.
+        self.signOffsets = {}
+        self.openShard = None
+        self.openSignOffsets = {}
+        self.shardSize = shardSize
+        self.numPushed = 0
+        self.firstShard = 0
+        self.signStart = {sgn: 0 for sgn in SIGNS}
+        self.nextEpisodeId = 0
+        self.liveCounts = {sgn: 0 for sgn in SIGNS}
+        if os.path.exists(self.indexPath):
+            self._readIndex()
+            if self.shardSize != shardSize:
+                raise ValueError(f"{self.shardPath} was written with shardSize {self.shardSize}, not {shardSize}")
+            self.liveCounts = {
+                sgn: sum(len(offsets) for _, offsets in self._getLiveSignOffsets(sgn)) for sgn in SIGNS
+            }
+            logger.info(f"Opened {self.numLive} transitions in {self.shardPath}")
+
+    @property
+    def indexPath(self) -> str:
+        return f"{self.shardPath}/index.json"
+
+    @property
+    def numLive(self) -> int:
+        return sum(self.liveCounts.values())
+
+    def pushTransitions(self, transitions: Sequence[Transition[TetrisState, TetrisAction]]) -> None:
+        if len(transitions) == 0:
+            return
+        boards = np.stack([move.state.board for move in transitions])
+        nextFrames = np.stack([move.newState.board[0] for move in transitions])
+        meta = np.zeros(len(transitions), dtype=SHARD_META_DTYPE)
+        meta["action"] = [ACTIONS.index(move.action) for move in transitions]
+        meta["reward"] = [move.reward for move in transitions]
+        meta["score"] = [(move.state.score, move.newState.score) for move in transitions]
+        meta["pieces"] = [
+            [(PIECES.index(state.activePiece), PIECES.index(state.nextPiece)) for state in (move.state, move.newState)]
+            for move in transitions
+        ]
+        meta["terminal"] = [(move.state.isTerminal, move.newState.isTerminal) for move in transitions]
+        meta["episode"] = self.nextEpisodeId
+
+        written = 0
+        while written < len(transitions):
+            shard, offset = divmod(self.numPushed, self.shardSize)
+            count = min(len(transitions) - written, self.shardSize - offset)
+            self._openShard(shard, create=offset == 0)
+            self.boards[shard][offset : offset + count] = boards[written : written + count]
+            self.nextFrames[shard][offset : offset + count] = nextFrames[written : written + count]
+            self.meta[shard][offset : offset + count] = meta[written : written + count]
+            for arr in (self.boards[shard], self.nextFrames[shard], self.meta[shard]):
+                _flushRows(arr, offset, offset + count)
+            self._appendSignOffsets(shard, offset, meta["reward"][written : written + count])
+            written += count
+            self.numPushed += count
+        # Only publish the new rows once they are written
+        self._writeIndex()
+        for sgn in self.autoEvictSigns:
+            if self.liveCounts[sgn] > self.capacity:
+                self.keepNewRowsDeleteOld(sgn)
+
+    def finishEpisode(self) -> None:
+        self.nextEpisodeId += 1
+        self._writeIndex()
+
+    def sample(self, batchSize: int) -> Sequence[Transition[TetrisState, TetrisAction]]:
+        return [self._getTransition(row) for row in self._drawRows(batchSize)]
+
+    def sampleBatch(self, batchSize: int) -> TransitionBatch:
+        with self.timer.time("sample", batchSize):
+            rows = self._drawRows(batchSize)
+        # Gathering from the memory-mapped shards, which may read them from disk, counts as decoding
+        with self.timer.time("decode", batchSize):
+            states = np.empty((len(rows),) + BOARD_SHAPE, dtype=np.uint8)
+            nextFrames = np.empty((len(rows),) + BOARD_SHAPE[1:], dtype=np.uint8)
+            meta = np.empty(len(rows), dtype=SHARD_META_DTYPE)
+            shards, offsets = np.divmod(rows, self.shardSize)
+            # One gather per shard rather than per row
+            for shard in np.unique(shards):
+                inShard = shards == shard
+                states[inShard] = self.boards[shard][offsets[inShard]]
+                nextFrames[inShard] = self.nextFrames[shard][offsets[inShard]]
+                meta[inShard] = self.meta[shard][offsets[inShard]]
+            return TransitionBatch(
+                states=states,
+                actions=meta["action"].astype(np.int64),
+                rewards=meta["reward"],
+                nextStates=np.stack([nextFrames, states[:, 0]], axis=1),
+                nonFinalMask=~meta["terminal"][:, 0],
+            )
+
+    def keepNewRowsDeleteOld(self, sgn: int = 0) -> None:
+        logger.info(f"Removing all but {self.capacity} rows with reward sign {sgn}")
+        if sgn not in SIGNS:
+            raise KeyError("sgn must be one of {-1, 0, 1}")
+        numEvicted = self.liveCounts[sgn] - self.capacity
+        if numEvicted <= 0:
+            return
+        self.signStart[sgn] = self._getLiveRow(sgn, numEvicted)
+        self.liveCounts[sgn] = self.capacity
+        # Shards before the first live row of every sign are no longer read
+        firstLiveRows = [self._getLiveRow(s, 0) if self.liveCounts[s] > 0 else self.numPushed for s in SIGNS]
+        firstShard = min(firstLiveRows) // self.shardSize
+        self.signStart = {s: max(start, firstShard * self.shardSize) for s, start in self.signStart.items()}
+        self._writeIndex(firstShard=firstShard)
+        for shard in range(self.firstShard, firstShard):
+            self._deleteShard(shard)
+        self.firstShard = firstShard
+
+    def _drawRows(self, batchSize: int) -> NDArray[np.int64]:
+        logger.info(f"Sampling {'stratified' if self.stratified else 'uniform'} batch of {batchSize} transitions")
+        counts = np.array([self.liveCounts[sgn] for sgn in SIGNS])
+        if counts.sum() == 0:
+            raise KeyError("No transitions to sample")
+        if self.stratified:
+            # Without replacement within each sign unless it has too few rows, as TetrisDataService does
+            present = np.flatnonzero(counts > 0)
+            quotas = np.zeros(len(SIGNS), dtype=np.int64)
+            quotas[present] = batchSize // len(present)
+            quotas[self.rng.choice(present, batchSize % len(present), replace=False)] += 1
+            ranks = [drawIndexArray(self.rng, counts[i], quotas[i]) for i in range(len(SIGNS))]
+        else:
+            quotas = np.bincount(
+                np.searchsorted(np.cumsum(counts), self.rng.integers(0, counts.sum(), batchSize), side="right"),
+                minlength=len(SIGNS),
+            )
+            ranks = [self.rng.integers(0, counts[i], quotas[i]) for i in range(len(SIGNS))]
+        rows = np.concatenate([self._getLiveRows(sgn, ranks[i]) for i, sgn in enumerate(SIGNS) if quotas[i] > 0])
+        return self.rng.permutation(rows)
+
+    def _shardFiles(self, shard: int) -> tuple[str, str, str]:
+        stub = f"{self.shardPath}/{shard:06d}"
+        return f"{stub}_boards.npy", f"{stub}_next_frames.npy", f"{stub}_meta.npy"
+
+    def _openShard(self, shard: int, create: bool = False) -> None:
+        if shard in self.boards:
+            return
+        boardsFile, nextFramesFile, metaFile = self._shardFiles(shard)
+        if create:
+            logger.info(f"Creating replay shard {shard} in {self.shardPath}")
+            openMemmap: Any = np.lib.format.open_memmap
+            self.boards[shard] = openMemmap(
+                boardsFile, mode="w+", dtype=np.uint8, shape=(self.shardSize,) + BOARD_SHAPE
+            )
+            self.nextFrames[shard] = openMemmap(
+                nextFramesFile, mode="w+", dtype=np.uint8, shape=(self.shardSize,) + BOARD_SHAPE[1:]
+            )
+            self.meta[shard] = openMemmap(metaFile, mode="w+", dtype=SHARD_META_DTYPE, shape=(self.shardSize,))
+        else:
+            self.boards[shard] = np.load(boardsFile, mmap_mode="r+")
+            self.nextFrames[shard] = np.load(nextFramesFile, mmap_mode="r+")
+            self.meta[shard] = np.load(metaFile, mmap_mode="r+")
+
+    def _deleteShard(self, shard: int) -> None:
+        logger.info(f"Deleting replay shard {shard} in {self.shardPath}")
+        for arrays in (self.boards, self.nextFrames, self.meta):
+            arrays.pop(shard, None)
+        self.signOffsets.pop(shard, None)
+        if shard == self.openShard:
+            self.openShard = None
+        for file in self._shardFiles(shard):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def _getSignOffsets(self, shard: int, sgn: int) -> NDArray[np.int64]:
+        """Returns the offsets within shard of the pushed rows with reward sign sgn, ignoring eviction."""
+        if shard not in self.signOffsets:
+            self._openShard(shard)
+            numRows = min(self.numPushed - shard * self.shardSize, self.shardSize)
+            signs = np.sign(self.meta[shard]["reward"][:numRows])
+            self.signOffsets[shard] = {s: np.flatnonzero(signs == s) for s in SIGNS}
+        return self.signOffsets[shard][sgn]
+
+    def _appendSignOffsets(self, shard: int, offset: int, rewards: NDArray[np.float32]) -> None:
+        """Records the signs of rewards, just written to shard from offset on, in the shard's sign offsets and the
+        live counts.  Must be called before numPushed counts the new rows."""
+        if shard != self.openShard:
+            # The offsets of a filled shard no longer grow, so they are trimmed to copies of their own
+            if self.openShard in self.signOffsets:
+                self.signOffsets[self.openShard] = {
+                    sgn: offsets.copy() for sgn, offsets in self.signOffsets[self.openShard].items()
+                }
+            self.openSignOffsets = {sgn: np.empty(self.shardSize, dtype=np.int64) for sgn in SIGNS}
+            for sgn in SIGNS:
+                offsets = self._getSignOffsets(shard, sgn)
+                self.openSignOffsets[sgn][: len(offsets)] = offsets
+            self.openShard = shard
+        signs = np.sign(rewards)
+        shardOffsets = self.signOffsets.setdefault(shard, {})
+        for sgn in SIGNS:
+            newOffsets = offset + np.flatnonzero(signs == sgn)
+            numOffsets = len(shardOffsets.get(sgn, ()))
+            self.openSignOffsets[sgn][numOffsets : numOffsets + len(newOffsets)] = newOffsets
+            shardOffsets[sgn] = self.openSignOffsets[sgn][: numOffsets + len(newOffsets)]
+            self.liveCounts[sgn] += len(newOffsets)
+
+    def _getLiveSignOffsets(self, sgn: int) -> list[tuple[int, NDArray[np.int64]]]:
+        """Returns (shard, offsets) of the live rows with reward sign sgn, oldest first."""
+        lastShard = (self.numPushed - 1) // self.shardSize
+        res = []
+        for shard in range(self.signStart[sgn] // self.shardSize, lastShard + 1):
+            offsets = self._getSignOffsets(shard, sgn)
+            if shard * self.shardSize < self.signStart[sgn]:
+                offsets = offsets[offsets >= self.signStart[sgn] - shard * self.shardSize]
+            res.append((shard, offsets))
+        return res
+
+    def _getLiveRows(self, sgn: int, ranks: NDArray[np.int64]) -> NDArray[np.int64]:
+        """Maps ranks in 0, ..., liveCounts[sgn] - 1 (oldest first) to row numbers."""
+        liveOffsets = self._getLiveSignOffsets(sgn)
+        ends = np.cumsum([len(offsets) for _, offsets in liveOffsets])
+        shardIndices = np.searchsorted(ends, ranks, side="right")
+        rows = np.empty(len(ranks), dtype=np.int64)
+        # One lookup per shard rather than per rank
+        for shardIdx in np.unique(shardIndices):
+            inShard = shardIndices == shardIdx
+            shard, offsets = liveOffsets[shardIdx]
+            rows[inShard] = shard * self.shardSize + offsets[ranks[inShard] - (ends[shardIdx] - len(offsets))]
+        return rows
+
+    def _getLiveRow(self, sgn: int, rank: int) -> int:
+        """Maps one rank to its row number like _getLiveRows, but only reads the shards up to the row's, so that
+        finding the oldest live rows does not depend on the number of shards."""
+        shard = self.signStart[sgn] // self.shardSize
+        while True:
+            offsets = self._getSignOffsets(shard, sgn)
+            if shard * self.shardSize < self.signStart[sgn]:
+                offsets = offsets[offsets >= self.signStart[sgn] - shard * self.shardSize]
+            if rank < len(offsets):
+                return shard * self.shardSize + int(offsets[rank])
+            rank -= len(offsets)
+            shard += 1
+
+    def _getState(self, row: int, new: bool) -> TetrisState:
+        shard, offset = divmod(row, self.shardSize)
+        meta = self.meta[shard][offset]
+        if new:
+            board = np.stack([self.nextFrames[shard][offset], self.boards[shard][offset, 0]])
+        else:
+            board = self.boards[shard][offset]
+        # Built without validation, since the fields come from arrays this class wrote
+        return TetrisState.construct(
+            board=board,
+            score=int(meta["score"][int(new)]),
+            activePiece=PIECES[meta["pieces"][int(new), 0]],
+            nextPiece=PIECES[meta["pieces"][int(new), 1]],
+            isTerminal=bool(meta["terminal"][int(new)]),
+        )
+
+    def _getTransition(self, row: int) -> TetrisTransition:
+        shard, offset = divmod(row, self.shardSize)
+        meta = self.meta[shard][offset]
+        return TetrisTransition.construct(
+            state=self._getState(row, new=False),
+            action=ACTIONS[meta["action"]].value,
+            newState=self._getState(row, new=True),
+            reward=float(meta["reward"]),
+        )
+
+    def _readIndex(self) -> None:
+        with open(self.indexPath) as f:
+            index = json.load(f)
+        self.shardSize = index["shardSize"]
+        self.numPushed = index["numPushed"]
+        self.firstShard = index["firstShard"]
+        self.signStart = {int(sgn): start for sgn, start in index["signStart"].items()}
+        self.nextEpisodeId = index["nextEpisodeId"]
+
+    def _writeIndex(self, firstShard: int | None = None) -> None:
+        index = {
+            "shardSize": self.shardSize,
+            "numPushed": self.numPushed,
+            "firstShard": self.firstShard if firstShard is None else firstShard,
+            "signStart": self.signStart,
+            "nextEpisodeId": self.nextEpisodeId,
+        }
+        # Write and rename, so that a crash never leaves a partial index behind
+        with open(f"{self.indexPath}.tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{self.indexPath}.tmp", self.indexPath)
+
+
+def _flushRows(arr: NDArray[Any], start: int, stop: int) -> None:
+    """Writes rows start, ..., stop - 1 of the np.memmap arr to disk, rather than every dirty page of its file."""
+    rowBytes = arr.strides[0]
+    # np.memmap maps the file from the allocation granularity boundary before the array's data
+    dataStart = arr.offset % mmap.ALLOCATIONGRANULARITY  # pyright: ignore
+    begin = dataStart + start * rowBytes
+    pageStart = begin - begin % mmap.PAGESIZE
+    arr.base.flush(pageStart, dataStart + stop * rowBytes - pageStart)  # pyright: ignore
@@ -1,41 +1,141 @@
+from __future__ import annotations
+
 import logging
-from typing import Any, Sequence
+import os
+from contextlib import contextmanager
+from multiprocessing.queues import Queue
+from typing import Any, Iterator, NamedTuple, Sequence
 
 import torch
+import torch.distributed as dist
 from tetris.config import BOARD_SIZE
 from torch import Tensor
-from torch.nn import MSELoss
 from torch.optim import Optimizer, RMSprop
 
+from rl_infra.impl.tetris.offline.batch_collator import BatchCollator, TetrisTrainingBatch
+from rl_infra.impl.tetris.offline.batch_prefetcher import BatchPrefetcher, PrefetchStats
+from rl_infra.impl.tetris.offline.data_parallel import DataParallelGroup, allReduceSum, broadcastTensors, shardSizes
 from rl_infra.impl.tetris.offline.dqn import DeepQNetwork
+from rl_infra.impl.tetris.offline.phase_timer import PhaseStats, PhaseTimer
+from rl_infra.impl.tetris.offline.target_updater import TargetUpdater
 from rl_infra.impl.tetris.offline.tetris_data_service import TetrisDataService
 from rl_infra.impl.tetris.offline.tetris_model_service import TetrisModelService
 from rl_infra.impl.tetris.offline.tetris_schema import TetrisOfflineMetrics
-from rl_infra.impl.tetris.online.tetris_agent import TetrisAgent
 from rl_infra.impl.tetris.online.tetris_transition import TetrisAction, TetrisState
+from rl_infra.types.offline.data_service import PrioritizedDataService
 from rl_infra.types.offline.model_service import ModelDbKey
 from rl_infra.types.offline.training_service import TrainingService
-from rl_infra.types.online.transition import Transition
 
 FUTURE_REWARDS_DISCOUNT = 0.99
 TAU = 1  # Soft update interpolation factor.  Set to 1 for hard update (no interpolation)
+TARGET_UPDATE_INTERVAL = 1  # Number of batches between target network updates
+VALIDATION_CHUNK_SIZE = 1024  # Number of validation states per forward pass, which bounds validation's memory
+IMPORTANCE_SAMPLING_BETA = 0.4  # Initial correction for the bias of prioritized sampling.  1 corrects it fully.
+BETA_ANNEALING_EPOCHS = 100  # Number of epochs over which the correction is annealed linearly to 1
 
 logger = logging.getLogger(__name__)
 
 
+class _TrainCommand(NamedTuple):
+    """Sent by rank 0 to the data parallel workers before each epoch.  The weights and optimizer state are broadcast
+    separately (see TetrisTrainingService._broadcastTrainingState)."""
+
+    numTargetUpdateSteps: int
+    batchSize: int
+    numBatches: int
+
+
+class _StateTensorSpec(NamedTuple):
+    shape: tuple[int, ...]
+    dtype: torch.dtype
+
+
+class ValidationResult(NamedTuple):
+    avgMaxQ: float  # The mean of episodeAvgMaxQs, so that every episode counts the same regardless of its length
+    episodeAvgMaxQs: dict[int, float]  # Average max Q over the states of each episode, by episode id
+
+
 class TetrisTrainingService(TrainingService[DeepQNetwork, TetrisModelService, TetrisDataService]):
     modelInitArgs: dict[str, Any]
     optimizerInitialArgs: dict[str, Any]
+    prefetchDepth: int
+    prioritizedReplay: PrioritizedDataService[TetrisState, TetrisAction] | None
+    betaAnnealingEpochs: int
+    importanceSamplingBeta: float  # For the current epoch
+    collator: BatchCollator
+    targetUpdater: TargetUpdater
+    lastPrefetchStats: PrefetchStats | None
+    timer: PhaseTimer
+    lastPhaseStats: list[PhaseStats]
+    sessionKey: ModelDbKey | None
+    checkpointInterval: int
+    epochsSinceCheckpoint: int
+    numValidationEpisodes: int
+    validationChunkSize: int
+    dataParallelGroup: DataParallelGroup | None
+    rank: int
+    worldSize: int
 
-    def __init__(self, device: torch.device) -> None:
+    def __init__(
+        self,
+        device: torch.device,
+        dataService: TetrisDataService | None = None,
+        prefetchDepth: int = 2,
+        tau: float = TAU,
+        targetUpdateInterval: int = TARGET_UPDATE_INTERVAL,
+        executionMode: str = "eager",
+        numValidationEpisodes: int = 1,
+        validationChunkSize: int = VALIDATION_CHUNK_SIZE,
+        recordTimings: bool = False,
+        prioritized: bool = False,
+        betaAnnealingEpochs: int = BETA_ANNEALING_EPOCHS,
+    ) -> None:
+        """prefetchDepth is the number of batches sampled and collated ahead of training on a background thread.  Set
+        it to 0 to sample each batch right before training on it.  The target network is updated towards the policy
+        network by tau every targetUpdateInterval batches.  executionMode is how the models run, one of
+        EXECUTION_MODES.  Each epoch is validated on the newest numValidationEpisodes validation episodes, running
+        validationChunkSize states at a time.  With recordTimings, the time spent in each phase of an epoch is
+        published to the training_timings table of model.db, and kept in lastPhaseStats.  With prioritized, batches are
+        drawn by priority, which the data service must support (see PrioritizedDataService), and the priorities are
+        updated with each batch's TD errors.  The importance sampling weights correcting for the bias of prioritized
+        sampling start at exponent IMPORTANCE_SAMPLING_BETA, which is annealed linearly to 1 (full correction) by epoch
+        betaAnnealingEpochs."""
+        if numValidationEpisodes <= 0:
+            raise ValueError("numValidationEpisodes must be positive")
+        if validationChunkSize <= 0:
+            raise ValueError("validationChunkSize must be positive")
+        if betaAnnealingEpochs < 0:
+            raise ValueError("betaAnnealingEpochs must not be negative")
         self.modelService = TetrisModelService()
-        self.dataService = TetrisDataService()
+        self.dataService = dataService if dataService is not None else TetrisDataService()
+        self.prioritizedReplay = None
+        if prioritized:
+            if not isinstance(self.dataService, PrioritizedDataService) or not self.dataService.prioritized:
+                raise ValueError(
+                    f"Prioritized training requires a data service with prioritized sampling enabled, such as "
+                    f"TetrisRingDataService(prioritized=True).  Received {type(self.dataService).__name__}"
+                )
+            self.prioritizedReplay = self.dataService
+        self.betaAnnealingEpochs = betaAnnealingEpochs
+        self.importanceSamplingBeta = IMPORTANCE_SAMPLING_BETA
         self.device = device
+        self.prefetchDepth = prefetchDepth
+        # Batches are collated into pinned memory on CUDA, so that copying them to the device can overlap compute
+        self.collator = BatchCollator(pinMemory=device.type == "cuda", numBuffers=prefetchDepth + 2)
+        self.targetUpdater = TargetUpdater(tau=tau, interval=targetUpdateInterval)
+        self.lastPrefetchStats = None
+        self.timer = PhaseTimer(enabled=recordTimings)
+        # The data service times its sample and decode phases into the same timer
+        self.dataService.timer = self.timer
+        self.lastPhaseStats = []
+        self.numValidationEpisodes = numValidationEpisodes
+        self.validationChunkSize = validationChunkSize
         self.modelInitArgs = {
             "arrayHeight": BOARD_SIZE[0],
             "arrayWidth": BOARD_SIZE[1] + 1,
             "numOutputs": 5,
             "device": self.device,
+            "executionMode": executionMode,
         }
         self.optimizerInitialArgs = {
             "lr": 1e-4,
@@ -48,6 +148,12 @@ class TetrisTrainingService(TrainingService[DeepQNetwork, TetrisModelService, Te
         }
         self.policyModel = None
         self.optimizer = None
+        self.sessionKey = None
+        self.checkpointInterval = 0
+        self.epochsSinceCheckpoint = 0
+        self.dataParallelGroup = None
+        self.rank = 0
+        self.worldSize = 1
 
     def modelFactory(self) -> DeepQNetwork:
         return DeepQNetwork(**self.modelInitArgs)
@@ -79,110 +185,339 @@ class TetrisTrainingService(TrainingService[DeepQNetwork, TetrisModelService, Te
     ) -> None:
         if numBatches <= 0:
             raise ValueError("numBatches must be positive")
+        if batchSize <= 0:
+            raise ValueError("batchSize must be positive")
         entry = self.modelService.getModelEntry(modelDbKey)
         if entry is None:
             raise KeyError(f"ModelDbKey {modelDbKey} not found")
-        self.policyModel = self.modelFactory()
-        self.policyModel.load_state_dict(torch.load(modelDbKey.policyModelLocation))
-        self.targetModel = self.modelFactory()
-        self.targetModel.load_state_dict(torch.load(modelDbKey.targetModelLocation))
-        self.optimizer = self.optimizerFactory()
-        self.optimizer.load_state_dict(torch.load(modelDbKey.optimizerLocation))
+        if self.sessionKey is None:
+            self._loadModels(modelDbKey)
+        elif self.sessionKey != modelDbKey:
+            raise ValueError(f"Cannot train {modelDbKey} during a session for {self.sessionKey}")
 
-        trainingLosses: list[float] = []
-        for _ in range(numBatches):
-            trainLoss = self._performBackpropOnBatch(batchSize)
-            trainingLosses.append(trainLoss)
-            self._softUpdateTargetModel()
+        self.timer.reset()
+        self.importanceSamplingBeta = self.annealedBeta(epochNumber)
+        with self.timer.time("train", batchSize * numBatches):
+            trainingLosses = self._trainBatches(batchSize, numBatches)
         avgBatchLoss = sum(trainingLosses) / numBatches
-        avgMaxQ, id = self.validateOnEpisode(validationEpisodeId)
+        with self.timer.time("validation"):
+            validation = self.validateOnEpisodes(None if validationEpisodeId is None else [validationEpisodeId])
+        logger.info(f"Validation average max Q: {validation.avgMaxQ:.4f}, by episode: {validation.episodeAvgMaxQs}")
 
         offlineMetrics = TetrisOfflineMetrics(
             epochNumber=epochNumber,
             numBatchesTrained=numBatches,
-            validationEpisodeId=id,
+            validationEpisodeId=max(validation.episodeAvgMaxQs),
             avgBatchLoss=avgBatchLoss,
-            valEpisodeAvgMaxQ=avgMaxQ,
+            valEpisodeAvgMaxQ=validation.avgMaxQ,
+            valEpisodeAvgMaxQs=validation.episodeAvgMaxQs,
         )
         self.modelService.publishOfflineMetrics(modelDbKey, offlineMetrics)
-        self.modelService.updateModelWeights(
-            entry.modelDbKey,
-            policyModel=self.policyModel,
-            targetModel=self.targetModel,
-            optimizer=self.optimizer,
-        )
+        self.epochsSinceCheckpoint += 1
+        if self.sessionKey is None or self.epochsSinceCheckpoint >= self.checkpointInterval:
+            self.checkpoint(entry.modelDbKey)
+        if self.timer.enabled:
+            self.lastPhaseStats = self.timer.stats()
+            self.modelService.publishTrainingTimings(modelDbKey, epochNumber, self.lastPhaseStats)
+
+    def annealedBeta(self, epochNumber: int) -> float:
+        """Returns the importance sampling exponent of prioritized replay for epochNumber."""
+        if epochNumber >= self.betaAnnealingEpochs:
+            return 1.0
+        return IMPORTANCE_SAMPLING_BETA + (1 - IMPORTANCE_SAMPLING_BETA) * epochNumber / self.betaAnnealingEpochs
+
+    def startSession(self, modelDbKey: ModelDbKey, checkpointInterval: int = 1) -> None:
+        """Loads the models and optimizer once, and keeps them in memory for every retrainAndPublish of modelDbKey
+        until endSession, instead of loading and saving them on every call.  Weights are saved after every
+        checkpointInterval epochs, and when the session ends."""
+        if checkpointInterval <= 0:
+            raise ValueError("checkpointInterval must be positive")
+        if self.sessionKey is not None:
+            raise RuntimeError(f"A training session for {self.sessionKey} is already in progress")
+        self._loadModels(modelDbKey)
+        self.sessionKey = modelDbKey
+        self.checkpointInterval = checkpointInterval
+        self.epochsSinceCheckpoint = 0
+        logger.info(f"Started training session for {modelDbKey}, checkpointing every {checkpointInterval} epochs")
+
+    def endSession(self) -> None:
+        """Saves any epochs trained since the last checkpoint, and ends the session."""
+        if self.sessionKey is None:
+            return
+        if self.epochsSinceCheckpoint > 0:
+            self.checkpoint(self.sessionKey)
+        logger.info(f"Ended training session for {self.sessionKey}")
+        self.sessionKey = None
+
+    @contextmanager
+    def session(self, modelDbKey: ModelDbKey, checkpointInterval: int = 1) -> Iterator[TetrisTrainingService]:
+        """startSession and endSession as a context manager, so that the last epochs are saved even if training is
+        interrupted."""
+        self.startSession(modelDbKey, checkpointInterval)
+        try:
+            yield self
+        finally:
+            self.endSession()
+
+    @contextmanager
+    def dataParallel(self, numWorkers: int) -> Iterator[TetrisTrainingService]:
+        """Trains every batch with numWorkers local processes (including this one) until the context exits.  Each
+        samples and computes gradients on a shard of the batch, and the gradients are summed with an all-reduce before
+        every process takes the same optimizer step.  Workers sample from data.db, so this requires the sqlite data
+        backend, and only trains on CPU."""
+        if self.device.type != "cpu":
+            raise ValueError("Data parallel training is only supported on CPU")
+        if type(self.dataService) is not TetrisDataService:
+            raise ValueError("Data parallel training requires the sqlite data backend (TetrisDataService)")
+        if self.dataParallelGroup is not None:
+            raise RuntimeError("Data parallel training is already running")
+        dataServiceArgs = {
+            "rootPath": os.path.dirname(self.dataService.dbPath),
+            "stratified": self.dataService.stratified,
+        }
+        serviceArgs = {
+            "prefetchDepth": self.prefetchDepth,
+            "tau": self.targetUpdater.tau,
+            "targetUpdateInterval": self.targetUpdater.interval,
+            "executionMode": self.modelInitArgs["executionMode"],
+        }
+        with DataParallelGroup(numWorkers, _runTrainingWorker, dataServiceArgs, serviceArgs) as group:
+            self.dataParallelGroup = group
+            self.worldSize = numWorkers
+            try:
+                yield self
+            finally:
+                self.dataParallelGroup = None
+                self.worldSize = 1
+
+    def checkpoint(self, modelDbKey: ModelDbKey) -> None:
+        """Saves the models and optimizer to modelDbKey's weights location."""
+        logger.info(f"Saving weights after {self.epochsSinceCheckpoint} epochs to {modelDbKey.weightsLocation}")
+        with self.timer.time("checkpoint"):
+            self.modelService.updateModelWeights(
+                modelDbKey,
+                policyModel=self.policyModel,
+                targetModel=self.targetModel,
+                optimizer=self.optimizer,
+            )
+        self.epochsSinceCheckpoint = 0
 
     def validateOnEpisode(self, validationEpisodeId: int | None = None) -> tuple[float, int]:
+        """Returns the policy's average max Q over the states of one validation episode (by default the newest), and
+        the episode's id."""
+        if validationEpisodeId is None:
+            validationEpisodeId = self.dataService.getValidationEpisodeIds(1)[0]
+        validation = self.validateOnEpisodes([validationEpisodeId])
+        return validation.avgMaxQ, validationEpisodeId
+
+    def validateOnEpisodes(self, validationEpisodeIds: Sequence[int] | None = None) -> ValidationResult:
+        """Evaluates the policy's average max Q on each of the given validation episodes, by default the newest
+        numValidationEpisodes.  Runs without autograd, validationChunkSize states at a time."""
         if self.policyModel is None:
             raise RuntimeError("Policy model not initialized")
-        valEpisode = self.dataService.getValidationEpisode(validationEpisodeId)
-        episodeStateTensor = torch.concat([m.state.toDqnInput() for m in valEpisode.moves])
-        stateActionValues = self.policyModel(episodeStateTensor)
-        stateMaxQ = stateActionValues.max(1)[0]
-        avgMaxQ = stateMaxQ.mean().item()
-        return avgMaxQ, valEpisode.episodeNumber
-
-    def _performBackpropOnBatch(self, batchSize: int) -> float:
-        if batchSize <= 0:
-            raise ValueError("batchSize must be positive")
+        if validationEpisodeIds is None:
+            validationEpisodeIds = self.dataService.getValidationEpisodeIds(self.numValidationEpisodes)
+        if len(validationEpisodeIds) == 0:
+            raise ValueError("validationEpisodeIds must not be empty")
+        episodeAvgMaxQs = {}
+        with torch.inference_mode():
+            for episodeId in validationEpisodeIds:
+                episodeStateTensor, _ = self.dataService.getValidationTensor(episodeId)
+                maxQSum = 0.0
+                for chunk in episodeStateTensor.split(self.validationChunkSize):
+                    maxQSum += self.policyModel(chunk).max(1)[0].sum().item()
+                episodeAvgMaxQs[episodeId] = maxQSum / len(episodeStateTensor)
+        return ValidationResult(
+            avgMaxQ=sum(episodeAvgMaxQs.values()) / len(episodeAvgMaxQs), episodeAvgMaxQs=episodeAvgMaxQs
+        )
+
+    def _loadModels(self, modelDbKey: ModelDbKey) -> None:
+        self.policyModel = self.modelFactory()
+        self.targetModel = self.modelFactory()
+        self.optimizer = self.optimizerFactory()
+        self.modelService.loadModelWeights(
+            modelDbKey, policyModel=self.policyModel, targetModel=self.targetModel, optimizer=self.optimizer
+        )
+
+    def _trainBatches(self, batchSize: int, numBatches: int) -> list[float]:
+        """Trains numBatches batches of batchSize, returning their losses.  In data parallel training, rank 0 first
+        sends the command to the workers and broadcasts its weights and optimizer state, and every rank then trains on
+        its shard of each batch."""
+        if self.policyModel is None or self.targetModel is None or self.optimizer is None:
+            raise RuntimeError("Policy model, target model or optimizer not initialized")
+        if self.dataParallelGroup is not None:
+            self.dataParallelGroup.send(
+                _TrainCommand(
+                    numTargetUpdateSteps=self.targetUpdater.numSteps, batchSize=batchSize, numBatches=numBatches
+                )
+            )
+        if self.worldSize > 1:
+            self._broadcastTrainingState()
+        shardSize = shardSizes(batchSize, self.worldSize)[self.rank]
+        trainingLosses: list[float] = []
+        # With prioritized sampling, prefetched batches are drawn before the priorities of the batches ahead of them
+        # in the queue are updated.  That staleness is bounded by prefetchDepth.
+        with BatchPrefetcher(lambda: self._sampleBatch(shardSize), numBatches, self.prefetchDepth) as batches:
+            for batch in batches:
+                trainLoss = self._performBackpropOnBatch(batch.to(self.device), shardSize / batchSize)
+                trainingLosses.append(trainLoss)
+                with self.timer.time("target update"):
+                    self._updateTargetModel()
+        self.lastPrefetchStats = batches.stats
+        # Sampling runs ahead on the prefetching thread, so training only waits for the part of it that is not hidden
+        self.timer.add("batch wait", batches.stats.waitSeconds, count=batches.stats.numBatches)
+        logger.info(f"Batch prefetching: {batches.stats}")
+        return trainingLosses
+
+    def _sampleBatch(self, batchSize: int) -> TetrisTrainingBatch:
+        """Samples and collates a batch.  Runs on the prefetching thread, so it must not touch the models."""
+        if self.prioritizedReplay is not None:
+            beta = self.importanceSamplingBeta
+            batch, slots, weights = self.prioritizedReplay.samplePrioritizedBatch(batchSize, beta)
+            with self.timer.time("collate", batchSize):
+                return self.collator(batch, slots, weights)
+        batch = self.dataService.sampleBatch(batchSize)
+        with self.timer.time("collate", batchSize):
+            return self.collator(batch)
+
+    def _performBackpropOnBatch(self, batch: TetrisTrainingBatch, batchFraction: float = 1) -> float:
+        """batchFraction is the share of the whole batch that batch is in data parallel training.  Returns the loss of
+        the whole batch."""
         if self.policyModel is None or self.targetModel is None:
             raise RuntimeError("Policy model or target model not initialized")
-        batch = self.dataService.sample(batchSize)
-        loss = self._getBatchLoss(batch)
+        numSamples = len(batch.rewards)
+        with self.timer.time("forward", numSamples):
+            loss, tdErrors = self._getBatchLoss(batch)
 
         if self.optimizer is None:
             raise RuntimeError("Optimizer not initialized")
 
         # Optimize the model
         self.optimizer.zero_grad()
-        loss.backward()
-        # In-place gradient clipping
-        torch.nn.utils.clip_grad.clip_grad_value_(self.policyModel.parameters(), 100)
-        self.optimizer.step()
+        if self.worldSize > 1:
+            # Weighting each shard's mean loss by its share of the batch makes the sums across ranks, of the losses and
+            # of their gradients, those of the mean over the whole batch.
+            loss = loss * batchFraction
+            with self.timer.time("backward", numSamples):
+                loss.backward()
+            loss = loss.detach().reshape(1)
+            with self.timer.time("all-reduce"):
+                allReduceSum([param.grad for param in self.policyModel.parameters() if param.grad is not None] + [loss])
+        else:
+            with self.timer.time("backward", numSamples):
+                loss.backward()
+        with self.timer.time("optimizer step"):
+            # In-place gradient clipping
+            torch.nn.utils.clip_grad.clip_grad_value_(self.policyModel.parameters(), 100)
+            self.optimizer.step()
+
+        if batch.slots is not None:
+            if self.prioritizedReplay is None:
+                raise RuntimeError("Received a prioritized batch without prioritized replay enabled")
+            with self.timer.time("priority update", numSamples):
+                self.prioritizedReplay.updatePriorities(batch.slots, tdErrors.cpu().numpy())
 
         return loss.item()
 
-    def _getBatchLoss(self, batch: Sequence[Transition[TetrisState, TetrisAction]]) -> Tensor:
+    def _getBatchLoss(self, batch: TetrisTrainingBatch) -> tuple[Tensor, Tensor]:
+        """Returns the (optionally importance weighted) mean squared TD error of the batch, along with the detached
+        per-transition TD errors."""
         if self.policyModel is None or self.targetModel is None:
             raise RuntimeError("Policy model or target model not initialized")
-        nonFinalMask = torch.tensor(
-            tuple(map(lambda s: not s.state.isTerminal, batch)), device=self.device, dtype=torch.bool
-        )
-        nonFinalNextStates = torch.cat([elt.newState.toDqnInput() for elt in batch if not elt.state.isTerminal])
-
-        stateBatch = torch.cat([elt.state.toDqnInput() for elt in batch])
-        actionBatch = torch.tensor([TetrisAgent.possibleActions.index(elt.action) for elt in batch])
-        rewardBatch = torch.tensor([elt.reward for elt in batch])
 
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
         # columns of actions taken. These are the actions which would've been taken
         # for each batch state according to policy_net
-        stateActionValues = self.policyModel(stateBatch).gather(1, actionBatch.reshape(-1, 1)).reshape(-1)
+        stateActionValues = self.policyModel(batch.states).gather(1, batch.actions.reshape(-1, 1)).reshape(-1)
 
         # Compute V(s_{t+1}) for all next states.
         # Expected values of actions for non_final_next_states are computed based
         # on the "older" target_net; selecting their best reward with max(1)[0].
         # This is merged based on the mask, such that we'll have either the expected
         # state value or 0 in case the state was final.
-        nextStateValues = torch.zeros(len(batch), device=self.device)
+        nextStateValues = torch.zeros(len(batch.rewards), device=self.device)
         with torch.no_grad():
-            nextStateValues[nonFinalMask] = self.targetModel(nonFinalNextStates).max(1)[0]
+            nextStateValues[batch.nonFinalMask] = self.targetModel(batch.nonFinalNextStates).max(1)[0]
 
         # Compute expected Q values
-        expectedStateActionValues = (nextStateValues * FUTURE_REWARDS_DISCOUNT) + rewardBatch
+        expectedStateActionValues = (nextStateValues * FUTURE_REWARDS_DISCOUNT) + batch.rewards
 
         # Compute Training loss
-        criterion = MSELoss()
+        tdErrors = expectedStateActionValues - stateActionValues
+        if batch.weights is None:
+            return tdErrors.pow(2).mean(), tdErrors.detach()
+        return (batch.weights * tdErrors.pow(2)).mean(), tdErrors.detach()
 
-        return criterion(stateActionValues, expectedStateActionValues)
+    def _broadcastTrainingState(self) -> None:
+        """Replaces the weights and optimizer state of every data parallel rank with rank 0's.  The optimizer's
+        hyperparameters and the layout of its lazily created state are broadcast first, so that a worker whose state
+        differs (e.g. before its first step, or after rank 0 loaded a checkpoint) can recreate it before the tensors
+        are broadcast."""
+        if self.policyModel is None or self.targetModel is None or self.optimizer is None:
+            raise RuntimeError("Policy model, target model or optimizer not initialized")
+        params = [param for group in self.optimizer.param_groups for param in group["params"]]
+        layout = [_optimizerLayout(self.optimizer, params)]
+        dist.broadcast_object_list(layout, src=0)
+        groupArgs, stateSpecs = layout[0]
+        if self.rank != 0:
+            for group, args in zip(self.optimizer.param_groups, groupArgs):
+                group.update(args)
+            if stateSpecs != _optimizerLayout(self.optimizer, params)[1]:
+                logger.info(f"Recreating optimizer state of rank {self.rank} to match rank 0")
+                for param, specs in zip(params, stateSpecs):
+                    self.optimizer.state[param] = {
+                        key: torch.zeros(spec.shape, dtype=spec.dtype) if isinstance(spec, _StateTensorSpec) else spec
+                        for key, spec in specs.items()
+                    }
+        tensors = [
+            *self.policyModel.parameters(),
+            *self.policyModel.buffers(),
+            *self.targetModel.parameters(),
+            *self.targetModel.buffers(),
+        ]
+        for param in params:
+            state = self.optimizer.state[param]
+            tensors.extend(state[key] for key in sorted(state) if isinstance(state[key], Tensor))
+        broadcastTensors(tensors)
 
-    def _softUpdateTargetModel(self) -> None:
+    def _updateTargetModel(self) -> None:
         if self.policyModel is None or self.targetModel is None:
             raise RuntimeError("Policy model or target model not initialized")
-        # Soft update of the target network's weights
-        # θ′ ← τ θ + (1 −τ )θ′
-        targetModelStateDict = self.targetModel.state_dict()
-        policyModelStateDict = self.policyModel.state_dict()
-        for key in policyModelStateDict:
-            targetModelStateDict[key] = policyModelStateDict[key] * TAU + targetModelStateDict[key] * (1 - TAU)
-        self.targetModel.load_state_dict(targetModelStateDict)
+        self.targetUpdater.step(self.policyModel, self.targetModel)
+
+
+def _runTrainingWorker(
+    rank: int,
+    worldSize: int,
+    commandQueue: Queue[_TrainCommand | None],
+    dataServiceArgs: dict[str, Any],
+    serviceArgs: dict[str, Any],
+) -> None:
+    """Runs in each data parallel worker process, training on its shard of every batch rank 0 trains."""
+    trainingService = TetrisTrainingService(
+        torch.device("cpu"), dataService=TetrisDataService(**dataServiceArgs), **serviceArgs
+    )
+    trainingService.rank = rank
+    trainingService.worldSize = worldSize
+    trainingService.policyModel = trainingService.modelFactory()
+    trainingService.targetModel = trainingService.modelFactory()
+    trainingService.optimizer = trainingService.optimizerFactory()
+    while (command := commandQueue.get()) is not None:
+        trainingService.targetUpdater.numSteps = command.numTargetUpdateSteps
+        trainingService._trainBatches(command.batchSize, command.numBatches)
+
+
+def _optimizerLayout(
+    optimizer: Optimizer, params: Sequence[Tensor]
+) -> tuple[list[dict[str, Any]], list[dict[str, _StateTensorSpec | Any]]]:
+    """Returns the hyperparameters of each of optimizer's parameter groups, and the keys of each parameter's state
+    with the shape and dtype of its tensors, or the value of its plain values."""
+    groupArgs = [{key: value for key, value in group.items() if key != "params"} for group in optimizer.param_groups]
+    stateSpecs = [
+        {
+            key: _StateTensorSpec(tuple(value.shape), value.dtype) if isinstance(value, Tensor) else value
+            for key, value in optimizer.state[param].items()
+        }
+        for param in params
+    ]
+    return groupArgs, stateSpecs
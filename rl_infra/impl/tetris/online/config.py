@@ -1,5 +1,6 @@
 MODEL_ROOT_PATH = "data/online/model"
-MODEL_WEIGHTS_PATH = f"{MODEL_ROOT_PATH}/weights.pt"
+MODEL_CHECKPOINT_PATH = f"{MODEL_ROOT_PATH}/checkpoint.bin"
+MODEL_WEIGHTS_PATH = f"{MODEL_ROOT_PATH}/weights.pt"  # Models deployed before checkpoints were single files
 MODEL_ENTRY_PATH = f"{MODEL_ROOT_PATH}/entry.json"
 INITIAL_EPSILON = 1
 FINAL_EPSILON = 0.1
@@ -1,20 +1,24 @@
 import logging
 import math
+import os
 import random
 
 import torch
 from tetris.config import BOARD_SIZE
 
 from rl_infra.impl.tetris.offline.dqn import DeepQNetwork
+from rl_infra.impl.tetris.offline.tensor_checkpoint import loadCheckpoint
 from rl_infra.impl.tetris.offline.tetris_schema import TetrisModelDbEntry
 from rl_infra.impl.tetris.online.config import (
     EPSILON_DECAY_RATE,
     FINAL_EPSILON,
     INITIAL_EPSILON,
+    MODEL_CHECKPOINT_PATH,
     MODEL_ENTRY_PATH,
     MODEL_WEIGHTS_PATH,
 )
 from rl_infra.impl.tetris.online.tetris_transition import TetrisAction, TetrisState
+from rl_infra.types.offline.schema import POLICY_MODEL_SECTION
 from rl_infra.types.online.agent import Agent
 
 logger = logging.getLogger(__name__)
@@ -23,20 +27,32 @@ logger = logging.getLogger(__name__)
 class TetrisAgent(Agent[TetrisState, TetrisAction, DeepQNetwork]):
     possibleActions = list(sorted(TetrisAction))  # Make sure the models always see the same order
 
-    def __init__(self, device: torch.device) -> None:
+    def __init__(self, device: torch.device, executionMode: str = "eager") -> None:
         self.policy = DeepQNetwork(
             arrayHeight=BOARD_SIZE[0],
             arrayWidth=BOARD_SIZE[1] + 1,
             numOutputs=5,
             device=device,
+            executionMode=executionMode,
         )
-        self.policy.load_state_dict(torch.load(MODEL_WEIGHTS_PATH))
+        if os.path.exists(MODEL_CHECKPOINT_PATH):
+            checkpoint = loadCheckpoint(MODEL_CHECKPOINT_PATH, POLICY_MODEL_SECTION)
+            self.policy.load_state_dict(checkpoint[POLICY_MODEL_SECTION])
+        else:
+            # Deployed before checkpoints were single files
+            self.policy.load_state_dict(torch.load(MODEL_WEIGHTS_PATH))
         entry = TetrisModelDbEntry.parse_file(MODEL_ENTRY_PATH)
         self.dbKey = entry.modelDbKey
         self.numEpisodesPlayed = entry.numEpisodesPlayed
         self.numEpochsTrained = entry.numEpochsTrained
         self.epsilon = self._updateEpsilon()
 
+    def updatePolicy(self, policyModel: DeepQNetwork, numEpochsTrained: int) -> None:
+        """Copies the weights of a policy trained in this process, instead of redeploying them through the file
+        system."""
+        self.policy.load_state_dict(policyModel.state_dict())
+        self.numEpochsTrained = numEpochsTrained
+
     def startNewEpisode(self) -> None:
         self.numEpisodesPlayed += 1
         self.epsilon = self._updateEpsilon()
@@ -0,0 +1,58 @@
+"""2-bit packed encoding of tetris board frames.
+
+A frame is BOARD_SIZE[0] rows of BOARD_SIZE[1] playfield cells, plus a metadata column holding the index of the next
+piece in row 0 and the dead flag in row 1 (see TetrisEnvironment._updateBuffer).  Cells are 0 (empty), 1 (settled) or
+2 (active piece), so a packed frame is a header byte (next piece index | dead flag << 3), followed by the cells in
+row-major order at 2 bits each, 4 to a byte, lowest bits first.  For a 20x10 board that is 51 bytes instead of 220.
+
+Boards are stacks of frames, so packing an array of boards of shape (..., 2) + FRAME_SHAPE gives shape (..., 2,
+PACKED_FRAME_SIZE)."""
+
+from __future__ import annotations
+
+import numpy as np
+from numpy.typing import NDArray
+
+from rl_infra.impl.tetris.online.tetris_transition import BOARD_SHAPE
+
+FRAME_SHAPE = BOARD_SHAPE[1:]
+NUM_CELLS = FRAME_SHAPE[0] * (FRAME_SHAPE[1] - 1)
+PACKED_FRAME_SIZE = 1 + -(-NUM_CELLS // 4)
+
+_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+# Row b holds the 4 cells packed into byte b, so unpacking is a single gather
+_UNPACK_TABLE = (np.arange(256, dtype=np.uint8)[:, None] >> _SHIFTS) & 3
+
+
+def packFrames(frames: NDArray[np.uint8]) -> NDArray[np.uint8]:
+    """Packs frames of shape (...,) + FRAME_SHAPE into shape (..., PACKED_FRAME_SIZE).  Raises ValueError if a frame
+    holds values the encoding cannot represent."""
+    if frames.shape[-2:] != FRAME_SHAPE:
+        raise ValueError(f"Expected frames of shape (...,) + {FRAME_SHAPE}, received {frames.shape}")
+    batchShape = frames.shape[:-2]
+    flat = frames.reshape((-1,) + FRAME_SHAPE)
+    cells = flat[:, :, :-1].reshape(len(flat), NUM_CELLS)
+    meta = flat[:, :, -1]
+    if (cells > 3).any() or (meta[:, 0] > 7).any() or (meta[:, 1] > 1).any() or meta[:, 2:].any():
+        raise ValueError("Frames hold values that do not fit the packed board encoding")
+    quads = np.zeros((len(flat), 4 * (PACKED_FRAME_SIZE - 1)), dtype=np.uint8)
+    quads[:, :NUM_CELLS] = cells
+    quads = quads.reshape(len(flat), PACKED_FRAME_SIZE - 1, 4) << _SHIFTS
+    packed = np.empty((len(flat), PACKED_FRAME_SIZE), dtype=np.uint8)
+    packed[:, 0] = meta[:, 0] | (meta[:, 1] << 3)
+    packed[:, 1:] = np.bitwise_or.reduce(quads, axis=2)
+    return packed.reshape(batchShape + (PACKED_FRAME_SIZE,))
+
+
+def unpackFrames(packed: NDArray[np.uint8]) -> NDArray[np.uint8]:
+    """Inverse of packFrames."""
+    if packed.shape[-1] != PACKED_FRAME_SIZE:
+        raise ValueError(f"Expected packed frames of shape (..., {PACKED_FRAME_SIZE}), received {packed.shape}")
+    batchShape = packed.shape[:-1]
+    flat = packed.reshape(-1, PACKED_FRAME_SIZE)
+    frames = np.zeros((len(flat),) + FRAME_SHAPE, dtype=np.uint8)
+    cells = _UNPACK_TABLE[flat[:, 1:]].reshape(len(flat), 4 * (PACKED_FRAME_SIZE - 1))[:, :NUM_CELLS]
+    frames[:, :, :-1] = cells.reshape((len(flat), FRAME_SHAPE[0], FRAME_SHAPE[1] - 1))
+    frames[:, 0, -1] = flat[:, 0] & 7
+    frames[:, 1, -1] = flat[:, 0] >> 3
+    return frames.reshape(batchShape + FRAME_SHAPE)
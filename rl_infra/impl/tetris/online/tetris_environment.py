@@ -32,10 +32,14 @@ TetrisGameplayRecord = GameplayRecord[TetrisState, TetrisAction, TetrisOnlineMet
 class TetrisEnvironment(Environment[TetrisState, TetrisAction, TetrisOnlineMetrics]):
     gameState: GameState
     humanPlayer: bool
+    recordMoves: bool
     stateBuffer: NDArray[np.uint8]
 
-    def __init__(self, episodeNumber: int = 0, humanPlayer: bool = False) -> None:
+    def __init__(self, episodeNumber: int = 0, humanPlayer: bool = False, recordMoves: bool = True) -> None:
+        """With recordMoves=False, transitions are only returned by step and not kept in currentEpisodeRecord or
+        currentGameplayRecord, e.g., because they are streamed to a data service as they happen."""
         self.humanPlayer = humanPlayer
+        self.recordMoves = recordMoves
         self.gameState = GameState()
         self.stateBuffer = np.zeros((2, BOARD_SIZE[0], BOARD_SIZE[1] + 1), dtype=np.uint8)
         self.currentState = self._getCurrentState()
@@ -72,7 +76,8 @@ class TetrisEnvironment(Environment[TetrisState, TetrisAction, TetrisOnlineMetri
             reward=reward,
         )
         logger.debug(f"transition = {transition}")
-        self.currentEpisodeRecord = self.currentEpisodeRecord.append(transition)
+        if self.recordMoves:
+            self.currentEpisodeRecord = self.currentEpisodeRecord.append(transition)
         return transition
 
     def _updateBuffer(self) -> None:
@@ -98,7 +103,8 @@ class TetrisEnvironment(Environment[TetrisState, TetrisAction, TetrisOnlineMetri
         logger.info("Starting new episode.")
         self.gameState = GameState()
         self.currentState = self._getCurrentState()
-        self.currentGameplayRecord = self.currentGameplayRecord.appendEpisode(self.currentEpisodeRecord)
+        if self.recordMoves:
+            self.currentGameplayRecord = self.currentGameplayRecord.appendEpisode(self.currentEpisodeRecord)
         self.currentEpisodeRecord = TetrisEpisodeRecord(
             episodeNumber=self.currentEpisodeRecord.episodeNumber + 1, moves=[]
         )
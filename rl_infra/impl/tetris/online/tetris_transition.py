@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 from enum import Enum
-from typing import Any, Literal, Type
+from typing import Any, Literal, NamedTuple, Type
 
+import numpy as np
 import torch
 from pydantic import validator
 from tetris.config import BOARD_SIZE
@@ -13,6 +14,8 @@ from torch import Tensor
 from rl_infra.types.base_types import NumpyArray
 from rl_infra.types.online.transition import Action, State, Transition
 
+BOARD_SHAPE = (2, BOARD_SIZE[0], BOARD_SIZE[1] + 1)
+
 
 class TetrisPiece(str, Enum):
     ELL = "L"
@@ -37,6 +40,9 @@ class TetrisPiece(str, Enum):
         raise TypeError(f"Invalid type for val: {type(val)}")
 
 
+_PIECES_BY_VALUE = {piece.value: piece for piece in TetrisPiece}  # Skips the overhead of TetrisPiece(value)
+
+
 class TetrisState(State):
     board: NumpyArray[Literal["uint8"]]
     score: int
@@ -44,7 +50,44 @@ class TetrisState(State):
     nextPiece: TetrisPiece
 
     def toDqnInput(self) -> Tensor:
-        return torch.from_numpy(self.board.copy().reshape(1, 2, BOARD_SIZE[0], BOARD_SIZE[1] + 1))
+        return torch.from_numpy(self.board.copy().reshape((1,) + BOARD_SHAPE))
+
+    def toDbColumns(self) -> tuple[bytes, int, str, str, bool]:
+        return (
+            self.board.tobytes(),
+            self.score,
+            TetrisPiece(self.activePiece).value,
+            TetrisPiece(self.nextPiece).value,
+            self.isTerminal,
+        )
+
+    @classmethod
+    def fromDbColumns(
+        cls: Type[TetrisState],
+        board: bytes,
+        score: int,
+        activePiece: str,
+        nextPiece: str,
+        isTerminal: int,
+        trusted: bool = False,
+    ) -> TetrisState:
+        """With trusted=True, the state is built without pydantic validation.  Only use it for columns written by
+        toDbColumns."""
+        if trusted:
+            return cls.construct(
+                board=np.frombuffer(board, dtype=np.uint8).reshape(BOARD_SHAPE),
+                score=score,
+                activePiece=_PIECES_BY_VALUE[activePiece],
+                nextPiece=_PIECES_BY_VALUE[nextPiece],
+                isTerminal=bool(isTerminal),
+            )
+        return cls(
+            board=np.frombuffer(board, dtype=np.uint8).reshape(BOARD_SHAPE),  # pyright: ignore
+            score=score,
+            activePiece=activePiece,  # pyright: ignore
+            nextPiece=nextPiece,  # pyright: ignore
+            isTerminal=bool(isTerminal),
+        )
 
 
 class TetrisAction(Action, Enum):
@@ -58,6 +101,21 @@ class TetrisAction(Action, Enum):
         return KeyPress[self.value]
 
 
+class TetrisDataDbRow(NamedTuple):
+    stateBoard: bytes
+    stateScore: int
+    stateActivePiece: str
+    stateNextPiece: str
+    stateIsTerminal: bool
+    action: str
+    newStateBoard: bytes
+    newStateScore: int
+    newStateActivePiece: str
+    newStateNextPiece: str
+    newStateIsTerminal: bool
+    reward: float
+
+
 class TetrisTransition(Transition[TetrisState, TetrisAction]):
     @validator("state", "newState", pre=True)
     @classmethod
@@ -65,3 +123,29 @@ class TetrisTransition(Transition[TetrisState, TetrisAction]):
         if isinstance(val, str):
             return TetrisState.parse_raw(val)
         return val
+
+    def toTetrisDbRow(self) -> TetrisDataDbRow:
+        return TetrisDataDbRow(
+            *self.state.toDbColumns(),
+            TetrisAction(self.action).value,
+            *self.newState.toDbColumns(),
+            self.reward,
+        )
+
+    @classmethod
+    def fromTetrisDbRow(cls: Type[TetrisTransition], row: TetrisDataDbRow, trusted: bool = False) -> TetrisTransition:
+        """With trusted=True, the transition is built without pydantic validation.  Only use it for rows written by
+        toTetrisDbRow."""
+        if trusted:
+            return cls.construct(
+                state=TetrisState.fromDbColumns(*row[0:5], trusted=True),
+                action=row.action,
+                newState=TetrisState.fromDbColumns(*row[6:11], trusted=True),
+                reward=row.reward,
+            )
+        return cls(
+            state=TetrisState.fromDbColumns(*row[0:5]),
+            action=row.action,  # pyright: ignore
+            newState=TetrisState.fromDbColumns(*row[6:11]),
+            reward=row.reward,
+        )
@@ -10,7 +10,7 @@ from pydantic.dataclasses import dataclass
 from pydantic.fields import ModelField
 from typing_extensions import Self
 
-from rl_infra.utils import compressNpArray, uncompressNpArray
+from rl_infra.utils import compressNpArray, decodeNpArrayFrame, uncompressNpArray
 
 DType = TypeVar("DType")
 
@@ -20,6 +20,7 @@ class SerializedNumpyArray:
     data: str
     shape: tuple[int, ...]
     dtype: str
+    compression: str | None = None
 
 
 class NumpyArray(NDArray[Any], Generic[DType]):
@@ -41,8 +42,10 @@ class NumpyArray(NDArray[Any], Generic[DType]):
             # validate the contents of val
             arr = SerializedNumpyArray(**val)  # pyright: ignore
             res = uncompressNpArray(**asdict(arr))
+        if isinstance(val, (bytes, bytearray, memoryview)):
+            res = decodeNpArrayFrame(val)
         if res is None:
-            raise TypeError("val is not a numpy array or a serialized numpy array")
+            raise TypeError("val is not a numpy array, a serialized numpy array or a numpy array frame")
         if expectedDtype != res.dtype:
             raise TypeError(f"dtype of val is incorrect.  Expected {expectedDtype}, received {res.dtype}")
         return res
@@ -1,21 +1,92 @@
 import os
 import sqlite3
+import threading
 from contextlib import AbstractContextManager
 from types import TracebackType
+from typing import Any, Iterable, Sequence
+
+# Applied once to every pooled connection.  WAL lets readers proceed while a writer commits, and with WAL,
+# synchronous=NORMAL only syncs at checkpoints, which can lose the last transactions on power loss but never corrupts.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,  # Negative values are in KiB, so 64MiB
+    "mmap_size": 256 * 2**20,
+    "temp_store": "MEMORY",
+}
+SQLITE_CACHED_STATEMENTS = 256
+
+
+class _PooledConnection:
+    connection: sqlite3.Connection
+    depth: int
+
+    def __init__(self, dbPath: str) -> None:
+        # isolation_level=None disables the implicit transactions of the sqlite3 module, so that SqliteConnection
+        # controls BEGIN/COMMIT itself.
+        self.connection = sqlite3.connect(dbPath, isolation_level=None, cached_statements=SQLITE_CACHED_STATEMENTS)
+        for pragma, value in SQLITE_PRAGMAS.items():
+            self.connection.execute(f"PRAGMA {pragma} = {value};")
+        self.depth = 0
+
+
+class _ConnectionPool(threading.local):
+    """One long-lived connection per (dbPath, thread).  sqlite3 connections may not be shared between threads, and
+    threading.local drops (and thereby closes) a thread's connections when the thread exits."""
+
+    connections: dict[str, _PooledConnection]
+
+    def __init__(self) -> None:
+        self.connections = {}
+
+    def get(self, dbPath: str) -> _PooledConnection:
+        pooled = self.connections.get(dbPath)
+        if pooled is None:
+            pooled = self.connections[dbPath] = _PooledConnection(dbPath)
+        return pooled
+
+
+_pool = _ConnectionPool()
+
+
+def closeSqliteConnections(dbPath: str | None = None) -> None:
+    """Closes the current thread's pooled connections to dbPath, or all of them if dbPath is None.  They are reopened
+    on next use."""
+    for path in [dbPath] if dbPath is not None else list(_pool.connections):
+        pooled = _pool.connections.get(path)
+        if pooled is None:
+            continue
+        if pooled.depth > 0:
+            raise RuntimeError(f"Cannot close connection to {path} inside a transaction")
+        pooled.connection.close()
+        del _pool.connections[path]
 
 
 class SqliteConnection(AbstractContextManager[sqlite3.Cursor]):
+    """Transaction scope on the pooled connection to dbPath.  The outermost scope issues BEGIN, and COMMIT or ROLLBACK
+    depending on whether it exits with an exception.  Nested scopes on the same thread join the enclosing transaction,
+    so a sequence of calls that each open a scope can be made atomic (and cheaper) by wrapping them in one more.
+
+    Pass transaction=False for statements that cannot run inside a transaction, like VACUUM.  They still run in the
+    enclosing transaction, if any."""
+
     dbPath: str
-    connection: sqlite3.Connection | None
+    transaction: bool
+    pooled: _PooledConnection | None
 
-    def __init__(self, dbPath: str) -> None:
+    def __init__(self, dbPath: str, transaction: bool = True) -> None:
         self.dbPath = dbPath
+        self.transaction = transaction
+        self.pooled = None
         if not os.path.exists(os.path.dirname(dbPath)):
             os.makedirs(os.path.dirname(dbPath))
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.connection = sqlite3.connect(self.dbPath)
-        return self.connection.cursor()
+        self.pooled = _pool.get(self.dbPath)
+        if self.pooled.depth == 0 and self.transaction:
+            self.pooled.connection.execute("BEGIN;")
+        self.pooled.depth += 1
+        return self.pooled.connection.cursor()
 
     def __exit__(
         self,
@@ -23,9 +94,25 @@ class SqliteConnection(AbstractContextManager[sqlite3.Cursor]):
         __exc_value: BaseException | None,
         __traceback: TracebackType | None,
     ) -> bool | None:
-        if self.connection is not None:
-            self.connection.commit()
-            self.connection.close()
-        else:
+        if self.pooled is None:
             raise TypeError("connection is None type")
+        pooled, self.pooled = self.pooled, None
+        pooled.depth -= 1
+        if pooled.depth == 0 and pooled.connection.in_transaction:
+            if __exc_type is None:
+                pooled.connection.execute("COMMIT;")
+            else:
+                pooled.connection.execute("ROLLBACK;")
         return super().__exit__(__exc_type, __exc_value, __traceback)
+
+
+def findFullScans(cur: sqlite3.Cursor, queries: Iterable[tuple[str, str, Sequence[Any]]]) -> list[str]:
+    """Runs EXPLAIN QUERY PLAN on each (name, sql, params) query and returns a description of every plan step that
+    scans a whole table, or sorts with a temporary b-tree, instead of using an index.  SQLite reports MIN()/MAX()
+    queries as SEARCH with or without a usable index, so those are not caught here."""
+    problems = []
+    for name, sql, params in queries:
+        for _, _, _, detail in cur.execute(f"EXPLAIN QUERY PLAN {sql}", tuple(params)).fetchall():
+            if detail.startswith("SCAN ") or "USE TEMP B-TREE" in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
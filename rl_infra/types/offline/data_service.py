@@ -1,4 +1,7 @@
-from typing import Protocol, Sequence, TypeVar
+from typing import Any, NamedTuple, Protocol, Sequence, TypeVar, runtime_checkable
+
+import numpy as np
+from numpy.typing import NDArray
 
 from rl_infra.types.offline.schema import OnlineMetrics
 from rl_infra.types.online.environment import EpisodeRecord, GameplayRecord
@@ -9,6 +12,17 @@ OM = TypeVar("OM", bound=OnlineMetrics)
 S = TypeVar("S", bound=State)
 
 
+class TransitionBatch(NamedTuple):
+    """A batch of transitions stored by column, so that it can be turned into tensors without touching each transition
+    in Python.  Row i of every array belongs to transition i."""
+
+    states: NDArray[Any]
+    actions: NDArray[np.int64]  # Indices into the agent's possible actions
+    rewards: NDArray[np.float32]
+    nextStates: NDArray[Any]
+    nonFinalMask: NDArray[np.bool_]  # Whether state is not terminal
+
+
 class DataService(Protocol[S, A, OM]):
     capacity: int
 
@@ -22,4 +36,29 @@ class DataService(Protocol[S, A, OM]):
 
     def sample(self, batchSize: int) -> Sequence[Transition[S, A]]: ...
 
+    def sampleBatch(self, batchSize: int) -> TransitionBatch: ...
+
     def keepNewRowsDeleteOld(self, sgn: int) -> None: ...
+
+
+@runtime_checkable
+class PrioritizedDataService(Protocol[S, A]):
+    """A data service which can also sample transitions in proportion to their priority (prioritized replay).  Only
+    services with prioritized set keep priorities."""
+
+    prioritized: bool
+
+    def samplePrioritized(
+        self, batchSize: int, beta: float
+    ) -> tuple[Sequence[Transition[S, A]], NDArray[np.int64], NDArray[np.float32]]:
+        """Samples transitions with probability proportional to their priority.  Returns the transitions, the slots to
+        pass back to updatePriorities, and importance sampling weights for the loss."""
+        ...
+
+    def samplePrioritizedBatch(
+        self, batchSize: int, beta: float
+    ) -> tuple[TransitionBatch, NDArray[np.int64], NDArray[np.float32]]:
+        """Like samplePrioritized, but returns the transitions as a TransitionBatch."""
+        ...
+
+    def updatePriorities(self, slots: NDArray[np.int64], tdErrors: NDArray[np.float32]) -> None: ...
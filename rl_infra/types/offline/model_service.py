@@ -40,6 +40,16 @@ class ModelService(Protocol[Model, OnM, OffM]):
         optimizer: Optimizer | None,
     ) -> None: ...
 
+    def loadModelWeights(
+        self,
+        key: ModelDbKey,
+        policyModel: Model | None,
+        targetModel: Model | None,
+        optimizer: Optimizer | None,
+    ) -> None:
+        """Loads the saved weights of key into each of the given models and optimizer."""
+        ...
+
     def publishOnlineMetrics(self, key: ModelDbKey, onlineMetrics: OnM) -> None: ...
 
     def publishOfflineMetrics(self, key: ModelDbKey, offlineMetrics: OffM) -> None: ...
@@ -16,11 +16,22 @@ class OfflineMetrics(ABC, SerializableDataClass):
     # Other metrics vary by implementation
 
 
+# Sections of the single file checkpoint at ModelDbKey.checkpointLocation, named after the .pt files they replace
+POLICY_MODEL_SECTION = "policyModel"
+TARGET_MODEL_SECTION = "targetModel"
+OPTIMIZER_SECTION = "optimizer"
+
+
 class ModelDbKey(SerializableDataClass):
     tag: str
     version: int
     weightsLocation: str
 
+    @property
+    def checkpointLocation(self) -> str:
+        return f"{self.weightsLocation}/checkpoint.bin"
+
+    # Weights saved before checkpoints were single files
     @property
     def policyModelLocation(self) -> str:
         return f"{self.weightsLocation}/policyModel.pt"
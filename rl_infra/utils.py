@@ -1,22 +1,91 @@
-import base64
+import binascii
+import struct
+import zlib
 from typing import Any
 
 import numpy as np
 from numpy.typing import NDArray
 
+# Binary frames are a header followed by the array's bytes in C order, optionally compressed.  The header is the magic,
+# the compression code, ndim and the length of the dtype string, then the dtype string (e.g. "<f4") and the shape as
+# little-endian uint64s.
+FRAME_MAGIC = b"NPA1"
+_FRAME_HEADER = struct.Struct("<4sBBB")
+FRAME_COMPRESSIONS = {None: 0, "zlib": 1}
+_FRAME_COMPRESSIONS_BY_CODE = {code: compression for compression, code in FRAME_COMPRESSIONS.items()}
+_COMPRESSION_LEVEL = 1  # Favor speed.  Higher levels cost much more time for little gain on array data.
 
-def compressNpArray(nparr: NDArray[Any]) -> dict[str, str | tuple[int, ...]]:
-    """Returns the given numpy array as a base64 encoded string."""
-    return dict(
-        data=base64.b64encode(bytes(nparr)).decode("ascii"),
+
+def compressNpArray(nparr: NDArray[Any], compression: str | None = None) -> dict[str, Any]:
+    """Returns the given numpy array as a base64 encoded string, optionally compressed, along with its shape and dtype.
+    The compression key is only included if compression is set, so uncompressed output keeps the original format."""
+    res: dict[str, Any] = dict(
+        data=binascii.b2a_base64(_compress(_asBuffer(nparr), compression), newline=False).decode("ascii"),
         shape=nparr.shape,
         dtype=str(nparr.dtype),
     )
+    if compression is not None:
+        res["compression"] = compression
+    return res
 
 
-def uncompressNpArray(data: str, shape: tuple[int, ...], dtype: str) -> NDArray[Any]:
+def uncompressNpArray(data: str, shape: tuple[int, ...], dtype: str, compression: str | None = None) -> NDArray[Any]:
     """Returns the given numpy array decoded from base64-encoded string."""
     dt = np.dtype(dtype)
-    buff = base64.decodebytes(bytes(data, "ascii"))  # pyright: ignore
+    # a2b_base64 accepts ASCII str directly, saving a copy
+    buff = _decompress(binascii.a2b_base64(data), compression)
     arr = np.frombuffer(buff, dtype=dt)
     return arr.reshape(shape)
+
+
+def encodeNpArrayFrame(nparr: NDArray[Any], compression: str | None = None) -> bytes:
+    """Returns the given numpy array as a binary frame, for transports that can carry raw bytes."""
+    if compression not in FRAME_COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}.  Expected one of {list(FRAME_COMPRESSIONS)}")
+    dtype = nparr.dtype.str.encode("ascii")
+    header = _FRAME_HEADER.pack(FRAME_MAGIC, FRAME_COMPRESSIONS[compression], nparr.ndim, len(dtype))
+    shape = struct.pack(f"<{nparr.ndim}Q", *nparr.shape)
+    return b"".join((header, dtype, shape, _compress(_asBuffer(nparr), compression)))
+
+
+def decodeNpArrayFrame(frame: bytes | bytearray | memoryview) -> NDArray[Any]:
+    """Inverse of encodeNpArrayFrame.  Uncompressed frames are decoded without copying, into a read-only view of
+    frame."""
+    frame = memoryview(frame)
+    if len(frame) < _FRAME_HEADER.size:
+        raise ValueError("Frame is shorter than its header")
+    magic, compressionCode, ndim, dtypeLength = _FRAME_HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f"Not a numpy array frame (magic {bytes(magic)!r})")
+    if compressionCode not in _FRAME_COMPRESSIONS_BY_CODE:
+        raise ValueError(f"Unknown compression code {compressionCode}")
+    compression = _FRAME_COMPRESSIONS_BY_CODE[compressionCode]
+    offset = _FRAME_HEADER.size
+    dtype = np.dtype(bytes(frame[offset : offset + dtypeLength]).decode("ascii"))
+    offset += dtypeLength
+    shape = struct.unpack_from(f"<{ndim}Q", frame, offset)
+    offset += 8 * ndim
+    return np.frombuffer(_decompress(frame[offset:], compression), dtype=dtype).reshape(shape)
+
+
+def _asBuffer(nparr: NDArray[Any]) -> memoryview:
+    """The bytes of nparr in C order, without copying unless nparr is not C contiguous."""
+    if nparr.dtype.hasobject or nparr.dtype.names is not None:
+        raise TypeError(f"Only arrays of plain scalar types can be serialized, not {nparr.dtype}")
+    return memoryview(np.ascontiguousarray(nparr).reshape(-1).view(np.uint8))
+
+
+def _compress(buff: memoryview, compression: str | None) -> bytes | memoryview:
+    if compression is None:
+        return buff
+    if compression == "zlib":
+        return zlib.compress(buff, _COMPRESSION_LEVEL)
+    raise ValueError(f"Unknown compression {compression}.  Expected one of {list(FRAME_COMPRESSIONS)}")
+
+
+def _decompress(buff: bytes | memoryview, compression: str | None) -> bytes | memoryview:
+    if compression is None:
+        return buff
+    if compression == "zlib":
+        return zlib.decompress(buff)
+    raise ValueError(f"Unknown compression {compression}.  Expected one of {list(FRAME_COMPRESSIONS)}")